@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the cost of handling a leave, across room sizes, room types, and numbers of
+admins and moderators.
+
+The module runs against a mocked ModuleApi, so nothing is actually sent and the
+benchmark doesn't need a homeserver or network access. Results are saved as JSON so
+runs from before and after a change can be compared.
+
+Usage, with the module installed (e.g. `pip install -e .`), or with `tox -e benchmarks`:
+
+    python benchmarks/bench_check_event_allowed.py --output before.json
+    python benchmarks/bench_check_event_allowed.py --output after.json \\
+        --compare before.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+from unittest import mock
+
+import synapse
+from synapse.api.constants import EventTypes, Membership
+from synapse.api.room_versions import RoomVersions
+from synapse.events import EventBase, make_event_from_dict
+from synapse.module_api import ModuleApi
+from synapse.types import MutableStateMap, StateMap
+
+from manage_last_admin import (
+    ACCESS_RULES_TYPE,
+    ROOM_ADMIN_INDEX_MAX_ROOMS,
+    AccessRules,
+    ManageLastAdmin,
+    RoomSnapshot,
+    RoomType,
+    _get_users_with_highest_nondefault_pl,
+    _is_last_admin_leaving,
+    _LruCache,
+)
+
+T = TypeVar("T")
+
+ROOM_ID = "!bench:example.com"
+ADMIN = "@admin0:example.com"
+
+DEFAULT_SIZES = [10, 1000, 10000, 100000]
+# The minimum duration of a sample, in seconds.
+SAMPLE_DURATION = 0.02
+
+ROOM_TYPES = [RoomType.PUBLIC, RoomType.PRIVATE, RoomType.EXTERNAL, RoomType.UNKNOWN]
+
+
+def make_event(content: Dict[str, Any]) -> EventBase:
+    return make_event_from_dict({"room_id": ROOM_ID, **content}, RoomVersions.V9)
+
+
+def make_members(members: int) -> MutableStateMap[EventBase]:
+    """Builds the membership events of a room in which every member is joined."""
+    state: MutableStateMap[EventBase] = {}
+    for i in range(members):
+        user_id = f"@user{i}:example.com"
+        state[(EventTypes.Member, user_id)] = make_event(
+            {
+                "sender": user_id,
+                "type": EventTypes.Member,
+                "state_key": user_id,
+                "content": {"membership": Membership.JOIN},
+            }
+        )
+    return state
+
+
+def make_room(
+    members: MutableStateMap[EventBase],
+    room_type: str,
+    admins: int,
+    moderators: int,
+) -> MutableStateMap[EventBase]:
+    """Builds the state of a room of the given type, with the given members.
+
+    Args:
+        members: The membership events of the room.
+        room_type: The type of the room, see RoomType.
+        admins: How many admins the room has, including ADMIN.
+        moderators: How many moderators the room has.
+
+    Returns:
+        The state of the room.
+    """
+    state = dict(members)
+    for i in range(admins):
+        user_id = f"@admin{i}:example.com"
+        state[(EventTypes.Member, user_id)] = make_event(
+            {
+                "sender": user_id,
+                "type": EventTypes.Member,
+                "state_key": user_id,
+                "content": {"membership": Membership.JOIN},
+            }
+        )
+
+    users = {f"@admin{i}:example.com": 100 for i in range(admins)}
+    users.update({f"@user{i}:example.com": 50 for i in range(moderators)})
+    state[(EventTypes.PowerLevels, "")] = make_event(
+        {
+            "sender": ADMIN,
+            "type": EventTypes.PowerLevels,
+            "state_key": "",
+            "content": {"users": users, "users_default": 0},
+        }
+    )
+
+    if room_type != RoomType.PUBLIC:
+        state[(EventTypes.RoomEncryption, "")] = make_event(
+            {
+                "sender": ADMIN,
+                "type": EventTypes.RoomEncryption,
+                "state_key": "",
+                "content": {"algorithm": "m.megolm.v1.aes-sha2"},
+            }
+        )
+
+    access_rule = {
+        RoomType.PRIVATE: AccessRules.RESTRICTED,
+        RoomType.EXTERNAL: AccessRules.UNRESTRICTED,
+    }.get(room_type)
+    if access_rule is not None:
+        state[(ACCESS_RULES_TYPE, "")] = make_event(
+            {
+                "sender": ADMIN,
+                "type": ACCESS_RULES_TYPE,
+                "state_key": "",
+                "content": {"rule": access_rule},
+            }
+        )
+
+    return state
+
+
+def make_leave(user_id: str) -> EventBase:
+    return make_event(
+        {
+            "sender": user_id,
+            "type": EventTypes.Member,
+            "state_key": user_id,
+            "content": {"membership": Membership.LEAVE},
+        }
+    )
+
+
+def create_module(
+    config: Dict[str, Any], state: MutableStateMap[EventBase]
+) -> ManageLastAdmin:
+    async def get_room_state(
+        room_id: str,
+        event_filter: Optional[Iterable[Tuple[str, Optional[str]]]] = None,
+    ) -> StateMap[EventBase]:
+        if event_filter is None:
+            return state
+        keys = set(event_filter)
+        return {
+            key: event
+            for key, event in state.items()
+            if key in keys or (key[0], None) in keys
+        }
+
+    module_api = mock.Mock(spec=ModuleApi)
+    module_api.create_and_send_event_into_room = mock.AsyncMock()
+    module_api.get_room_state = mock.AsyncMock(side_effect=get_room_state)
+    # The users leaving the benchmark's rooms are local.
+    module_api.is_mine.return_value = True
+    # There's no reactor to run computations off, so run them inline.
+    module_api.defer_to_thread = mock.AsyncMock(
+        side_effect=lambda f, *args, **kwargs: f(*args, **kwargs)
+    )
+    # Don't coalesce repairs, so every leave of the last admin repairs the room.
+    config = {"repair_coalescing_window_ms": 0, **config}
+    return ManageLastAdmin(ManageLastAdmin.parse_config(config), module_api)
+
+
+def run(awaitable: Awaitable[T]) -> T:
+    """Runs a coroutine which never needs to wait on anything, which is the case when
+    running against the mocked ModuleApi, without the overhead of an event loop.
+    """
+    coroutine = awaitable.__await__()
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value  # type: ignore[no-any-return]
+    raise RuntimeError("The benchmarked coroutine had to wait")
+
+
+def measure(func: Callable[[], object], repeat: int) -> Dict[str, Any]:
+    """Times the given function.
+
+    Returns:
+        The number of calls per sample, and the best and median time of a call across
+        samples, in milliseconds.
+    """
+    timer = timeit.Timer(func)
+
+    # Make each sample last at least SAMPLE_DURATION seconds.
+    number = 1
+    while True:
+        duration = timer.timeit(number)
+        if duration >= SAMPLE_DURATION:
+            break
+        number *= 10 if duration < SAMPLE_DURATION / 10 else 2
+
+    samples = sorted(t / number * 1000 for t in timer.repeat(repeat, number))
+    return {
+        "number": number,
+        "best_ms": samples[0],
+        "median_ms": samples[len(samples) // 2],
+    }
+
+
+def bench_room(
+    state: MutableStateMap[EventBase],
+    promote_moderators: bool,
+    repeat: int,
+) -> Dict[str, Dict[str, Any]]:
+    """Runs every benchmark against a room.
+
+    Returns:
+        The timings of each benchmark, by name.
+    """
+    module = create_module({"promote_moderators": promote_moderators}, state)
+    admin_leave = make_leave(ADMIN)
+    member_leave = make_leave("@user0:example.com")
+    snapshot = RoomSnapshot.from_state(state)
+    assert snapshot.power_levels is not None
+    pl_content = snapshot.power_levels.content
+    admin_level = pl_content["users"][ADMIN]
+    candidates = _get_users_with_highest_nondefault_pl(snapshot, ADMIN)
+
+    def cold_admin_leave() -> None:
+        # Forget about the room, so its admin index has to be built again.
+        module._room_admin_indexes = _LruCache(ROOM_ADMIN_INDEX_MAX_ROOMS)
+        run(module.check_event_allowed(admin_leave, state))
+
+    def warm_member_leave() -> None:
+        run(module.check_event_allowed(member_leave, state))
+
+    warm_member_leave()
+
+    return {
+        "check_event_allowed_admin_cold": measure(cold_admin_leave, repeat),
+        "check_event_allowed_member_warm": measure(warm_member_leave, repeat),
+        "room_snapshot_from_state": measure(
+            lambda: RoomSnapshot.from_state(state), repeat
+        ),
+        "is_last_admin_leaving": measure(
+            lambda: _is_last_admin_leaving(admin_leave, snapshot), repeat
+        ),
+        "get_users_with_highest_nondefault_pl": measure(
+            lambda: _get_users_with_highest_nondefault_pl(snapshot, ADMIN), repeat
+        ),
+        "plan_promotion": measure(
+            lambda: run(
+                module._plan_promotion(
+                    admin_leave.room_id, candidates, pl_content, admin_level
+                )
+            ),
+            repeat,
+        ),
+    }
+
+
+def bench(sizes: Iterable[int], repeat: int) -> List[Dict[str, Any]]:
+    results = []
+    for size in sizes:
+        members = make_members(size)
+        for room_type in ROOM_TYPES:
+            for admins in (1, 5):
+                for moderators in sorted({1, max(1, size // 100)}):
+                    state = make_room(members, room_type, admins, moderators)
+                    timings = bench_room(state, promote_moderators=True, repeat=repeat)
+                    for name, timing in timings.items():
+                        result = {
+                            "benchmark": name,
+                            "members": size,
+                            "room_type": room_type,
+                            "admins": admins,
+                            "moderators": moderators,
+                            **timing,
+                        }
+                        results.append(result)
+                        print(
+                            f"{name:<38} {size:>7} {room_type:<9} {admins:>2} admins"
+                            f" {moderators:>5} mods {timing['median_ms']:>10.4f} ms",
+                            flush=True,
+                        )
+    return results
+
+
+def result_key(result: Dict[str, Any]) -> str:
+    return (
+        f"{result['benchmark']}/{result['members']}/{result['room_type']}"
+        f"/{result['admins']}/{result['moderators']}"
+    )
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str) -> None:
+    """Prints how the median times of the results compare with a previous run."""
+    with open(baseline_path) as f:
+        baseline = {result_key(r): r for r in json.load(f)["results"]}
+
+    print(f"\nCompared with {baseline_path} (ratio of median times, < 1 is faster):")
+    for result in results:
+        previous = baseline.get(result_key(result))
+        if previous is None or not previous["median_ms"]:
+            continue
+        ratio = result["median_ms"] / previous["median_ms"]
+        print(f"{result_key(result):<70} {ratio:>6.2f}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help="The numbers of members of the rooms to benchmark.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="How many samples to take."
+    )
+    parser.add_argument(
+        "--output",
+        default="benchmark-results.json",
+        help="Where to save the results.",
+    )
+    parser.add_argument(
+        "--compare",
+        metavar="BASELINE",
+        help="Results of a previous run to compare the new results with.",
+    )
+    args = parser.parse_args(argv)
+
+    results = bench(args.sizes, args.repeat)
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "metadata": {
+                    "timestamp": int(time.time()),
+                    "python": platform.python_version(),
+                    "synapse": synapse.__version__,
+                    "sizes": args.sizes,
+                    "repeat": args.repeat,
+                },
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Results saved to {args.output}")
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the bucketed selection of users with the highest non-default power level
+against the previous implementation, which looked for the maximum level again for each
+tier it discarded.
+
+Usage, with the module installed (e.g. `pip install -e .`):
+
+    python benchmarks/bench_highest_pl.py
+"""
+import timeit
+from typing import Dict, List
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.api.room_versions import RoomVersions
+from synapse.events import make_event_from_dict
+
+from manage_last_admin import (
+    RoomSnapshot,
+    _get_power_levels_view_for_event,
+    _get_users_with_highest_nondefault_pl,
+)
+
+USERS = 10000
+LEAVING_ADMIN = "@admin:example.com"
+
+
+def legacy_get_users_with_highest_nondefault_pl(
+    users_dict: Dict[str, int],
+    users_default_pl: int,
+    memberships: Dict[str, str],
+    ignore_user: str,
+) -> List[str]:
+    users_dict_copy = users_dict.copy()
+    users_dict_copy.pop(ignore_user, None)
+
+    while users_dict_copy:
+        max_pl = max(users_dict_copy.values())
+        if max_pl <= users_default_pl:
+            return []
+
+        users_with_max_pl = [
+            user_id for user_id, pl in users_dict_copy.items() if pl == max_pl
+        ]
+        users_to_promote = [
+            user_id
+            for user_id in users_with_max_pl
+            if memberships.get(user_id) in [Membership.JOIN, Membership.INVITE]
+        ]
+        if users_to_promote:
+            return users_to_promote
+
+        for user_id in users_with_max_pl:
+            del users_dict_copy[user_id]
+
+    return []
+
+
+def make_room(tiers: int) -> RoomSnapshot:
+    """Builds a room with USERS users spread over the given number of power levels
+    above the default. Only the users of the lowest tier are still in the room, so every
+    other tier has to be looked at and discarded.
+    """
+    users = {LEAVING_ADMIN: 100}
+    memberships = {LEAVING_ADMIN: Membership.JOIN}
+    for i in range(USERS):
+        tier = i % tiers
+        user_id = f"@user{i}:example.com"
+        users[user_id] = tiers - tier
+        memberships[user_id] = (
+            Membership.JOIN if tier == tiers - 1 else Membership.LEAVE
+        )
+
+    event = make_event_from_dict(
+        {
+            "sender": LEAVING_ADMIN,
+            "type": EventTypes.PowerLevels,
+            "state_key": "",
+            "content": {"users": users, "users_default": 0},
+            "room_id": "!bench:example.com",
+        },
+        RoomVersions.V9,
+    )
+    snapshot = RoomSnapshot()
+    snapshot.power_levels = _get_power_levels_view_for_event(event)
+    snapshot.memberships = memberships
+    return snapshot
+
+
+def main() -> None:
+    print(f"{USERS} users in the power levels event")
+    print(f"{'tiers':>6} {'legacy (ms)':>12} {'bucketed (ms)':>14} {'speedup':>8}")
+    for tiers in (1, 5, 20, 100, 500):
+        snapshot = make_room(tiers)
+        assert snapshot.power_levels is not None
+        users = snapshot.power_levels.content["users"]
+
+        expected = legacy_get_users_with_highest_nondefault_pl(
+            users, 0, snapshot.memberships, LEAVING_ADMIN
+        )
+        result = _get_users_with_highest_nondefault_pl(snapshot, LEAVING_ADMIN)
+        assert result == expected, (tiers, len(result), len(expected))
+
+        number = 20
+        legacy = timeit.timeit(
+            lambda: legacy_get_users_with_highest_nondefault_pl(
+                users, 0, snapshot.memberships, LEAVING_ADMIN
+            ),
+            number=number,
+        )
+        bucketed = timeit.timeit(
+            lambda: _get_users_with_highest_nondefault_pl(snapshot, LEAVING_ADMIN),
+            number=number,
+        )
+        print(
+            f"{tiers:>6} {legacy * 1000 / number:>12.3f} "
+            f"{bucketed * 1000 / number:>14.3f} {legacy / bucketed:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the time and memory it takes to build the content of a new power levels
+event promoting a few users, with a deep copy of the current content and with the
+copy-on-write builder.
+
+Usage, with the module installed (e.g. `pip install -e .`):
+
+    python benchmarks/bench_power_levels_copy.py
+"""
+import copy
+import timeit
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from manage_last_admin import _PowerLevelsContentBuilder
+
+PROMOTED_USERS = 10
+
+
+def make_content(users: int) -> Dict[str, Any]:
+    return {
+        "ban": 50,
+        "events": {f"org.example.event{i}": 50 for i in range(50)},
+        "events_default": 0,
+        "invite": 0,
+        "kick": 50,
+        "notifications": {"room": 50},
+        "redact": 50,
+        "state_default": 50,
+        "users": {f"@user{i}:example.com": i % 100 for i in range(users)},
+        "users_default": 0,
+    }
+
+
+def with_deepcopy(content: Dict[str, Any], promoted: List[str]) -> Dict[str, Any]:
+    new_content = copy.deepcopy(content)
+    for user_id in promoted:
+        new_content["users"][user_id] = 100
+    return new_content
+
+
+def with_builder(content: Dict[str, Any], promoted: List[str]) -> Dict[str, Any]:
+    builder = _PowerLevelsContentBuilder(content)
+    for user_id in promoted:
+        builder.set_user_level(user_id, 100)
+    return builder.build()
+
+
+def peak_allocated(
+    f: Callable[[Dict[str, Any], List[str]], Dict[str, Any]],
+    content: Dict[str, Any],
+    promoted: List[str],
+) -> int:
+    tracemalloc.start()
+    f(content, promoted)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main() -> None:
+    print(f"Promoting {PROMOTED_USERS} users")
+    print(
+        f"{'users':>7} {'deepcopy (ms)':>14} {'builder (ms)':>13}"
+        f" {'deepcopy (KiB)':>15} {'builder (KiB)':>14}"
+    )
+    for users in (5000, 20000, 50000):
+        content = make_content(users)
+        promoted = [f"@user{i}:example.com" for i in range(PROMOTED_USERS)]
+        assert with_deepcopy(content, promoted) == with_builder(content, promoted)
+
+        number = 10
+        deepcopy_time = timeit.timeit(
+            lambda: with_deepcopy(content, promoted), number=number
+        )
+        builder_time = timeit.timeit(
+            lambda: with_builder(content, promoted), number=number
+        )
+        deepcopy_peak = peak_allocated(with_deepcopy, content, promoted)
+        builder_peak = peak_allocated(with_builder, content, promoted)
+        print(
+            f"{users:>7} {deepcopy_time * 1000 / number:>14.3f}"
+            f" {builder_time * 1000 / number:>13.3f}"
+            f" {deepcopy_peak / 1024:>15.1f} {builder_peak / 1024:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
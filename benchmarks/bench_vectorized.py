@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares candidate selection with NumPy and in pure Python, to find from how many
+users the NumPy engine pays off (see the vectorized_threshold option).
+
+Candidates are selected among the moderators of a room, and the ones from a forbidden
+domain are left out. "Cold" timings include building the arrays of the power levels
+event, which happens once per power levels event, when it's sent; "warm" timings reuse
+them. Selection is also measured in a
+"tiered" room, where a single moderator outranks every other user listed in the power
+levels, in which both implementations stop at the moderator's level.
+
+Usage, with the module and NumPy installed:
+
+    python benchmarks/bench_vectorized.py
+"""
+import argparse
+import sys
+from typing import List, Optional
+
+from bench_check_event_allowed import (
+    ADMIN,
+    make_event,
+    make_members,
+    make_room,
+    measure,
+)
+from synapse.api.constants import EventTypes
+from synapse.events import EventBase
+from synapse.types import MutableStateMap
+
+from manage_last_admin import (
+    DomainMatcher,
+    RoomSnapshot,
+    RoomType,
+    _filter_out_users_from_forbidden_domain,
+    _get_users_with_highest_nondefault_pl,
+    vectorized,
+)
+
+DEFAULT_SIZES = [10, 100, 300, 1000, 3000, 10000, 100000]
+
+FORBIDDEN_DOMAINS = DomainMatcher(["externe.com"])
+
+
+def make_tiered_room(
+    members: MutableStateMap[EventBase], size: int
+) -> MutableStateMap[EventBase]:
+    """Builds a public room in which one member is a moderator, and the other members
+    are listed in the power levels with a lower, non-default level (e.g. bots).
+    """
+    state = make_room(members, RoomType.PUBLIC, 1, 0)
+    users = {ADMIN: 100, "@user0:example.com": 50}
+    users.update({f"@user{i}:example.com": 10 for i in range(1, size)})
+    state[(EventTypes.PowerLevels, "")] = make_event(
+        {
+            "sender": ADMIN,
+            "type": EventTypes.PowerLevels,
+            "state_key": "",
+            "content": {"users": users, "users_default": 0},
+        }
+    )
+    return state
+
+
+def bench(sizes: List[int], repeat: int) -> None:
+    print(
+        f"{'users':>7} {'python':>10} {'numpy cold':>10} {'numpy warm':>10}"
+        f" {'tiered python':>13} {'tiered numpy':>12}  (median, ms)"
+    )
+    for size in sizes:
+        members = make_members(size)
+        snapshot = RoomSnapshot.from_state(make_room(members, RoomType.PUBLIC, 1, size))
+        power_levels = snapshot.power_levels
+        assert power_levels is not None
+
+        def python() -> List[str]:
+            return _filter_out_users_from_forbidden_domain(
+                _get_users_with_highest_nondefault_pl(snapshot, ADMIN),
+                FORBIDDEN_DOMAINS,
+            )
+
+        def numpy_cold() -> List[str]:
+            engine = vectorized.VectorizedEngine(1, FORBIDDEN_DOMAINS)
+            return engine.get_users_with_highest_nondefault_pl(
+                power_levels, snapshot.memberships, ADMIN
+            )[1]
+
+        # Keeps the arrays of both rooms' power levels.
+        engine = vectorized.VectorizedEngine(2, FORBIDDEN_DOMAINS)
+
+        def numpy_warm() -> List[str]:
+            return engine.get_users_with_highest_nondefault_pl(
+                power_levels, snapshot.memberships, ADMIN
+            )[1]
+
+        assert python() == numpy_cold() == numpy_warm()
+
+        tiered = RoomSnapshot.from_state(make_tiered_room(members, size))
+        tiered_power_levels = tiered.power_levels
+        assert tiered_power_levels is not None
+
+        def tiered_python() -> List[str]:
+            return _filter_out_users_from_forbidden_domain(
+                _get_users_with_highest_nondefault_pl(tiered, ADMIN),
+                FORBIDDEN_DOMAINS,
+            )
+
+        def tiered_numpy() -> List[str]:
+            return engine.get_users_with_highest_nondefault_pl(
+                tiered_power_levels, tiered.memberships, ADMIN
+            )[1]
+
+        assert tiered_python() == tiered_numpy()
+
+        timings = [
+            measure(python, repeat),
+            measure(numpy_cold, repeat),
+            measure(numpy_warm, repeat),
+            measure(tiered_python, repeat),
+            measure(tiered_numpy, repeat),
+        ]
+        medians = [timing["median_ms"] for timing in timings]
+        print(
+            f"{size:>7} {medians[0]:>10.4f} {medians[1]:>10.4f} {medians[2]:>10.4f}"
+            f" {medians[3]:>13.4f} {medians[4]:>12.4f}",
+            flush=True,
+        )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help="The numbers of users to select candidates among.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="How many samples to take."
+    )
+    args = parser.parse_args(argv)
+
+    if not vectorized.AVAILABLE:
+        sys.exit("NumPy isn't installed")
+
+    bench(args.sizes, args.repeat)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -12,239 +12,2197 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import copy
+import functools
 import logging
-from typing import Any, Dict, Final, Iterable, Optional, Tuple, List
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import (
+    AbstractSet,
+    Any,
+    Awaitable,
+    Callable,
+    Collection,
+    Dict,
+    Final,
+    FrozenSet,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 import attr
+from canonicaljson import encode_canonical_json
 from synapse.api.constants import EventTypes, Membership
 from synapse.api.room_versions import EventFormatVersions, RoomVersion
-from synapse.events import EventBase
-from synapse.module_api import ModuleApi, UserID
+from synapse.events import EventBase, make_event_from_dict
+from synapse.logging.context import PreserveLoggingContext
+from synapse.logging.opentracing import set_tag, start_active_span
+from synapse.module_api import (
+    ModuleApi,
+    make_deferred_yieldable,
+    run_as_background_process,
+)
+from synapse.module_api.errors import ConfigError
 from synapse.types import StateMap
+from synapse.util.async_helpers import Linearizer
+from synapse.util.caches import EvictionReason
 from synapse.util.stringutils import random_string
+from twisted.internet import defer
+
+from manage_last_admin import metrics, vectorized
+from manage_last_admin.deactivation import DeactivationBatcher
+from manage_last_admin.retries import RepairRetryQueue, RetryResult
+from manage_last_admin.sampler import SlowInvocationSampler
+from manage_last_admin.sweeper import OrphanedRoomSweeper
+from manage_last_admin.warmup import CacheWarmer
 
 logger = logging.getLogger(__name__)
 
+KT = TypeVar("KT")
+VT = TypeVar("VT")
+T = TypeVar("T")
+R = TypeVar("R")
+
+# The maximum number of rooms for which we keep an admin index in memory.
+ROOM_ADMIN_INDEX_MAX_ROOMS = 10000
+
+# The maximum number of user IDs we keep the domain of in memory.
+USER_DOMAIN_CACHE_SIZE = 100000
+
+# The maximum number of power levels views we keep in memory.
+POWER_LEVELS_VIEW_CACHE_SIZE = 1000
+
+# The maximum number of rooms to remember the type of.
+ROOM_TYPE_CACHE_SIZE = 10000
+
+# From how many state entries or users to go through computations are run in a thread.
+OFFLOAD_THRESHOLD = 10000
+
+# From how many users to look at candidate selection is done with NumPy, if installed.
+# Selecting with the arrays of a power levels event is faster than in pure Python from a
+# hundred users or so, but building them costs more than a pure-Python selection, so
+# they're only built, when the power levels event is sent, for rooms where the selection
+# is worth speeding up (see benchmarks/bench_vectorized.py).
+VECTORIZED_THRESHOLD = 1000
+
+# The maximum size of an event, in bytes, once encoded in canonical JSON.
+# See https://spec.matrix.org/v1.12/client-server-api/#size-limits
+MAX_EVENT_SIZE = 65536
+
+# How much of the event size limit we keep for the fields of a power levels event other
+# than its content (signatures, hashes, prev and auth events, etc.).
+EVENT_SIZE_HEADROOM = 4096
+
+
+class RoomType:
+    DIRECT: Final = "DIRECT"
+    PUBLIC: Final = "PUBLIC"
+    PRIVATE: Final = "PRIVATE"
+    EXTERNAL: Final = "EXTERNAL"
+    UNKNOWN: Final = "UNKNOWN"
+
+
+class LeaveOutcome:
+    """What came out of processing an event in check_event_allowed."""
+
+    # The event isn't a leave, or the room has no usable power levels.
+    IGNORED: Final = "ignored"
+    # The room is repaired by another homeserver, see _is_responsible_server.
+    NOT_RESPONSIBLE: Final = "not_responsible"
+    # The user leaving the room isn't its last admin.
+    NOT_LAST_ADMIN: Final = "not_last_admin"
+    # The room had just been repaired by another leave.
+    COALESCED: Final = "coalesced"
+    # Users were promoted to admins.
+    PROMOTED: Final = "promoted"
+    # Admin was made the default power level of the room.
+    DEFAULT_TO_ADMIN: Final = "default_to_admin"
+    # The new power levels event couldn't be sent.
+    SEND_FAILED: Final = "send_failed"
+
+
+class TracingTags:
+    """The tags set on the module's opentracing spans."""
+
+    # The number of entries in the room's state.
+    ROOM_SIZE: Final = "manage_last_admin.room_size"
+    # The type of the room, see RoomType.
+    ROOM_TYPE: Final = "manage_last_admin.room_type"
+    # The number of users considered for a promotion.
+    CANDIDATES: Final = "manage_last_admin.candidates"
+    # How the room is repaired, "promote" or "default_to_admin".
+    STRATEGY: Final = "manage_last_admin.strategy"
+    # The outcome of processing the leave, see LeaveOutcome.
+    OUTCOME: Final = "manage_last_admin.outcome"
+
+
+ACCESS_RULES_TYPE = "im.vector.room.access_rules"
+
+
+class AccessRules:
+    RESTRICTED = "restricted"
+    UNRESTRICTED = "unrestricted"
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class PowerLevelsView:
+    """Data derived from the content of a m.room.power_levels event.
+
+    Events never change, so a view only needs to be computed once per power levels
+    event, see _get_power_levels_view_for_event.
+    """
+
+    # The ID of the power levels event.
+    event_id: str
+    # The content of the power levels event.
+    content: Dict[str, Any]
+    # Every user listed in the "users" dictionary of the content.
+    users: FrozenSet[str]
+    # The users with an admin power level.
+    admins: FrozenSet[str]
+    # The user-specific power levels, from highest to lowest, with the users that
+    # have each of them.
+    levels: Tuple[Tuple[int, Tuple[str, ...]], ...]
+    # The default power level for users who don't appear in the "users" dictionary.
+    users_default: int
+
+
+class DomainMatcher:
+    """Checks whether domains belong to a list of domains.
+
+    The list can contain exact domains (e.g. "externe.com") and wildcard patterns (e.g.
+    "*.externe.com") which match any subdomain of a domain, but not the domain itself.
+    Exact domains are kept in a set, and wildcard patterns in a trie of reversed labels,
+    so checking a domain doesn't depend on the size of the list.
+    """
+
+    __slots__ = ("_exact", "_wildcards")
+
+    # The key marking a node of the trie as the end of a wildcard pattern.
+    _WILDCARD: Final = "*"
+
+    def __init__(self, domains: Iterable[str]):
+        exact = set()
+        self._wildcards: Dict[str, Any] = {}
+        for domain in domains:
+            if not domain.startswith("*."):
+                exact.add(domain)
+                continue
+
+            node = self._wildcards
+            for label in reversed(domain[2:].split(".")):
+                node = node.setdefault(label, {})
+            node[self._WILDCARD] = True
+
+        self._exact = frozenset(exact)
+
+    def __bool__(self) -> bool:
+        return bool(self._exact or self._wildcards)
+
+    def matches(self, domain: str) -> bool:
+        """Checks whether the given domain is in the list."""
+        if domain in self._exact:
+            return True
+
+        if not self._wildcards:
+            return False
+
+        node = self._wildcards
+        labels = domain.split(".")
+        # Walk down the trie from the top-level domain, and stop as soon as we reach a
+        # wildcard with at least one label left to match it.
+        for i in range(len(labels) - 1, 0, -1):
+            child = node.get(labels[i])
+            if child is None:
+                return False
+            node = child
+            if self._WILDCARD in node:
+                return True
+
+        return False
+
+
+@attr.s(auto_attribs=True, frozen=True)
+class ManageLastAdminConfig:
+    promote_moderators: bool = False
+    domains_forbidden_when_restricted: List[str] = []
+    # The compiled version of domains_forbidden_when_restricted.
+    forbidden_domains: DomainMatcher = attr.Factory(
+        lambda self: DomainMatcher(self.domains_forbidden_when_restricted),
+        takes_self=True,
+    )
+    repair_in_background: bool = False
+    repair_concurrency: int = 10
+    repair_coalescing_window_ms: int = 5000
+    sweeper_enabled: bool = False
+    sweeper_interval_ms: int = 24 * 60 * 60 * 1000
+    sweeper_batch_size: int = 100
+    sweeper_concurrency: int = 5
+    sweeper_rooms_per_second: float = 10
+    vectorized_threshold: Optional[int] = VECTORIZED_THRESHOLD
+    dry_run: bool = False
+    offload_threshold: Optional[int] = OFFLOAD_THRESHOLD
+    retry_failed_repairs: bool = False
+    retry_database_path: Optional[str] = None
+    retry_interval_ms: int = 10 * 1000
+    retry_base_delay_ms: int = 10 * 1000
+    retry_max_delay_ms: int = 60 * 60 * 1000
+    retry_max_attempts: int = 10
+    retry_batch_size: int = 50
+    retry_concurrency: int = 5
+    warmup_enabled: bool = False
+    warmup_rooms: Optional[List[str]] = None
+    warmup_max_rooms: int = 1000
+    warmup_rooms_per_second: float = 20
+    warmup_delay_ms: int = 30 * 1000
+    batch_deactivations: bool = False
+    deactivation_concurrency: int = 10
+    slow_sampler_threshold_ms: Optional[int] = None
+    slow_sampler_directory: str = os.path.join(
+        tempfile.gettempdir(), "manage_last_admin_samples"
+    )
+    slow_sampler_max_samples: int = 20
+    slow_sampler_min_interval_ms: int = 60 * 1000
+
+
+# The options which must be positive numbers, e.g. because they're divided by.
+_POSITIVE_OPTIONS = (
+    "repair_concurrency",
+    "sweeper_batch_size",
+    "sweeper_concurrency",
+    "sweeper_rooms_per_second",
+    "retry_batch_size",
+    "retry_concurrency",
+    "warmup_rooms_per_second",
+    "deactivation_concurrency",
+    "slow_sampler_max_samples",
+)
+
+
+class ManageLastAdmin:
+    def __init__(self, config: ManageLastAdminConfig, api: ModuleApi):
+        self._api = api
+        self._config = config
+
+        # Per-room index of admins and members, so we don't need to walk the whole
+        # room state on every leave.
+        self._room_admin_indexes: _LruCache[str, _RoomAdminIndex] = _LruCache(
+            ROOM_ADMIN_INDEX_MAX_ROOMS, name="room_admin_indexes"
+        )
+
+        # The type of each room, see get_room_type.
+        self._room_types = _RoomTypeCache(ROOM_TYPE_CACHE_SIZE)
+
+        # Selects candidates with NumPy in rooms with a lot of users to look at.
+        self._vectorized: Optional[vectorized.VectorizedEngine] = None
+        if vectorized.AVAILABLE and config.vectorized_threshold is not None:
+            self._vectorized = vectorized.VectorizedEngine(
+                POWER_LEVELS_VIEW_CACHE_SIZE, config.forbidden_domains
+            )
+
+        # Leaves to process in the background, if configured to.
+        self._background_repairs: _BackgroundRunner[
+            Tuple[EventBase, StateMap[EventBase]], str
+        ] = _BackgroundRunner(
+            "manage_last_admin_repair",
+            config.repair_concurrency,
+            lambda item: self._on_room_leave(*item),
+        )
+        metrics.background_repairs.set_function(lambda: len(self._background_repairs))
+
+        # Repairs of the same room are run one at a time, and we remember when we last
+        # repaired each room so repairs that follow closely can be coalesced with it.
+        self._repair_linearizer = Linearizer(name="manage_last_admin_repair")
+        self._last_repairs: _LruCache[str, float] = _LruCache(
+            ROOM_ADMIN_INDEX_MAX_ROOMS
+        )
+        # How many repairs turned out to be unnecessary because another repair of the
+        # same room had just been done.
+        self.coalesced_repairs = 0
+
+        # Looks for rooms that lost their last admin without us noticing, e.g. before
+        # the module was deployed.
+        self.sweeper = OrphanedRoomSweeper(
+            api,
+            self._is_room_orphaned,
+            config.sweeper_batch_size,
+            config.sweeper_concurrency,
+            config.sweeper_rooms_per_second,
+        )
+        if config.sweeper_enabled:
+            self.sweeper.start(config.sweeper_interval_ms)
+
+        # Repairs that failed to send their power levels event, to try again later.
+        self.retry_queue: Optional[RepairRetryQueue] = None
+        if config.retry_failed_repairs:
+            self.retry_queue = RepairRetryQueue(
+                api,
+                self._retry_repair,
+                config.retry_database_path,
+                config.retry_base_delay_ms,
+                config.retry_max_delay_ms,
+                config.retry_max_attempts,
+                config.retry_batch_size,
+                config.retry_concurrency,
+            )
+            self.retry_queue.start(config.retry_interval_ms)
+
+        # Fills the caches for the biggest rooms after a restart, in the background.
+        self.cache_warmer = CacheWarmer(
+            api, self._warm_room, config.warmup_rooms_per_second
+        )
+        if config.warmup_enabled:
+            self.cache_warmer.start(
+                config.warmup_rooms, config.warmup_max_rooms, config.warmup_delay_ms
+            )
+
+        # Repairs the rooms of deactivated users in one go, alongside the leaves of
+        # their rooms.
+        self.deactivation_batcher = DeactivationBatcher(
+            api,
+            self._repair_room_of_deactivated_user,
+            config.deactivation_concurrency,
+        )
+
+        # Captures the calls to check_event_allowed that are slower than a threshold.
+        self.slow_sampler: Optional[SlowInvocationSampler] = None
+        if config.slow_sampler_threshold_ms is not None:
+            self.slow_sampler = SlowInvocationSampler(
+                api,
+                self.get_room_type,
+                attr.asdict(
+                    config,
+                    filter=lambda attribute, _: attribute.name != "forbidden_domains",
+                ),
+                config.slow_sampler_threshold_ms,
+                config.slow_sampler_directory,
+                config.slow_sampler_max_samples,
+                config.slow_sampler_min_interval_ms,
+            )
+
+        self._api.register_third_party_rules_callbacks(
+            check_event_allowed=self.check_event_allowed,
+            on_new_event=self.on_new_event,
+            on_user_deactivation_status_changed=(
+                self.deactivation_batcher.on_user_deactivation_status_changed
+                if config.batch_deactivations
+                else None
+            ),
+        )
+
+    @staticmethod
+    def parse_config(config: Dict[str, Any]) -> ManageLastAdminConfig:
+        # Only pass the options that are set, so their defaults are only defined in
+        # ManageLastAdminConfig.
+        options = {
+            attribute.name: config[attribute.name]
+            for attribute in attr.fields(ManageLastAdminConfig)
+            if attribute.name in config and attribute.name != "forbidden_domains"
+        }
+
+        for name in _POSITIVE_OPTIONS:
+            value = options.get(name)
+            if value is not None and (
+                isinstance(value, bool)
+                or not isinstance(value, (int, float))
+                or value <= 0
+            ):
+                raise ConfigError(f"{name} must be a positive number", (name,))
+
+        return ManageLastAdminConfig(**options)
+
+    async def check_event_allowed(
+        self,
+        event: EventBase,
+        state_events: StateMap[EventBase],
+    ) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """Implements synapse.events.ThirdPartyEventRules.check_event_allowed.
+
+        Checks the event's type and the current rule and calls the right function to
+        determine whether the event can be allowed.
+
+        Args:
+            event: The event to check.
+            state_events: A dict mapping (event type, state key) to state event.
+                State events in the room the event originated from.
+
+        Returns:
+            True if the event should be allowed, False if it should be rejected. If the
+            event should be allowed but with some of its data replaced (or its context
+            needs to be recalculated, eg because the state of the room has changed), a
+            dictionary might be returned in addition to the boolean.
+        """
+        start = time.perf_counter()
+        outcome: str = LeaveOutcome.SEND_FAILED
+        replacement: Optional[Dict[str, Any]] = None
+        try:
+            outcome, replacement = await self._check_event(event, state_events)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.check_event_allowed_seconds.labels(outcome).observe(elapsed)
+            if self.slow_sampler is not None:
+                self.slow_sampler.maybe_sample(event, state_events, outcome, elapsed)
+
+        return True, replacement
+
+    async def _check_event(
+        self,
+        event: EventBase,
+        state_events: StateMap[EventBase],
+    ) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """Processes the event if it can make the room lose its last admin, i.e. if it's
+        a leave, a kick, a ban or a change of the room's power levels, see
+        check_event_allowed.
+
+        Returns:
+            The outcome of processing the event, see LeaveOutcome, and the event to
+            replace it with, if any.
+        """
+        if not event.is_state():
+            return LeaveOutcome.IGNORED, None
+
+        if event.type == EventTypes.PowerLevels and event.state_key == "":
+            if not self._is_responsible_server(event):
+                return LeaveOutcome.NOT_RESPONSIBLE, None
+
+            return await self._check_power_levels_change(event, state_events)
+
+        # If the event is a leave, a kick or a ban, check if the last admin is leaving
+        # the room
+        if event.type != EventTypes.Member or event.membership not in (
+            Membership.LEAVE,
+            Membership.BAN,
+        ):
+            return LeaveOutcome.IGNORED, None
+
+        if not self._is_responsible_server(event):
+            return LeaveOutcome.NOT_RESPONSIBLE, None
+
+        if self._config.repair_in_background:
+            return await self._maybe_repair_in_background(event, state_events), None
+
+        return await self._on_room_leave(event, state_events), None
+
+    def _is_responsible_server(self, event: EventBase) -> bool:
+        """Checks whether this homeserver is the one that repairs the room if the user
+        leaving it is its last admin.
+
+        Every server in the room sees the leave, but the new power levels event has to
+        be sent by the leaving admin, since they're the only user left with the power
+        to change the room's power levels, and only their own homeserver can send
+        events on their behalf. So the responsible server is the leaving user's, and
+        every other server skips the leave before doing any work, which leads to a
+        single power levels event being sent across the federation. The same goes for
+        the sender of a kick, a ban, or a change of the room's power levels.
+
+        Args:
+            event: The leave event, or the event that can make the room lose its last
+                admin.
+
+        Returns:
+            Whether this homeserver is the one repairing the room.
+        """
+        return self._api.is_mine(event.sender)
+
+    async def _maybe_repair_in_background(
+        self,
+        event: EventBase,
+        state_events: StateMap[EventBase],
+    ) -> str:
+        """Processes a leave in the background if the user leaving the room (or being
+        kicked or banned from it) is one of its admins, and allows the leaves of other
+        users right away.
+
+        The new power levels event is sent on behalf of the leaving admin, and once
+        their leave is persisted, nobody left in the room is allowed to send it, since
+        only an admin can promote other users to admins. So the leave waits for the
+        background repair to be done. A repair that can't start right away, because
+        repair_concurrency repairs are already running, is done inline instead.
+
+        Args:
+            event: The leave event.
+            state_events: The current state of the room.
+
+        Returns:
+            The outcome of processing the leave, see LeaveOutcome.
+        """
+        power_levels = _get_power_levels_view(state_events)
+        if power_levels is None:
+            return LeaveOutcome.IGNORED
+
+        if event.state_key not in power_levels.admins:
+            return LeaveOutcome.NOT_LAST_ADMIN
+
+        repair = self._background_repairs.try_run((event, state_events))
+        if repair is not None:
+            return await make_deferred_yieldable(repair)
+
+        logger.debug(
+            "%d repairs running in the background, repairing room %s inline",
+            len(self._background_repairs),
+            event.room_id,
+        )
+        metrics.inline_repairs.inc()
+        return await self._on_room_leave(event, state_events)
+
+    async def on_new_event(
+        self,
+        event: EventBase,
+        state_events: StateMap[EventBase],
+    ) -> None:
+        """Implements synapse.events.ThirdPartyEventRules.on_new_event.
+
+        Keeps the admin index of the event's room up to date with membership and power
+        levels changes. Rooms we don't have an index for are ignored: their index will be
+        built from the room's state the next time it's needed.
+
+        Args:
+            event: The event that was just persisted.
+            state_events: The current state of the room the event was sent into.
+        """
+        if not event.is_state():
+            return
+
+        if event.type == EventTypes.PowerLevels and event.state_key == "":
+            self._prepare_vectorized_selection(_get_power_levels_view_for_event(event))
+
+        index = self._room_admin_indexes.get(event.room_id)
+        if index is None:
+            return
+
+        if event.type == EventTypes.Member:
+            index.set_membership(event.state_key, event.membership)
+        elif event.type == EventTypes.PowerLevels and event.state_key == "":
+            index.update_power_levels(
+                _get_power_levels_view_for_event(event), state_events
+            )
+
+    def _prepare_vectorized_selection(
+        self, power_levels: Optional[PowerLevelsView]
+    ) -> None:
+        """Builds the NumPy arrays for a power levels event if candidates will be
+        selected with them, so the cost of building them isn't paid when the last admin
+        leaves the room.
+
+        Args:
+            power_levels: The view of the power levels event, if it's valid.
+        """
+        if not self._config.promote_moderators or power_levels is None:
+            return
+
+        engine = self._get_vectorized_engine(len(power_levels.users))
+        if engine is not None:
+            engine.get_arrays(power_levels)
+
+    async def _warm_room(self, room_id: str) -> None:
+        """Fills the module's caches for the given room, as if one of its members had
+        left it: the view of its power levels, its type, its admin index, and the NumPy
+        arrays for its power levels if they're needed.
+
+        Args:
+            room_id: The room to warm caches up for.
+        """
+        if self._room_admin_indexes.get(room_id) is not None:
+            # A leave got there first.
+            return
+
+        state_events = await self._get_admin_state(room_id)
+        power_levels = _get_power_levels_view(state_events)
+        if power_levels is None:
+            return
+
+        snapshot = self._build_snapshot(room_id, state_events)
+        self._room_admin_indexes.set(room_id, _RoomAdminIndex.from_snapshot(snapshot))
+        self._prepare_vectorized_selection(power_levels)
+
+    def _get_room_admin_index(
+        self,
+        room_id: str,
+        power_levels: PowerLevelsView,
+        state_events: StateMap[EventBase],
+    ) -> Optional["_RoomAdminIndex"]:
+        """Returns the admin index for the given room, making sure it's using the
+        provided power levels.
+
+        Args:
+            room_id: The room to get the index of.
+            power_levels: The view of the power levels event that's currently in the
+                room's state.
+            state_events: The current state of the room.
+
+        Returns:
+            The room's admin index, or None if we don't have one for this room.
+        """
+        index = self._room_admin_indexes.get(room_id)
+        if index is None:
+            return None
+
+        if power_levels.event_id != index.power_levels_event_id:
+            index.update_power_levels(power_levels, state_events)
+
+        return index
+
+    async def _check_power_levels_change(
+        self,
+        event: EventBase,
+        state_events: StateMap[EventBase],
+    ) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """Checks whether a new power levels event makes the room lose its last admin,
+        and if so replaces it with one that also repairs the room.
+
+        Only an admin can change the level of another admin, so the room can only lose
+        its last admin if the sender of the event gives up their own admin level. If
+        admin is the default level, every member is an admin, and any of them can lower
+        it. The old and new power levels are compared without looking at the rest of
+        the room's state, so ordinary changes only cost a lookup of the sender's level,
+        and the membership of the users whose admin level changed is only looked up if
+        the sender demotes themselves.
+
+        The new power levels event can't be sent separately, as it would conflict with
+        the one being checked, so the checked event is replaced with one that both
+        makes the sender's change and repairs the room.
+
+        Args:
+            event: The new power levels event.
+            state_events: The current state of the room.
+
+        Returns:
+            The outcome of processing the event, see LeaveOutcome, and the event to
+            replace it with, if any.
+        """
+        old_event = state_events.get((EventTypes.PowerLevels, ""))
+        if old_event is None:
+            return LeaveOutcome.IGNORED, None
+
+        old_power_levels = _get_power_levels_view_with_users(old_event)
+        new_power_levels = _get_power_levels_view_with_users(event)
+        if old_power_levels is None or new_power_levels is None:
+            return LeaveOutcome.IGNORED, None
+
+        old_level = old_power_levels.content["users"].get(
+            event.sender, old_power_levels.users_default
+        )
+        if (
+            not isinstance(old_level, int)
+            or old_level < 100
+            or event.sender in new_power_levels.admins
+            or new_power_levels.users_default >= 100
+        ):
+            return LeaveOutcome.NOT_LAST_ADMIN, None
+
+        with _stage("detect_last_admin"):
+            index = self._get_room_admin_index(
+                event.room_id, old_power_levels, state_events
+            )
+            if index is None:
+                index = _RoomAdminIndex.from_snapshot(
+                    self._build_snapshot(
+                        event.room_id, state_events, power_levels=old_power_levels
+                    )
+                )
+                self._room_admin_indexes.set(event.room_id, index)
+
+            # The index only knows about the admins listed in the power levels, which is
+            # enough to tell whether one of them is still in the room.
+            lost_admins = old_power_levels.admins - new_power_levels.admins
+            if not index.loses_last_admin(
+                lost_admins, new_power_levels.admins, state_events
+            ):
+                self._report_state_entries_touched(event, 1 + index.lookups)
+                return LeaveOutcome.NOT_LAST_ADMIN, None
+
+            # Check against the room's state with the new power levels before doing
+            # anything, in case the index missed an admin joining the room.
+            snapshot = self._build_snapshot(
+                event.room_id, state_events, power_levels=new_power_levels
+            )
+            self._report_state_entries_touched(event, snapshot.entries_scanned)
+            if _has_admin(snapshot):
+                self._room_admin_indexes.set(
+                    event.room_id,
+                    _RoomAdminIndex.from_snapshot(
+                        self._build_snapshot(
+                            event.room_id, state_events, power_levels=old_power_levels
+                        )
+                    ),
+                )
+                return LeaveOutcome.NOT_LAST_ADMIN, None
+
+        logger.info(
+            "%s is giving up the last admin level of room %s",
+            event.sender,
+            event.room_id,
+        )
+        plan = await self._plan_repair(
+            event.room_id, snapshot, leaving_user=event.sender, admin_level=old_level
+        )
+        if plan is None:
+            return LeaveOutcome.NOT_LAST_ADMIN, None
+
+        outcome = (
+            LeaveOutcome.PROMOTED
+            if plan.strategy == "promote"
+            else LeaveOutcome.DEFAULT_TO_ADMIN
+        )
+        with _stage("send_power_levels"):
+            set_tag(TracingTags.STRATEGY, plan.strategy)
+            set_tag(TracingTags.CANDIDATES, len(plan.promoted_users))
+            if self._config.dry_run:
+                logger.info(
+                    "Dry run: not replacing power levels event %s in room %s"
+                    " (strategy: %s, promoted users: %s)",
+                    event.event_id,
+                    event.room_id,
+                    plan.strategy,
+                    ", ".join(plan.promoted_users),
+                )
+                metrics.dry_run_power_levels_events.labels(plan.strategy).inc()
+                return outcome, None
+
+        # Synapse may still reject the replacement, so it isn't counted as sent.
+        metrics.power_levels_events_replaced.labels(plan.strategy).inc()
+        return outcome, {**event.get_dict(), "content": plan.content}
+
+    async def _on_room_leave(
+        self,
+        event: EventBase,
+        state_events: StateMap[EventBase],
+    ) -> str:
+        """Processes a leave in its own opentracing span, see _handle_room_leave.
+
+        Args:
+            event: The event to check.
+            state_events: The current state of the room.
+
+        Returns:
+            The outcome of processing the leave, see LeaveOutcome.
+        """
+        with start_active_span("manage_last_admin.on_room_leave"):
+            set_tag(TracingTags.ROOM_SIZE, len(state_events))
+            outcome = await self._handle_room_leave(event, state_events)
+            set_tag(TracingTags.OUTCOME, outcome)
+            return outcome
+
+    async def _handle_room_leave(
+        self,
+        event: EventBase,
+        state_events: StateMap[EventBase],
+    ) -> str:
+        """React to a m.room.member event with a "leave" membership.
+
+        Checks if the user leaving the room is the last admin in the room. If so, checks
+        if there are users with lower but non-default power levels that can be promoted
+        to admins. If so, promotes them to admin if the configuration allows it,
+        otherwise change admin rule of the room.
+
+        Repairs of the same room are serialized, and a repair that closely follows
+        another one of the same room is checked again against the latest state of the
+        room, so concurrent leaves only cause one new power levels event.
+
+        Args:
+            event: The event to check.
+            state_events: The current state of the room.
+
+        Returns:
+            The outcome of processing the leave, see LeaveOutcome.
+        """
+        # Check if the last admin is leaving the room.
+        snapshot = self._check_last_admin_leaving(event, state_events)
+        if snapshot is None:
+            return LeaveOutcome.NOT_LAST_ADMIN
+
+        async with self._repair_linearizer.queue(event.room_id):
+            last_repair = self._last_repairs.get(event.room_id)
+            if (
+                last_repair is not None
+                and time.monotonic() - last_repair
+                < self._config.repair_coalescing_window_ms / 1000
+            ):
+                # The room was repaired just before, and the state we were given might
+                # predate it, so check again with the latest state.
+                state_events = await self._get_admin_state(event.room_id)
+                snapshot = self._check_last_admin_leaving(event, state_events)
+                if snapshot is None:
+                    self.coalesced_repairs += 1
+                    logger.info(
+                        "Room %s was already repaired, ignoring leave %s",
+                        event.room_id,
+                        event.event_id,
+                    )
+                    return LeaveOutcome.COALESCED
+
+            try:
+                outcome = await self._repair_room(event, snapshot)
+            except Exception as e:
+                await self._schedule_retry(event, str(e))
+                raise
+
+            self._last_repairs.set(event.room_id, time.monotonic())
+            return outcome
+
+    async def _schedule_retry(self, event: EventBase, error: str) -> None:
+        """Stores a failed repair to retry it later, if configured to. The leave that
+        triggered the repair is then rejected, see _repair_room.
+
+        Args:
+            event: The leave event that triggered the repair.
+            error: Why the repair failed.
+        """
+        if self.retry_queue is None:
+            return
+
+        try:
+            await self.retry_queue.schedule(event, error)
+        except Exception:
+            logger.exception("Failed to store repair of room %s", event.room_id)
+
+    async def _retry_repair(self, event: EventBase) -> str:
+        """Retries a failed repair, from the room's current state.
+
+        The new power levels event can only be sent on behalf of the admin whose leave
+        triggered the repair, and only while they're still in the room. Their leave is
+        rejected when the repair fails, so they usually are, unless they were made to
+        leave it some other way since, e.g. by the deactivation of their account. In
+        that case the room can't be repaired by the module, and is left for the sweeper
+        to report.
+
+        Args:
+            event: The leave event that triggered the repair.
+
+        Returns:
+            Why there's nothing left to retry, see RetryResult.
+        """
+        async with self._repair_linearizer.queue(event.room_id):
+            state_events = await self._get_admin_state(event.room_id)
+            snapshot = self._check_last_admin_leaving(event, state_events)
+            if snapshot is None:
+                logger.info("Room %s doesn't need repairing anymore", event.room_id)
+                return RetryResult.NOT_NEEDED
+
+            if snapshot.get_membership(event.sender) != Membership.JOIN:
+                logger.warning(
+                    "Can't repair room %s: %s isn't in the room anymore",
+                    event.room_id,
+                    event.sender,
+                )
+                return RetryResult.UNREPAIRABLE
+
+            # Raises if the new power levels event can't be sent.
+            outcome = await self._repair_room(event, snapshot)
+            if outcome == LeaveOutcome.NOT_LAST_ADMIN:
+                # There's no way to repair the room with the current configuration.
+                return RetryResult.UNREPAIRABLE
+
+            self._last_repairs.set(event.room_id, time.monotonic())
+            return RetryResult.REPAIRED
+
+    async def _repair_room_of_deactivated_user(
+        self, room_id: str, user_id: str, room_version: RoomVersion
+    ) -> str:
+        """Repairs a room ahead of the leave of a deactivated user, if they're its last
+        admin, from the room's current state.
+
+        The repair is done on behalf of the user, so it only happens if they're still in
+        the room. If they've already left it, their leave took care of the room.
+
+        Args:
+            room_id: The room to repair.
+            user_id: The deactivated user.
+            room_version: The version of the room.
+
+        Returns:
+            The outcome of the repair, see LeaveOutcome.
+        """
+        # The leave the deactivation is about to cause, which the repair is done for.
+        event = make_event_from_dict(
+            {
+                "room_id": room_id,
+                "sender": user_id,
+                "type": EventTypes.Member,
+                "state_key": user_id,
+                "content": {"membership": Membership.LEAVE},
+                **_maybe_get_event_id_dict_for_room_version(
+                    room_version, self._api.server_name
+                ),
+            },
+            room_version,
+        )
+
+        try:
+            async with self._repair_linearizer.queue(room_id):
+                state_events = await self._get_admin_state(room_id)
+                snapshot = self._check_last_admin_leaving(event, state_events)
+                if (
+                    snapshot is None
+                    or snapshot.get_membership(user_id) != Membership.JOIN
+                ):
+                    return LeaveOutcome.NOT_LAST_ADMIN
+
+                outcome = await self._repair_room(event, snapshot)
+                self._last_repairs.set(room_id, time.monotonic())
+        except Exception as e:
+            logger.exception(
+                "Failed to repair room %s for deactivated user %s", room_id, user_id
+            )
+            await self._schedule_retry(event, str(e))
+            return LeaveOutcome.SEND_FAILED
+
+        return outcome
+
+    def _check_last_admin_leaving(
+        self,
+        event: EventBase,
+        state_events: StateMap[EventBase],
+    ) -> Optional["RoomSnapshot"]:
+        """Checks if the user leaving the room is the last admin in the room.
+
+        Args:
+            event: The leave event to check.
+            state_events: The current state of the room.
+
+        Returns:
+            A snapshot of the room's state if the last admin is leaving the room, None
+            otherwise.
+        """
+        with _stage("get_power_levels"):
+            power_levels = _get_power_levels_view(state_events)
+        if power_levels is None:
+            return None
+
+        with _stage("detect_last_admin"):
+            return self._detect_last_admin_leaving(event, state_events, power_levels)
+
+    def _detect_last_admin_leaving(
+        self,
+        event: EventBase,
+        state_events: StateMap[EventBase],
+        power_levels: PowerLevelsView,
+    ) -> Optional["RoomSnapshot"]:
+        """Checks if the user leaving the room is the last admin in the room, see
+        _check_last_admin_leaving.
+
+        Args:
+            event: The leave event to check.
+            state_events: The current state of the room.
+            power_levels: The view of the room's power levels.
+
+        Returns:
+            A snapshot of the room's state if the last admin is leaving the room, None
+            otherwise.
+        """
+        # Ask the room's admin index first, it only needs to look up the membership of
+        # the other admins of the room. If we don't have an index for this room yet,
+        # build it from a snapshot of the room's state.
+        snapshot: Optional[RoomSnapshot] = None
+        index = self._get_room_admin_index(event.room_id, power_levels, state_events)
+        if index is None:
+            snapshot = self._build_snapshot(event.room_id, state_events)
+            index = _RoomAdminIndex.from_snapshot(snapshot)
+            self._room_admin_indexes.set(event.room_id, index)
+
+        if not index.is_last_admin_leaving(event.state_key, state_events):
+            self._report_state_entries_touched(
+                event,
+                1 + index.lookups if snapshot is None else snapshot.entries_scanned,
+            )
+            return None
+
+        # The index might have missed an admin joining the room, so check against the
+        # room's state before doing anything, and rebuild the index if they disagree.
+        if snapshot is None:
+            snapshot = self._build_snapshot(event.room_id, state_events)
+        self._report_state_entries_touched(event, snapshot.entries_scanned)
+
+        last_admin_leaving = _is_last_admin_leaving(event, snapshot)
+        if not last_admin_leaving:
+            logger.debug(
+                "Admin index of room %s is out of date, rebuilding it", event.room_id
+            )
+            self._room_admin_indexes.set(
+                event.room_id, _RoomAdminIndex.from_snapshot(snapshot)
+            )
+            return None
+
+        return snapshot
+
+    def get_room_type(self, room_id: str, state_events: StateMap[EventBase]) -> str:
+        """Returns the type of the given room, see RoomType.
+
+        The type of a room only depends on its m.room.encryption and
+        im.vector.room.access_rules events, so it's cached for each room until one of
+        these events changes.
+
+        Args:
+            room_id: The room to get the type of.
+            state_events: The current state of the room.
+
+        Returns:
+            The type of the room.
+        """
+        return self._room_types.get(room_id, state_events)
+
+    def _build_snapshot(
+        self,
+        room_id: str,
+        state_events: StateMap[EventBase],
+        power_levels: Optional[PowerLevelsView] = None,
+    ) -> "RoomSnapshot":
+        """Builds a snapshot of the room's admins from the room's state, using the
+        cached type of the room. See RoomSnapshot.from_lookups.
+        """
+        return RoomSnapshot.from_lookups(
+            state_events,
+            room_type=self.get_room_type(room_id, state_events),
+            power_levels=power_levels,
+        )
+
+    async def _get_admin_state(self, room_id: str) -> StateMap[EventBase]:
+        """Fetches the parts of the room's current state needed to tell whether a user
+        is its last admin: its power levels, the events its type depends on, and the
+        membership of the users listed in its power levels.
+
+        Args:
+            room_id: The room to get the state of.
+
+        Returns:
+            The requested state events.
+        """
+        state_events = await self._api.get_room_state(
+            room_id,
+            [
+                (EventTypes.PowerLevels, ""),
+                (EventTypes.RoomEncryption, ""),
+                (ACCESS_RULES_TYPE, ""),
+            ],
+        )
+        power_levels = _get_power_levels_view(state_events)
+        if power_levels is None or not power_levels.users:
+            return state_events
+
+        member_events = await self._api.get_room_state(
+            room_id,
+            [(EventTypes.Member, user_id) for user_id in power_levels.users],
+        )
+        return {**state_events, **member_events}
+
+    async def _load_members(self, room_id: str, snapshot: "RoomSnapshot") -> None:
+        """Adds every member of the room to the snapshot, if it doesn't already include
+        them. Only the room's membership events are fetched.
+
+        Args:
+            room_id: The room the snapshot is of.
+            snapshot: The snapshot to complete.
+        """
+        if snapshot.has_all_members:
+            return
+
+        member_events = await self._api.get_room_state(
+            room_id, [(EventTypes.Member, None)]
+        )
+        with _stage("build_room_snapshot"):
+            await self._compute(
+                len(member_events),
+                "build_room_snapshot",
+                lambda: snapshot.set_members(member_events),
+            )
+
+    async def _is_room_orphaned(self, room_id: str) -> bool:
+        """Checks whether the given room has no admin left in it.
+
+        Only the power levels of the room and the membership of its admins are read
+        from the room's state, rather than the whole state.
+
+        Args:
+            room_id: The room to check.
+
+        Returns:
+            Whether the room has power levels, but none of its admins is joined to or
+            invited in it.
+        """
+        state_events = await self._api.get_room_state(
+            room_id, [(EventTypes.PowerLevels, "")]
+        )
+        power_levels = _get_power_levels_view(state_events)
+        if power_levels is None:
+            return False
+
+        if power_levels.admins:
+            state_events = await self._api.get_room_state(
+                room_id,
+                [(EventTypes.PowerLevels, "")]
+                + [(EventTypes.Member, user_id) for user_id in power_levels.admins],
+            )
+
+        return _is_room_without_admin(RoomSnapshot.from_state(state_events))
+
+    async def _repair_room(self, event: EventBase, snapshot: "RoomSnapshot") -> str:
+        """Makes sure the room still has an admin after its last admin leaves it.
+
+        If the new power levels event can't be sent, the error is raised, which rejects
+        the leave, when admin is made the default level or when failed repairs are
+        retried. Otherwise the leave goes through, with the room left without admin.
+
+        Args:
+            event: The leave, kick or ban of the last admin. The new power levels event
+                is sent on behalf of its sender.
+            snapshot: The snapshot of the room's state.
+
+        Returns:
+            The outcome of the repair, see LeaveOutcome.
+        """
+        assert snapshot.power_levels is not None
+        plan = await self._plan_repair(
+            event.room_id,
+            snapshot,
+            leaving_user=event.state_key,
+            admin_level=snapshot.power_levels.content["users"][event.state_key],
+        )
+        if plan is None:
+            return LeaveOutcome.NOT_LAST_ADMIN
+
+        if plan.strategy == "default_to_admin":
+            await self._send_power_levels(event, plan.content, plan.strategy)
+            return LeaveOutcome.DEFAULT_TO_ADMIN
+
+        try:
+            await self._send_power_levels(
+                event, plan.content, plan.strategy, plan.promoted_users
+            )
+        except Exception as e:  # Catch all other exceptions
+            if self.retry_queue is not None:
+                # Fail the leave, so the admin is still in the room, and can send the
+                # new power levels event, when the repair is retried.
+                raise
+            # Generic handling if you don't know the exact type of the exception
+            # if users_to_promote list if very very large, we might reach the event size limit of 65kb
+            # see : https://spec.matrix.org/v1.12/client-server-api/#size-limits
+            logger.info("Cannot send promote event : %s", e)
+            return LeaveOutcome.SEND_FAILED
+
+        if not self._config.dry_run:
+            metrics.promoted_users.inc(len(plan.promoted_users))
+        return LeaveOutcome.PROMOTED
+
+    async def _plan_repair(
+        self,
+        room_id: str,
+        snapshot: "RoomSnapshot",
+        leaving_user: str,
+        admin_level: int,
+    ) -> Optional["_RepairPlan"]:
+        """Works out the new power levels event that makes sure the room still has an
+        admin once its last admin is gone.
+
+        Args:
+            room_id: The room to repair.
+            snapshot: The snapshot of the room's state, with the power levels to build
+                the new ones from.
+            leaving_user: The last admin, who is leaving the room or giving up their
+                admin level, and mustn't be picked as a new admin.
+            admin_level: The level to promote users to.
+
+        Returns:
+            The new power levels event, or None if the room can't be repaired.
+        """
+        assert snapshot.power_levels is not None
+        pl_content = snapshot.power_levels.content
+
+        # Search for users to promote if the configuration allows it.
+        if self._config.promote_moderators:
+            # Look for users to promote.
+            power_levels = snapshot.power_levels
+            engine = self._get_vectorized_engine(len(power_levels.users))
+            with _stage("select_candidates"):
+                if engine is not None:
+                    # The arrays are cached, so get them before going to a thread.
+                    arrays = engine.get_arrays(power_levels)
+                    users_to_promote, allowed_users = await self._compute(
+                        len(power_levels.users),
+                        "select_candidates",
+                        lambda: vectorized.select_users_with_highest_nondefault_pl(
+                            arrays,
+                            power_levels.users_default,
+                            snapshot.memberships,
+                            leaving_user,
+                        ),
+                    )
+                else:
+                    users_to_promote = await self._compute(
+                        len(power_levels.users),
+                        "select_candidates",
+                        lambda: _get_users_with_highest_nondefault_pl(
+                            snapshot, ignore_user=leaving_user
+                        ),
+                    )
+                set_tag(TracingTags.CANDIDATES, len(users_to_promote))
+
+            # If we found users to promote, update the power levels event in the room's
+            # state.
+            if users_to_promote:
+                # avoid external users to be promoted
+                if engine is not None:
+                    users_to_promote = allowed_users
+                else:
+                    users_to_promote = await self._filter_candidates(users_to_promote)
+
+                logger.info(
+                    "Promoting users to admins in room %s: %s",
+                    room_id,
+                    users_to_promote,
+                )
+                return await self._plan_promotion(
+                    room_id, users_to_promote, pl_content, admin_level
+                )
+
+        room_type = snapshot.room_type
+        if _is_room_public_or_private(snapshot):
+            # We make sure to change default permission only on public or private rooms
+            # If not, we set the default power level as admin
+            logger.info("Make admin as default level in room %s", room_id)
+            return await self._plan_default_to_admin(pl_content)
+        elif room_type in [RoomType.UNKNOWN, RoomType.EXTERNAL]:
+            # In case of External or Unknown Room
+            # promote all users with default power levels except external users
+            # This is the only strategy that needs the whole member list.
+            await self._load_members(room_id, snapshot)
+            with _stage("select_candidates"):
+                users_to_promote = await self._compute(
+                    len(snapshot.joined),
+                    "select_candidates",
+                    lambda: _get_users_with_default_pl(snapshot),
+                )
+                set_tag(TracingTags.CANDIDATES, len(users_to_promote))
+
+            # avoid external users to be promoted
+            users_to_promote = await self._filter_candidates(users_to_promote)
+
+            logger.info(
+                "Make admin all non-external default power level users room %s: %s",
+                room_id,
+                ", ".join(users_to_promote),
+            )
+            return await self._plan_promotion(
+                room_id, users_to_promote, pl_content, admin_level
+            )
+
+        return None
+
+    async def _filter_candidates(self, users: List[str]) -> List[str]:
+        """Leaves out the users from forbidden domains from the users to promote.
+
+        Args:
+            users: The users to promote.
+
+        Returns:
+            The users which aren't from a forbidden domain.
+        """
+        with _stage("filter_domains"):
+            users = await self._compute(
+                len(users),
+                "filter_domains",
+                lambda: _filter_out_users_from_forbidden_domain(
+                    users, self._config.forbidden_domains
+                ),
+            )
+            set_tag(TracingTags.CANDIDATES, len(users))
+            return users
+
+    async def _compute(self, size: int, stage: str, f: Callable[[], T]) -> T:
+        """Runs a pure computation of the processing of a leave. Computations going
+        through at least offload_threshold state entries or users are run in Synapse's
+        thread pool rather than on the reactor, so they don't hold up other requests.
+
+        Args:
+            size: How many state entries or users the computation goes through.
+            stage: The stage of the processing the computation is part of.
+            f: The computation. It mustn't use the module's caches, which aren't
+                thread-safe.
+
+        Returns:
+            The result of the computation.
+        """
+        threshold = self._config.offload_threshold
+        if threshold is None or size < threshold:
+            return f()
+
+        def run() -> T:
+            start = time.perf_counter()
+            try:
+                return f()
+            finally:
+                metrics.offloaded_seconds.labels(stage).observe(
+                    time.perf_counter() - start
+                )
+
+        return await self._api.defer_to_thread(run)
+
+    def _get_vectorized_engine(
+        self, users: int
+    ) -> Optional[vectorized.VectorizedEngine]:
+        """Returns the NumPy engine if candidates should be selected with it, i.e. if
+        NumPy is installed and there are enough users to look at for it to pay off.
+
+        Args:
+            users: The number of users to look at.
+        """
+        threshold = self._config.vectorized_threshold
+        if self._vectorized is None or threshold is None or users < threshold:
+            return None
+        return self._vectorized
+
+    def _report_state_entries_touched(self, event: EventBase, entries: int) -> None:
+        """Reports how many entries of the room's state were looked at to process the
+        given leave event.
+        """
+        logger.debug(
+            "Processing leave %s in room %s touched %d state entries",
+            event.event_id,
+            event.room_id,
+            entries,
+        )
+        metrics.state_entries_scanned.observe(entries)
+
+    async def _plan_default_to_admin(self, pl_content: Dict[str, Any]) -> "_RepairPlan":
+        """Plans a new power levels event making admin the default level.
+
+        Args:
+            pl_content: The content of the power levels event to build the new one from.
+
+        Returns:
+            The new power levels event.
+        """
+        power_levels_content = await self._compute(
+            len(pl_content["users"]),
+            "build_power_levels",
+            lambda: _build_default_to_admin_content(pl_content),
+        )
+        return _RepairPlan("default_to_admin", power_levels_content)
+
+    async def _plan_promotion(
+        self,
+        room_id: str,
+        users_to_promote: Iterable[str],
+        pl_content: Dict[str, Any],
+        admin_level: int,
+    ) -> "_RepairPlan":
+        """Plans a new power levels event promoting a given list of users to admins.
+
+        Args:
+            room_id: The room to repair.
+            users_to_promote: The users to promote.
+            pl_content: The content of the power levels event to build the new one from.
+            admin_level: The level to promote users to.
+
+        Returns:
+            The new power levels event. It makes admin the default level instead if
+            promoting the users would make it too big.
+        """
+        candidates = list(users_to_promote)
+
+        planned = await self._compute(
+            len(pl_content["users"]) + len(candidates),
+            "build_power_levels",
+            lambda: _build_promotion_content(pl_content, candidates, admin_level),
+        )
+        if planned is None:
+            logger.warning(
+                "Power levels event in room %s is too big to promote anyone, making"
+                " admin the default level instead",
+                room_id,
+            )
+            return await self._plan_default_to_admin(pl_content)
+
+        planned_users, new_pl_content = planned
+        return _RepairPlan("promote", new_pl_content, planned_users)
+
+    async def _send_power_levels(
+        self,
+        event: EventBase,
+        content: Dict[str, Any],
+        strategy: str,
+        promoted_users: Collection[str] = (),
+    ) -> None:
+        """Sends a new power levels event into the room, on behalf of the admin leaving
+        it. In dry run mode, only logs the event that would have been sent.
+
+        Args:
+            event: The leave event of the last admin.
+            content: The content of the new power levels event.
+            strategy: How the room is repaired, "promote" or "default_to_admin".
+            promoted_users: The users promoted to admins by the new event, if any.
+        """
+        with _stage("send_power_levels"):
+            set_tag(TracingTags.STRATEGY, strategy)
+            set_tag(TracingTags.CANDIDATES, len(promoted_users))
+            if self._config.dry_run:
+                logger.info(
+                    "Dry run: not sending power levels event of %d bytes into room %s"
+                    " (strategy: %s, promoted users: %s)",
+                    len(encode_canonical_json(content)),
+                    event.room_id,
+                    strategy,
+                    ", ".join(promoted_users),
+                )
+                metrics.dry_run_power_levels_events.labels(strategy).inc()
+                return
+
+            await self._api.create_and_send_event_into_room(
+                {
+                    "room_id": event.room_id,
+                    "sender": event.sender,
+                    "type": EventTypes.PowerLevels,
+                    "content": content,
+                    "state_key": "",
+                    **_maybe_get_event_id_dict_for_room_version(
+                        event.room_version, self._api.server_name
+                    ),
+                }
+            )
+
+        _report_power_levels_event_sent(strategy, content)
+
+
+def _build_default_to_admin_content(pl_content: Dict[str, Any]) -> Dict[str, Any]:
+    """Builds the content of a power levels event making admin the default level.
+
+    Args:
+        pl_content: The content of the m.room.power_levels event that's currently in the
+            room state.
+
+    Returns:
+        The content of the new power levels event.
+    """
+    # Build the new content without editing the content of the event that's
+    # currently in the room's state.
+    builder = _PowerLevelsContentBuilder(pl_content)
+    # Send a new power levels event with a similar content to the previous one
+    # except users_default is 100 to allow any user to be admin of the room.
+    builder.set("users_default", 100)
+    # Just to be safe, also delete all users that don't have a power level of
+    # 100, in order to prevent anyone from being unable to be admin the room.
+    # Julien : I am not why it's needed
+    users = {}
+    for user, level in pl_content["users"].items():
+        if level == 100:
+            users[user] = level
+    builder.set_users(users)
+    return builder.build()
+
+
+def _build_promotion_content(
+    pl_content: Dict[str, Any], users_to_promote: List[str], admin_level: int
+) -> Optional[Tuple[List[str], Dict[str, Any]]]:
+    """Builds the content of a power levels event promoting the given users.
+
+    Args:
+        pl_content: The content of the m.room.power_levels event that's currently in the
+            room state.
+        users_to_promote: The users to promote.
+        admin_level: The power level to promote them to.
+
+    Returns:
+        The users that could be promoted and the content of the new power levels event,
+        or None if the content is too big to promote anyone.
+    """
+    # Make sure the new power levels event won't be too big to be sent, and only
+    # promote as many users as we can fit into it.
+    planned_users = _plan_promotion(
+        pl_content,
+        users_to_promote,
+        admin_level,
+        MAX_EVENT_SIZE - EVENT_SIZE_HEADROOM,
+    )
+    if planned_users is None:
+        return None
+
+    # Build the new content without editing the "users" dict from the event that's
+    # currently in the room's state.
+    builder = _PowerLevelsContentBuilder(pl_content)
+    for user in planned_users:
+        builder.set_user_level(user, admin_level)
+    return planned_users, builder.build()
+
+
+@contextmanager
+def _stage(name: str) -> Iterator[None]:
+    """Runs a stage of the processing of a leave in its own opentracing span, and
+    reports how long it took to the module's metrics.
+
+    Args:
+        name: The name of the stage.
+    """
+    start = time.perf_counter()
+    try:
+        with start_active_span(f"manage_last_admin.{name}"):
+            yield
+    finally:
+        metrics.stage_seconds.labels(name).observe(time.perf_counter() - start)
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class _RepairPlan:
+    """A new power levels event making sure a room still has an admin."""
+
+    # How the room is repaired, "promote" or "default_to_admin".
+    strategy: str
+    # The content of the new power levels event.
+    content: Dict[str, Any]
+    # The users promoted to admins by the new event, if any.
+    promoted_users: Sequence[str] = ()
+
+
+def _report_power_levels_event_sent(strategy: str, content: Dict[str, Any]) -> None:
+    """Reports a new power levels event to the module's metrics.
+
+    Args:
+        strategy: How the room was repaired, "promote" or "default_to_admin".
+        content: The content of the power levels event.
+    """
+    metrics.power_levels_events_sent.labels(strategy).inc()
+    metrics.power_levels_event_size_bytes.observe(len(encode_canonical_json(content)))
+
+
+class _PowerLevelsContentBuilder:
+    """Builds the content of a new power levels event from the content of the current
+    one.
+
+    Only what changes is copied: the new content shares every value it doesn't modify
+    (e.g. the "events" and "notifications" dictionaries) with the current one, and the
+    "users" dictionary is only copied the first time a user's level is changed.
+    """
+
+    def __init__(self, pl_content: Dict[str, Any]):
+        self._pl_content = pl_content
+        self._changes: Dict[str, Any] = {}
+        self._users: Optional[Dict[str, Any]] = None
+
+    def set(self, key: str, value: Any) -> None:
+        """Sets a top-level key of the new content."""
+        self._changes[key] = value
+
+    def set_users(self, users: Dict[str, Any]) -> None:
+        """Replaces the "users" dictionary of the new content."""
+        self._users = users
+
+    def set_user_level(self, user_id: str, level: int) -> None:
+        """Sets the power level of a user in the new content."""
+        if self._users is None:
+            self._users = dict(self._pl_content["users"])
+        self._users[user_id] = level
+
+    def build(self) -> Dict[str, Any]:
+        """Returns the new content."""
+        content = dict(self._pl_content)
+        content.update(self._changes)
+        if self._users is not None:
+            content["users"] = self._users
+        return content
+
+
+class _PowerLevelsContentSizeEstimator:
+    """Keeps track of the size of the content of a power levels event, once encoded in
+    canonical JSON, while users are added to or updated in its "users" dictionary.
+
+    The content is only encoded once, each change then updates the size from the size of
+    the entry it adds or modifies.
+    """
+
+    def __init__(self, pl_content: Dict[str, Any]):
+        self._users: Dict[str, Any] = pl_content["users"]
+        self._added: Set[str] = set()
+        self.size = len(encode_canonical_json(pl_content))
+        # Every entry we add is counted with the comma separating it from the previous
+        # one, which the first entry of an empty dictionary doesn't need.
+        if not self._users:
+            self.size -= 1
+
+    def cost(self, user_id: str, level: int) -> int:
+        """Returns by how much the size would change if the given user had the given
+        power level.
+        """
+        if user_id in self._added:
+            return 0
+
+        level_size = len(str(level))
+        if user_id in self._users:
+            return level_size - len(encode_canonical_json(self._users[user_id]))
+
+        # The user ID and the level, separated by a colon, and separated from the
+        # previous entry by a comma.
+        return len(encode_canonical_json(user_id)) + 1 + level_size + 1
+
+    def add(self, user_id: str, level: int) -> None:
+        """Records that the given user now has the given power level."""
+        self.size += self.cost(user_id, level)
+        if user_id not in self._users:
+            self._added.add(user_id)
+
+
+def _plan_promotion(
+    pl_content: Dict[str, Any],
+    users_to_promote: List[str],
+    level: int,
+    max_size: int,
+) -> Optional[List[str]]:
+    """Figures out which users can be promoted to the given level without the content of
+    the new power levels event exceeding the given size.
+
+    If promoting every user would make the content too big, promote as many users as
+    possible instead.
+
+    Args:
+        pl_content: The content of the m.room.power_levels event that's currently in the
+            room state.
+        users_to_promote: The users we want to promote.
+        level: The power level to promote them to.
+        max_size: The maximum size of the new content, in bytes.
+
+    Returns:
+        The users to promote, in the same order as users_to_promote, or None if the
+        content is too big to promote any of them.
+    """
+    estimator = _PowerLevelsContentSizeEstimator(pl_content)
+    costs = [estimator.cost(user_id, level) for user_id in users_to_promote]
+    if estimator.size + sum(costs) <= max_size:
+        return users_to_promote
+
+    # Promoting the users whose entries are the smallest first maximises the number of
+    # users we promote.
+    planned = set()
+    for _, user_id in sorted(zip(costs, users_to_promote)):
+        if estimator.size + estimator.cost(user_id, level) > max_size:
+            break
+        estimator.add(user_id, level)
+        planned.add(user_id)
+
+    if not planned:
+        return None
+
+    logger.warning(
+        "Only promoting %d out of %d users to keep the power levels event under %d"
+        " bytes",
+        len(planned),
+        len(users_to_promote),
+        max_size,
+    )
+    return [user_id for user_id in users_to_promote if user_id in planned]
+
+
+class _BackgroundRunner(Generic[T, R]):
+    """Processes items in the background, with a maximum number of items being
+    processed at the same time.
+
+    Items are never queued: once as many items as allowed are being processed, the
+    caller has to process the next ones itself.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        concurrency: int,
+        process: Callable[[T], Awaitable[R]],
+    ):
+        self._name = name
+        self._concurrency = max(concurrency, 1)
+        self._process = process
+        self._running = 0
 
-class RoomType:
-    DIRECT: Final = "DIRECT"
-    PUBLIC: Final = "PUBLIC"
-    PRIVATE: Final = "PRIVATE"
-    EXTERNAL: Final = "EXTERNAL"
-    UNKNOWN: Final = "UNKNOWN"
+    def __len__(self) -> int:
+        """Returns the number of items being processed."""
+        return self._running
 
+    def try_run(self, item: T) -> "Optional[defer.Deferred[R]]":
+        """Starts processing an item in the background, if we're not already
+        processing as many items as we can.
 
-ACCESS_RULES_TYPE = "im.vector.room.access_rules"
+        Returns:
+            A deferred that follows the result of processing the item, or None if it
+            isn't being processed. It doesn't follow Synapse's logcontext rules.
+        """
+        if self._running >= self._concurrency:
+            return None
+
+        self._running += 1
+        done: "defer.Deferred[R]" = defer.Deferred()
+        run_as_background_process(self._name, self._run, item, done)
+        return done
+
+    async def _run(self, item: T, done: "defer.Deferred[R]") -> None:
+        try:
+            result = await self._process(item)
+        except Exception as e:
+            with PreserveLoggingContext():
+                done.errback(e)
+        else:
+            with PreserveLoggingContext():
+                done.callback(result)
+        finally:
+            self._running -= 1
+
+
+class _LruCache(Generic[KT, VT]):
+    """A simple mapping bounded in size, which evicts the least recently used entry
+    when full.
+    """
 
+    def __init__(self, max_size: int, name: Optional[str] = None):
+        self.max_size = max_size
+        self._entries: "OrderedDict[KT, VT]" = OrderedDict()
 
-class AccessRules:
-    RESTRICTED = "restricted"
-    UNRESTRICTED = "unrestricted"
+        self.hits = 0
+        self.misses = 0
+        # Report the cache to Synapse's cache metrics if it has a name.
+        self._metric = (
+            metrics.register_module_cache(name, self) if name is not None else None
+        )
 
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: KT) -> Optional[VT]:
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            if self._metric is not None:
+                self._metric.inc_misses()
+            return None
+
+        self.hits += 1
+        if self._metric is not None:
+            self._metric.inc_hits()
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: KT, value: VT) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            if self._metric is not None:
+                self._metric.inc_evictions(EvictionReason.size)
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class _RoomTypeCacheEntry:
+    # The IDs of the events the room's type was worked out from.
+    encryption_event_id: Optional[str]
+    access_rules_event_id: Optional[str]
+    room_type: str
+
+
+class _RoomTypeCache:
+    """Caches the type of rooms, see RoomType.
+
+    Entries are keyed by the IDs of the room's m.room.encryption and
+    im.vector.room.access_rules events, so they're invalidated as soon as either event
+    changes.
+    """
 
-@attr.s(auto_attribs=True, frozen=True)
-class ManageLastAdminConfig:
-    promote_moderators: bool = False
-    domains_forbidden_when_restricted: List[str] = []
+    def __init__(self, max_size: int):
+        self._entries: _LruCache[str, _RoomTypeCacheEntry] = _LruCache(
+            max_size, name="room_types"
+        )
 
+    def get(self, room_id: str, state_events: StateMap[EventBase]) -> str:
+        """Returns the type of the given room, working it out if it isn't cached or if
+        the events it depends on changed.
 
-class ManageLastAdmin:
-    def __init__(self, config: ManageLastAdminConfig, api: ModuleApi):
-        self._api = api
-        self._config = config
+        Args:
+            room_id: The room to get the type of.
+            state_events: The current state of the room.
 
-        self._api.register_third_party_rules_callbacks(
-            check_event_allowed=self.check_event_allowed
+        Returns:
+            The type of the room.
+        """
+        encryption_event = state_events.get((EventTypes.RoomEncryption, ""))
+        access_rules_event = state_events.get((ACCESS_RULES_TYPE, ""))
+        encryption_event_id = (
+            encryption_event.event_id if encryption_event is not None else None
+        )
+        access_rules_event_id = (
+            access_rules_event.event_id if access_rules_event is not None else None
         )
 
-    @staticmethod
-    def parse_config(config: Dict[str, Any]) -> ManageLastAdminConfig:
-        return ManageLastAdminConfig(
-            config.get("promote_moderators", False),
-            config.get("domains_forbidden_when_restricted", [])
+        entry = self._entries.get(room_id)
+        if (
+            entry is not None
+            and entry.encryption_event_id == encryption_event_id
+            and entry.access_rules_event_id == access_rules_event_id
+        ):
+            return entry.room_type
+
+        room_type = _classify_room(
+            encryption_event is not None,
+            access_rules_event.content.get("rule")
+            if access_rules_event is not None
+            else None,
         )
+        self._entries.set(
+            room_id,
+            _RoomTypeCacheEntry(encryption_event_id, access_rules_event_id, room_type),
+        )
+        return room_type
 
-    async def check_event_allowed(
+
+class _RoomAdminIndex:
+    """Tracks the admins of a room, and the membership of the users listed in its
+    power levels.
+
+    The index is built once from the room's state, then kept up to date from the
+    membership and power levels events the module sees. It can miss events (e.g. if
+    they're rejected after we've seen them), so it's only used as a hint, and checked
+    against the room's state before acting on it.
+    """
+
+    __slots__ = (
+        "lookups",
+        "power_levels_event_id",
+        "users_levels",
+        "admins",
+        "active_admins",
+        "joined",
+        "invited",
+    )
+
+    def __init__(self) -> None:
+        # How many state entries the last call to is_last_admin_leaving looked up.
+        self.lookups = 0
+        # The ID of the power levels event the levels below were taken from.
+        self.power_levels_event_id: Optional[str] = None
+        # The user-specific power levels from the power levels event.
+        self.users_levels: Dict[str, int] = {}
+        # The users with an admin power level, regardless of their membership.
+        self.admins: Set[str] = set()
+        # The admins that are in, or invited to, the room.
+        self.active_admins: Set[str] = set()
+        self.joined: Set[str] = set()
+        self.invited: Set[str] = set()
+
+    @classmethod
+    def from_snapshot(cls, snapshot: "RoomSnapshot") -> "_RoomAdminIndex":
+        """Builds an index from a snapshot of the room's state."""
+        index = cls()
+        index.joined = set(snapshot.joined)
+        index.invited = set(snapshot.invited)
+        index.update_power_levels(snapshot.power_levels)
+        return index
+
+    def is_active(self, user_id: str) -> bool:
+        return user_id in self.joined or user_id in self.invited
+
+    def update_power_levels(
         self,
-        event: EventBase,
+        power_levels: Optional[PowerLevelsView],
+        state_events: Optional[StateMap[EventBase]] = None,
+    ) -> None:
+        """Replaces the power levels tracked by the index with the ones from the given
+        power levels view.
+
+        Args:
+            power_levels: The view of the new power levels.
+            state_events: The current state of the room. If provided, the membership of
+                the users listed in the new power levels is looked up in it.
+        """
+        if power_levels is None:
+            self.power_levels_event_id = None
+            self.users_levels = {}
+            self.admins = set()
+        else:
+            self.power_levels_event_id = power_levels.event_id
+            self.users_levels = {
+                user_id: level
+                for level, user_ids in power_levels.levels
+                for user_id in user_ids
+            }
+            self.admins = set(power_levels.admins)
+
+        if state_events is not None:
+            for user_id in self.users_levels:
+                self._set_active(user_id, _get_membership(user_id, state_events))
+
+        self.active_admins = {
+            user_id for user_id in self.admins if self.is_active(user_id)
+        }
+
+    def _set_active(self, user_id: str, membership: Optional[str]) -> None:
+        self.joined.discard(user_id)
+        self.invited.discard(user_id)
+        if membership == Membership.JOIN:
+            self.joined.add(user_id)
+        elif membership == Membership.INVITE:
+            self.invited.add(user_id)
+
+    def set_membership(self, user_id: str, membership: Optional[str]) -> None:
+        """Records the new membership of a user in the room.
+
+        Only the membership of the users listed in the power levels is tracked, the
+        membership of other users is looked up when the power levels change.
+        """
+        if user_id not in self.users_levels:
+            return
+
+        was_active = self.is_active(user_id)
+        self._set_active(user_id, membership)
+
+        is_active = self.is_active(user_id)
+        if was_active == is_active:
+            return
+
+        if user_id in self.admins:
+            if is_active:
+                self.active_admins.add(user_id)
+            else:
+                self.active_admins.discard(user_id)
+
+    def is_last_admin_leaving(
+        self,
+        user_id: str,
         state_events: StateMap[EventBase],
-    ) -> Tuple[bool, Optional[Dict[str, Any]]]:
-        """Implements synapse.events.ThirdPartyEventRules.check_event_allowed.
+    ) -> bool:
+        """Checks whether the given user is the last admin in, or invited to, the room.
 
-        Checks the event's type and the current rule and calls the right function to
-        determine whether the event can be allowed.
+        The membership of the other admins is looked up in the room's state, and the
+        index is corrected if it's out of date.
 
         Args:
-            event: The event to check.
-            state_events: A dict mapping (event type, state key) to state event.
-                State events in the room the event originated from.
+            user_id: The user leaving the room.
+            state_events: The current state of the room.
 
         Returns:
-            True if the event should be allowed, False if it should be rejected. If the
-            event should be allowed but with some of its data replaced (or its context
-            needs to be recalculated, eg because the state of the room has changed), a
-            dictionary might be returned in addition to the boolean.
+            Whether the user is the last admin of the room, according to the index.
         """
+        self.lookups = 0
+        if user_id not in self.admins:
+            return False
 
-        # If the event is a leave membership update, check if the last admin is leaving
-        # the room
-        if (
-            event.type == EventTypes.Member
-            and event.membership == Membership.LEAVE
-            and event.is_state()
-        ):
-            await self._on_room_leave(event, state_events)
-
-        return True, None
+        return self.loses_last_admin(frozenset([user_id]), self.admins, state_events)
 
-    async def _on_room_leave(
+    def loses_last_admin(
         self,
-        event: EventBase,
+        lost_admins: AbstractSet[str],
+        new_admins: AbstractSet[str],
         state_events: StateMap[EventBase],
-    ) -> None:
-        """React to a m.room.member event with a "leave" membership.
+    ) -> bool:
+        """Checks whether the room is left without any admin in, or invited to, it once
+        the given admins stop being admins.
 
-        Checks if the user leaving the room is the last admin in the room. If so, checks
-        if there are users with lower but non-default power levels that can be promoted
-        to admins. If so, promotes them to admin if the configuration allows it,
-        otherwise change admin rule of the room.
+        Only the membership of the users who become admins, and of the admins the index
+        knows to be active, is looked up in the room's state, and the index is corrected
+        if it's out of date.
 
         Args:
-            event: The event to check.
+            lost_admins: The admins who are leaving the room, or losing their admin
+                level.
+            new_admins: The admins of the room once they're gone.
             state_events: The current state of the room.
+
+        Returns:
+            Whether the room is left without an admin, according to the index.
         """
-        # Check if the last admin is leaving the room.
-        pl_content = _get_power_levels_content_from_state(state_events)
-        if pl_content is None:
-            return
+        self.lookups = 0
+        for user_id in new_admins - self.admins:
+            # This user is becoming an admin.
+            self.lookups += 1
+            if _get_membership(user_id, state_events) in [
+                Membership.JOIN,
+                Membership.INVITE,
+            ]:
+                return False
+
+        for admin in list(self.active_admins):
+            if admin in lost_admins:
+                continue
+
+            self.lookups += 1
+            membership = _get_membership(admin, state_events)
+            if membership in [Membership.JOIN, Membership.INVITE]:
+                return False
+
+            # We missed this admin leaving the room.
+            self.set_membership(admin, membership)
 
-        last_admin_leaving = _is_last_admin_leaving(event, pl_content, state_events)
-        if not last_admin_leaving:
-            return
+        return True
 
-        # If so, search for users to promote if the configuration allows it.
-        if self._config.promote_moderators:
-            # Look for users to promote.
-            users_to_promote = _get_users_with_highest_nondefault_pl(
-                pl_content["users"],
-                pl_content.get("users_default", 0),
-                state_events,
-                ignore_user=event.state_key,
-            )
 
-            # If we found users to promote, update the power levels event in the room's
-            # state.
-            if users_to_promote:
-                #avoid external users to be promoted
-                users_to_promote = _filter_out_users_from_forbidden_domain(
-                    users_to_promote, 
-                    self._config.domains_forbidden_when_restricted)
+class RoomSnapshot:
+    """The parts of a room's state the module needs to make a decision.
 
-                logger.info(
-                    "Promoting users to admins in room %s: %s",
-                    event.room_id,
-                    users_to_promote,
-                )
-                await self._promote_to_admins(users_to_promote, pl_content, event)
-                return
+    A snapshot is either collected in a single pass over the room's state (from_state),
+    or from keyed lookups of the few state entries needed to find out who the room's
+    admins are (from_lookups), in which case it only knows about the membership of the
+    users listed in the room's power levels until set_members is called.
+    """
 
-        room_type = _get_room_type(state_events)
-        if room_type in [RoomType.PRIVATE, RoomType.PUBLIC]:
-            # We make sure to change default permission only on public or private rooms
-            # If not, we set the default power level as admin
-            logger.info("Make admin as default level in room %s", event.room_id)
-            await self._set_room_users_default_to_admin(event, state_events)
-        elif room_type in [RoomType.UNKNOWN, RoomType.EXTERNAL]:
-            # In case of External or Unknown Room
-            # promote all users with default power levels except external users
-            users_to_promote = _get_users_with_default_pl(pl_content["users"],
-                state_events)
-            
-            #avoid external users to be promoted
-            users_to_promote = _filter_out_users_from_forbidden_domain(
-                    users_to_promote, 
-                    self._config.domains_forbidden_when_restricted)
-            
-            logger.info("Make admin all non-external default power level users room %s: %s", event.room_id, ', '.join(users_to_promote))
-            await self._promote_to_admins(users_to_promote, pl_content, event)
-
-    async def _set_room_users_default_to_admin(
-        self, event: EventBase, state_events: StateMap[EventBase]
-    ) -> None:
+    __slots__ = (
+        "memberships",
+        "joined",
+        "invited",
+        "is_encrypted",
+        "access_rule",
+        "room_type",
+        "power_levels",
+        "entries_scanned",
+        "has_all_members",
+    )
+
+    def __init__(self) -> None:
+        # The membership of every user with a m.room.member event in the state.
+        self.memberships: Dict[str, str] = {}
+        # The users in the room, and the ones invited to it.
+        self.joined: List[str] = []
+        self.invited: List[str] = []
+        self.is_encrypted = False
+        # The rule from the room's im.vector.room.access_rules event, if any.
+        self.access_rule: Optional[Any] = None
+        self.room_type: str = RoomType.UNKNOWN
+        self.power_levels: Optional[PowerLevelsView] = None
+        # How many state entries were looked at to build the snapshot.
+        self.entries_scanned = 0
+        # Whether memberships, joined and invited include every member of the room.
+        self.has_all_members = True
+
+    @classmethod
+    def from_state(
+        cls,
+        state_events: StateMap[EventBase],
+        room_type: Optional[str] = None,
+    ) -> "RoomSnapshot":
+        """Builds a snapshot from the full state of a room.
 
-        current_power_levels = state_events.get((EventTypes.PowerLevels, ""))
-        # Make a deep copy of the content so we don't edit the "users" dict from
-        # the event that's currently in the room's state.
-        power_levels_content = (
-            {}
-            if current_power_levels is None
-            else copy.deepcopy(current_power_levels.content)
-        )
-        # Send a new power levels event with a similar content to the previous one
-        # except users_default is 100 to allow any user to be admin of the room.
-        power_levels_content["users_default"] = 100
-        # Just to be safe, also delete all users that don't have a power level of
-        # 100, in order to prevent anyone from being unable to be admin the room.
-        # Julien : I am not why it's needed
-        users = {}
-        for user, level in power_levels_content["users"].items():
-            if level == 100:
-                users[user] = level
-        power_levels_content["users"] = users
-        await self._api.create_and_send_event_into_room(
-            {
-                "room_id": event.room_id,
-                "sender": event.sender,
-                "type": EventTypes.PowerLevels,
-                "content": power_levels_content,
-                "state_key": "",
-                **_maybe_get_event_id_dict_for_room_version(
-                    event.room_version, self._api.server_name
-                ),
-            }
+        Args:
+            state_events: The current state of the room.
+            room_type: The type of the room, if already known. Otherwise it's worked out
+                from the room's state.
+
+        Returns:
+            The snapshot of the room's state.
+        """
+        with _stage("build_room_snapshot"):
+            snapshot = cls._from_state(state_events, room_type)
+            set_tag(TracingTags.ROOM_TYPE, snapshot.room_type)
+            return snapshot
+
+    @classmethod
+    def _from_state(
+        cls,
+        state_events: StateMap[EventBase],
+        room_type: Optional[str],
+    ) -> "RoomSnapshot":
+        snapshot = cls()
+        power_levels_event = None
+        for (event_type, state_key), state_event in state_events.items():
+            snapshot.entries_scanned += 1
+
+            if event_type == EventTypes.Member:
+                membership = state_event.membership
+                snapshot.memberships[state_key] = membership
+                if membership == Membership.JOIN:
+                    snapshot.joined.append(state_key)
+                elif membership == Membership.INVITE:
+                    snapshot.invited.append(state_key)
+            elif state_key != "":
+                continue
+            elif event_type == EventTypes.PowerLevels:
+                power_levels_event = state_event
+            elif event_type == EventTypes.RoomEncryption:
+                snapshot.is_encrypted = True
+            elif event_type == ACCESS_RULES_TYPE:
+                # TODO : This is slightly different from this one:
+                # https://github.com/tchapgouv/synapse-room-access-rules/blob/3ade4c621ed874e2d2c6c9b12c6dd303350639c4/room_access_rules/__init__.py#L962
+                snapshot.access_rule = state_event.content.get("rule")
+
+        if power_levels_event is not None:
+            snapshot.power_levels = _get_power_levels_view_for_event(power_levels_event)
+        snapshot.room_type = (
+            room_type if room_type is not None else _get_room_type(snapshot)
         )
+        return snapshot
 
-    async def _promote_to_admins(
-        self,
-        users_to_promote: Iterable[str],
-        pl_content: Dict[str, Any],
-        event: EventBase,
-    ) -> None:
-        """Promotes a given list of users to admins.
+    @classmethod
+    def from_lookups(
+        cls,
+        state_events: StateMap[EventBase],
+        room_type: Optional[str] = None,
+        power_levels: Optional[PowerLevelsView] = None,
+    ) -> "RoomSnapshot":
+        """Builds a snapshot from the room's power levels, and from the membership of
+        the users listed in them, without going through the rest of the room's state.
 
         Args:
-            users_to_promote: The users to promote.
-            pl_content: The content of the m.room.power_levels event that's currently in
-                the room state.
-            event: The event we want to use the sender and room_id of to send the new
-                power levels event.
-        """
-        # Make a deep copy of the content so we don't edit the "users" dict from
-        # the event that's currently in the room's state.
-        new_pl_content = copy.deepcopy(pl_content)
-        for user in users_to_promote:
-            new_pl_content["users"][user] = pl_content["users"][event.sender]
-
-        try: 
-            await self._api.create_and_send_event_into_room(
-                {
-                    "room_id": event.room_id,
-                    "sender": event.sender,
-                    "type": EventTypes.PowerLevels,
-                    "content": new_pl_content,
-                    "state_key": "",
-                    **_maybe_get_event_id_dict_for_room_version(
-                        event.room_version, self._api.server_name
-                    ),
-                }
-            )
-        except Exception as e:  # Catch all other exceptions
-            # Generic handling if you don't know the exact type of the exception
-            # if users_to_promote list if very very large, we might reach the event size limit of 65kb 
-            # see : https://spec.matrix.org/v1.12/client-server-api/#size-limits
-            logger.info("Cannot send promote event : %s", e)
- 
+            state_events: The current state of the room.
+            room_type: The type of the room, if already known. Otherwise it's worked out
+                from the room's state.
+            power_levels: The power levels to build the snapshot with, if not the ones
+                in the room's state, e.g. the ones of an event being checked.
+
+        Returns:
+            The snapshot of the room's admins.
+        """
+        with _stage("build_room_snapshot"):
+            snapshot = cls()
+            snapshot.has_all_members = False
+            if power_levels is None:
+                power_levels = _get_power_levels_view(state_events)
+                snapshot.entries_scanned = 1
+            snapshot.power_levels = power_levels
+
+            if snapshot.power_levels is not None:
+                for user_id in snapshot.power_levels.users:
+                    snapshot.entries_scanned += 1
+                    membership = _get_membership(user_id, state_events)
+                    if membership is not None:
+                        snapshot._add_member(user_id, membership)
+
+            if room_type is None:
+                snapshot.entries_scanned += 2
+                snapshot.is_encrypted = (
+                    EventTypes.RoomEncryption,
+                    "",
+                ) in state_events
+                access_rules_event = state_events.get((ACCESS_RULES_TYPE, ""))
+                if access_rules_event is not None:
+                    snapshot.access_rule = access_rules_event.content.get("rule")
+                room_type = _get_room_type(snapshot)
+
+            snapshot.room_type = room_type
+            set_tag(TracingTags.ROOM_TYPE, snapshot.room_type)
+            return snapshot
+
+    def set_members(self, member_events: StateMap[EventBase]) -> None:
+        """Replaces the members known to the snapshot with the ones from the given
+        membership events, which must include every member of the room.
+
+        Args:
+            member_events: The m.room.member events in the room's state.
+        """
+        self.memberships = {}
+        self.joined = []
+        self.invited = []
+        for (event_type, state_key), state_event in member_events.items():
+            if event_type == EventTypes.Member:
+                self._add_member(state_key, state_event.membership)
+        self.has_all_members = True
+
+    def _add_member(self, user_id: str, membership: str) -> None:
+        self.memberships[user_id] = membership
+        if membership == Membership.JOIN:
+            self.joined.append(user_id)
+        elif membership == Membership.INVITE:
+            self.invited.append(user_id)
+
+    def get_membership(self, user_id: str) -> Optional[str]:
+        return self.memberships.get(user_id)
+
 
 def _maybe_get_event_id_dict_for_room_version(
     room_version: RoomVersion, server_name: str
@@ -257,50 +2215,40 @@ def _maybe_get_event_id_dict_for_room_version(
     return {"event_id": "!%s:%s" % (random_id, server_name)}
 
 
-def _is_room_encrypted(
-    state_events: StateMap[EventBase],
-) -> bool:
-    room_encryption = state_events.get((EventTypes.RoomEncryption, ""))
-    if room_encryption:
-        return True
-    return False
-
-
-def _get_access_rule_type(
-    state_events: StateMap[EventBase],
-) -> Optional[Any]:
-    """
-    TODO : This method is slightly different from this one:
-    https://github.com/tchapgouv/synapse-room-access-rules/blob/3ade4c621ed874e2d2c6c9b12c6dd303350639c4/room_access_rules/__init__.py#L962
-    """
-    access_rule_type_event = state_events.get((ACCESS_RULES_TYPE, ""))
-    if access_rule_type_event is None:
-        return None
-    return access_rule_type_event.content["rule"]
-
-
 def _is_room_public_or_private(
-    state_events: StateMap[EventBase],
+    snapshot: RoomSnapshot,
 ) -> bool:
     """Checks if the room is public or private
 
     Args:
-        state_events: The current state of the room, from which we can check the room's type.
+        snapshot: The snapshot of the room's state, from which we can check the room's
+            type.
 
     Returns:
         True if this room is public or private otherwise false.
     """
-    room_type = _get_room_type(state_events)
-    return room_type in [RoomType.PRIVATE, RoomType.PUBLIC]
+    return snapshot.room_type in [RoomType.PRIVATE, RoomType.PUBLIC]
 
 
 def _get_room_type(
-    state_events: StateMap[EventBase],
+    snapshot: RoomSnapshot,
 ) -> str:
-    is_room_encrypted = _is_room_encrypted(state_events)
-    if not is_room_encrypted:
+    return _classify_room(snapshot.is_encrypted, snapshot.access_rule)
+
+
+def _classify_room(is_encrypted: bool, access_rule_type: Optional[Any]) -> str:
+    """Works out the type of a room, see RoomType.
+
+    Args:
+        is_encrypted: Whether the room has a m.room.encryption event.
+        access_rule_type: The rule of the room's im.vector.room.access_rules event, if
+            any.
+
+    Returns:
+        The type of the room.
+    """
+    if not is_encrypted:
         return RoomType.PUBLIC
-    access_rule_type = _get_access_rule_type(state_events)
     if access_rule_type == AccessRules.RESTRICTED:
         return RoomType.PRIVATE
     if access_rule_type == AccessRules.UNRESTRICTED:
@@ -310,43 +2258,69 @@ def _get_room_type(
 
 def _is_last_admin_leaving(
     event: EventBase,
-    power_level_content: Dict[str, Any],
-    state_events: StateMap[EventBase],
+    snapshot: RoomSnapshot,
 ) -> bool:
-    """Checks if the provided leave event is the last admin in the room leaving it.
+    """Checks if the provided leave event is the last admin in the room leaving it,
+    including being kicked or banned from it.
 
     Args:
         event: The leave event to check.
-        power_level_content: The content of the power levels event that's currently in
-            the room's state.
-        state_events: The current state of the room, from which we can check the room's
-            member list.
+        snapshot: The snapshot of the room's state, from which we can check the room's
+            power levels and member list.
 
     Returns:
         Whether this event is the last admin leaving the room.
     """
+    if snapshot.power_levels is None:
+        return False
+
     # Get every admin user defined in the room's state
-    admin_users = {
-        user
-        for user, power_level in power_level_content["users"].items()
-        if power_level >= 100
-    }
+    admin_users = snapshot.power_levels.admins
 
-    if event.sender not in admin_users:
+    if event.state_key not in admin_users:
         # This user is not an admin, ignore them
         return False
 
-    if any(
-        event_type == EventTypes.Member
-        and state_event.membership in [Membership.JOIN, Membership.INVITE]
-        and state_key in admin_users
-        and state_key != event.sender
-        for (event_type, state_key), state_event in state_events.items()
-    ):
-        # There's another admin user in, or invited to, the room
+    # Check whether there's another admin user in, or invited to, the room
+    return not _has_admin(snapshot, ignore_user=event.state_key)
+
+
+def _is_room_without_admin(snapshot: RoomSnapshot) -> bool:
+    """Checks if a room has lost all of its admins, e.g. if its last admin left it
+    without this module noticing.
+
+    Args:
+        snapshot: The snapshot of the room's state.
+
+    Returns:
+        Whether the room has power levels but no admin in, or invited to, it.
+    """
+    if snapshot.power_levels is None:
+        return False
+
+    if snapshot.power_levels.users_default >= 100:
+        # Everyone is an admin in this room.
         return False
 
-    return True
+    return not _has_admin(snapshot)
+
+
+def _has_admin(snapshot: RoomSnapshot, ignore_user: Optional[str] = None) -> bool:
+    """Checks if any admin of the room is in, or invited to, it.
+
+    Args:
+        snapshot: The snapshot of the room's state. Must include power levels.
+        ignore_user: An admin to leave out of the check, if any.
+
+    Returns:
+        Whether an admin other than ignore_user is joined to or invited in the room.
+    """
+    assert snapshot.power_levels is not None
+    return any(
+        snapshot.get_membership(user_id) in [Membership.JOIN, Membership.INVITE]
+        for user_id in snapshot.power_levels.admins
+        if user_id != ignore_user
+    )
 
 
 def _get_power_levels_content_from_state(
@@ -364,11 +2338,94 @@ def _get_power_levels_content_from_state(
         levels event exist in the given state events or if one exists but its content is
         missing a "users" key.
     """
+    power_levels = _get_power_levels_view(state_events)
+    if power_levels is None:
+        return None
+
+    return power_levels.content
+
+
+# Views of the power levels events we've recently seen, keyed by event ID.
+_power_levels_view_cache: _LruCache[str, PowerLevelsView] = _LruCache(
+    POWER_LEVELS_VIEW_CACHE_SIZE, name="power_levels_views"
+)
+
+
+def _get_power_levels_view(
+    state_events: StateMap[EventBase],
+) -> Optional[PowerLevelsView]:
+    """Returns the view of the power levels event in the provided set of state events.
+
+    Args:
+        state_events: The state events to extract power levels from.
+
+    Returns:
+        The view of the power levels event, or None if no power levels event exist in
+        the given state events or if one exists but its content can't be used.
+    """
     power_level_state_event = state_events.get((EventTypes.PowerLevels, ""))
     if power_level_state_event is None:
         return None
-    power_level_content = power_level_state_event.content
 
+    return _get_power_levels_view_for_event(power_level_state_event)
+
+
+def _get_power_levels_view_for_event(
+    power_level_state_event: EventBase,
+) -> Optional[PowerLevelsView]:
+    """Returns the view of the given power levels event, computing it if it's not
+    already cached.
+
+    Args:
+        power_level_state_event: The m.room.power_levels event.
+
+    Returns:
+        The view of the power levels event, or None if its content is missing a "users"
+        key.
+    """
+    power_levels = _power_levels_view_cache.get(power_level_state_event.event_id)
+    if power_levels is not None:
+        return power_levels
+
+    power_levels = _build_power_levels_view(
+        power_level_state_event.event_id, power_level_state_event.content
+    )
+    if power_levels is not None:
+        _power_levels_view_cache.set(power_levels.event_id, power_levels)
+    return power_levels
+
+
+def _get_power_levels_view_with_users(
+    power_level_state_event: EventBase,
+) -> Optional[PowerLevelsView]:
+    """Same as _get_power_levels_view_for_event, but a content without a "users" key is
+    read as if it had an empty one, as the spec says it should.
+
+    The content of the view then has an empty "users" dictionary, so power levels
+    events built from it do too.
+    """
+    power_levels = _get_power_levels_view_for_event(power_level_state_event)
+    content = power_level_state_event.content
+    if power_levels is None and isinstance(content, dict) and "users" not in content:
+        power_levels = _build_power_levels_view(
+            power_level_state_event.event_id, {**content, "users": {}}
+        )
+    return power_levels
+
+
+def _build_power_levels_view(
+    event_id: str, power_level_content: Any
+) -> Optional[PowerLevelsView]:
+    """Builds the view of a power levels event, see _get_power_levels_view_for_event.
+
+    Args:
+        event_id: The ID of the power levels event.
+        power_level_content: The content of the power levels event.
+
+    Returns:
+        The view of the power levels event, or None if its content is missing a "users"
+        key.
+    """
     # Do some validation checks on the power level state event
     if (
         not isinstance(power_level_content, dict)
@@ -379,104 +2436,91 @@ def _get_power_levels_content_from_state(
         # frozen. Bail out.
         return None
 
-    return power_level_content
-
-def _get_members_in_room_from_state_events(state_events: StateMap[EventBase]
-)-> list[str]: 
-    members = []
-    for (event_type, state_key), state_event in state_events.items():
-        if (
-            event_type == EventTypes.Member
-            and state_event.membership == Membership.JOIN
-            and state_event.is_state()
-        ):
-            members.append(state_key)  # state_key is the user ID
-    return members
-
+    # Group users by power level, ignoring any level that isn't an integer.
+    users_by_level: Dict[int, List[str]] = {}
+    for user_id, level in power_level_content["users"].items():
+        if isinstance(level, int):
+            users_by_level.setdefault(level, []).append(user_id)
+
+    users_default = power_level_content.get("users_default", 0)
+    if not isinstance(users_default, int):
+        users_default = 0
+
+    return PowerLevelsView(
+        event_id=event_id,
+        content=power_level_content,
+        users=frozenset(power_level_content["users"]),
+        admins=frozenset(
+            user_id
+            for level, user_ids in users_by_level.items()
+            if level >= 100
+            for user_id in user_ids
+        ),
+        levels=tuple(
+            (level, tuple(users_by_level[level]))
+            for level in sorted(users_by_level, reverse=True)
+        ),
+        users_default=users_default,
+    )
 
 def _get_users_with_default_pl(
-    users_pl_dict: Dict[str, Any],
-    state_events: StateMap[EventBase]
-)->  Iterable[str]:
-    # Make a copy of the users dict so we don't modify the actual event content.
-    users_dict_copy = users_pl_dict.copy()
+    snapshot: RoomSnapshot,
+) -> List[str]:
+    power_levels = snapshot.power_levels
 
     # If there's no more user to evaluate, return an empty tuple.
-    if not users_dict_copy:
+    if power_levels is None or not power_levels.users:
         return []
-    
+
     # Figure out which users in still in the room :
-    members_in_room = _get_members_in_room_from_state_events(state_events)
+    members_in_room = snapshot.joined
+
+    users_with_default_pl = [
+        user for user in members_in_room if user not in power_levels.users
+    ]
 
-    users_with_default_pl = [user for user in members_in_room if user not in users_pl_dict]
-    
     return users_with_default_pl
 
 
 def _get_users_with_highest_nondefault_pl(
-    users_dict: Dict[str, Any],
-    users_default_pl: int,
-    state_events: StateMap[EventBase],
+    snapshot: RoomSnapshot,
     ignore_user: str,
-) -> Iterable[str]:
-    """Looks at the provided bits of power levels event content to figure out what the
-    maximum user-specific non-default power level is with users still in the room (or
-    invited to it) and which users have it.
+) -> List[str]:
+    """Looks at the room's power levels to figure out what the maximum user-specific
+    non-default power level is with users still in the room (or invited to it) and which
+    users have it.
 
     Args:
-        users_dict: The "users" dictionary from the power levels event content.
-        users_default_pl: The default power level for users who don't appear in the users
-            dictionary.
-        state_events: The current state of the room, from which we can check the room's
-            member list.
+        snapshot: The snapshot of the room's state, from which we can check the room's
+            power levels and member list.
         ignore_user: A user to ignore, i.e. to consider they've left the room even if the
             room's state says otherwise.
 
     Returns:
-        A tuple of users with the highest non-default power level, or an empty set if no
+        A list of users with the highest non-default power level, or an empty list if no
         such users exist in the room.
     """
-    # Make a copy of the users dict so we don't modify the actual event content.
-    users_dict_copy = users_dict.copy()
-
-    if ignore_user in users_dict_copy:
-        del users_dict_copy[ignore_user]
-
-    while True:
-        # If there's no more user to evaluate, return an empty tuple.
-        if not users_dict_copy:
-            return []
-
-        # Get the max power level in the dict.
-        max_pl = max(users_dict_copy.values())
+    power_levels = snapshot.power_levels
+    if power_levels is None:
+        return []
 
-        # Bail out if the max power level is the default one (or is lower).
-        if max_pl <= users_default_pl:
+    # The levels are sorted from highest to lowest, so the first level with users in
+    # the room (or with a pending invite to it) is the one we're looking for.
+    for level, user_ids in power_levels.levels:
+        # Bail out if we've reached the default power level (or lower).
+        if level <= power_levels.users_default:
             return []
 
-        # Figure out which users have that maximum power level.
-        users_with_max_pl = [
-            user_id for user_id, pl in users_dict_copy.items() if pl == max_pl
-        ]
-
-        # Among those users, figure out which ones are still in the room (or have a
-        # pending invite to it): those are the users we need to promote.
         users_to_promote = [
             user_id
-            for user_id in users_with_max_pl
-            if (
-                _get_membership(user_id, state_events)
-                in [Membership.JOIN, Membership.INVITE]
-            )
+            for user_id in user_ids
+            if user_id != ignore_user
+            and snapshot.get_membership(user_id) in [Membership.JOIN, Membership.INVITE]
         ]
-
-        # If we've got users in the room to promote, break out and return.
         if users_to_promote:
             return users_to_promote
 
-        # Otherwise, remove the users we've considered and start again.
-        for user_id in users_with_max_pl:
-            del users_dict_copy[user_id]
+    return []
 
 
 def _get_membership(
@@ -490,18 +2534,45 @@ def _get_membership(
 
     return evt.membership
 
-def _filter_out_users_from_forbidden_domain(user_ids: Iterable[str], forbidden_domains: List[str]
+@functools.lru_cache(maxsize=USER_DOMAIN_CACHE_SIZE)
+def _get_user_domain(user_id: str) -> str:
+    """Returns the domain of the given user ID, or an empty string if it doesn't have
+    one.
+
+    This is much cheaper than parsing the user ID with UserID.from_string, which we don't
+    need since we only look at the domain.
+    """
+    _, _, domain = user_id.partition(":")
+    return domain
+
+
+metrics.register_functools_cache("user_domains", _get_user_domain)
+
+
+def _filter_out_users_from_forbidden_domain(
+    user_ids: Iterable[str], forbidden_domains: Union[DomainMatcher, List[str]]
 ) -> List[str]:
     """Filters out any users that belong to forbidden domains.
 
     Args:
         user_ids: An iterable of user IDs to filter.
-        forbidden_domains: A list of domain names that are forbidden.
+        forbidden_domains: The domain names that are forbidden, either as a list or
+            already compiled into a DomainMatcher.
 
     Returns:
         A list of user IDs with users from forbidden domains filtered out.
     """
     if user_ids is None:
         return None
-    
-    return [user_id for user_id in user_ids if UserID.from_string(user_id).domain not in forbidden_domains]
+
+    if not isinstance(forbidden_domains, DomainMatcher):
+        forbidden_domains = DomainMatcher(forbidden_domains)
+
+    if not forbidden_domains:
+        return list(user_ids)
+
+    return [
+        user_id
+        for user_id in user_ids
+        if not forbidden_domains.matches(_get_user_domain(user_id))
+    ]
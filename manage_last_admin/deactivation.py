@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Tuple, cast
+
+from synapse.api.room_versions import KNOWN_ROOM_VERSIONS, RoomVersion
+from synapse.module_api import ModuleApi, run_as_background_process
+from synapse.storage.database import LoggingTransaction
+from synapse.util.async_helpers import concurrently_execute
+
+from manage_last_admin import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DeactivationBatcher:
+    """Repairs the rooms of a user whose account was deactivated as one batch.
+
+    When an account is deactivated, Synapse starts making the user leave every room
+    they're in, one after the other, before telling modules about the deactivation. So
+    the batch runs alongside these leaves rather than ahead of them: it goes through all
+    the rooms the user is still in, a bounded number of them at once, and repairs the
+    ones the user is the last admin of while they're still in them. Each leave is still
+    checked as usual. A leave for a room the batch is repairing waits for it and finds
+    the room already repaired, and a leave that gets to a room first repairs it itself,
+    in which case the batch finds nothing left to do.
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        repair_room: Callable[[str, str, RoomVersion], Awaitable[str]],
+        concurrency: int,
+    ):
+        """
+        Args:
+            api: The module API.
+            repair_room: Repairs the given room, with the given version, if the given
+                user is its last admin. Returns the outcome of the repair, see
+                LeaveOutcome, and doesn't raise.
+            concurrency: The maximum number of rooms repaired at once.
+        """
+        self._api = api
+        self._repair_room = repair_room
+        self._concurrency = concurrency
+
+    async def on_user_deactivation_status_changed(
+        self, user_id: str, deactivated: bool, by_admin: bool
+    ) -> None:
+        """Implements
+        synapse.events.ThirdPartyEventRules.on_user_deactivation_status_changed.
+
+        Starts repairing the rooms of the user in the background if their account was
+        deactivated, so the deactivation isn't held up.
+        """
+        if not deactivated:
+            return
+
+        run_as_background_process(
+            "manage_last_admin_deactivation_batch", self.process, user_id
+        )
+
+    async def process(self, user_id: str) -> Dict[str, int]:
+        """Repairs the rooms of a deactivated user, see the class's docstring.
+
+        Args:
+            user_id: The deactivated user.
+
+        Returns:
+            How many rooms had each outcome, see LeaveOutcome.
+        """
+        start = time.perf_counter()
+        # The type of run_db_interaction doesn't account for the transaction the
+        # function is given before the arguments.
+        rooms = await self._api.run_db_interaction(
+            "manage_last_admin_get_rooms_of_deactivated_user",
+            cast(Callable[..., List[Tuple[str, str]]], _get_joined_rooms_txn),
+            user_id,
+        )
+
+        outcomes: Dict[str, int] = {}
+
+        async def repair(room: Tuple[str, str]) -> None:
+            room_id, room_version = room
+            outcome = await self._repair_room(
+                room_id, user_id, KNOWN_ROOM_VERSIONS[room_version]
+            )
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+        await concurrently_execute(repair, rooms, self._concurrency)
+
+        elapsed = time.perf_counter() - start
+        metrics.deactivation_batch_seconds.observe(elapsed)
+        logger.info(
+            "Processed %d rooms of deactivated user %s in %.3fs: %s",
+            len(rooms),
+            user_id,
+            elapsed,
+            ", ".join(f"{outcome}: {count}" for outcome, count in outcomes.items()),
+        )
+        return outcomes
+
+
+def _get_joined_rooms_txn(
+    txn: LoggingTransaction, user_id: str
+) -> List[Tuple[str, str]]:
+    txn.execute(
+        """
+        SELECT room_id, room_version FROM local_current_membership
+        INNER JOIN rooms USING (room_id)
+        WHERE user_id = ? AND membership = 'join'
+        ORDER BY room_id
+        """,
+        (user_id,),
+    )
+    return cast(List[Tuple[str, str]], txn.fetchall())
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Any, Callable, Optional
+
+from prometheus_client import Counter, Gauge, Histogram, Summary
+from synapse.util.caches import CacheMetric, register_cache
+
+# Prometheus metrics exported by the module. They're registered in the default registry,
+# which Synapse exposes on its metrics listener.
+
+check_event_allowed_seconds = Histogram(
+    "manage_last_admin_check_event_allowed_seconds",
+    "Time spent in check_event_allowed, by outcome of the event's processing",
+    ["outcome"],
+)
+
+state_entries_scanned = Histogram(
+    "manage_last_admin_state_entries_scanned",
+    "Number of room state entries looked at to process a leave",
+    buckets=(1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000, float("inf")),
+)
+
+stage_seconds = Histogram(
+    "manage_last_admin_stage_seconds",
+    "Time spent in each stage of the processing of a leave",
+    ["stage"],
+)
+
+offloaded_seconds = Histogram(
+    "manage_last_admin_offloaded_seconds",
+    "Time spent in computations run in a thread rather than on the reactor, by stage",
+    ["stage"],
+)
+
+promoted_users = Counter(
+    "manage_last_admin_promoted_users",
+    "Number of users promoted to admins",
+)
+
+power_levels_events_sent = Counter(
+    "manage_last_admin_power_levels_events_sent",
+    "Number of power levels events sent, by repair strategy",
+    ["strategy"],
+)
+
+power_levels_events_replaced = Counter(
+    "manage_last_admin_power_levels_events_replaced",
+    "Number of power levels events replaced with ones that also repair the room, by"
+    " repair strategy",
+    ["strategy"],
+)
+
+background_repairs = Gauge(
+    "manage_last_admin_background_repairs",
+    "Number of repairs running in the background, when repair_in_background is enabled",
+)
+
+inline_repairs = Counter(
+    "manage_last_admin_inline_repairs",
+    "Number of leaves of admins processed inline, when repair_in_background is"
+    " enabled, because repair_concurrency repairs were already running",
+)
+
+repair_retries = Counter(
+    "manage_last_admin_repair_retries",
+    "Number of failed repairs retried, by result: succeeded, not_needed, failed or"
+    " abandoned",
+    ["result"],
+)
+
+slow_invocations_sampled = Counter(
+    "manage_last_admin_slow_invocations_sampled_total",
+    "Number of calls to check_event_allowed captured for being slower than"
+    " slow_sampler_threshold_ms",
+)
+
+deactivation_batch_seconds = Summary(
+    "manage_last_admin_deactivation_batch_seconds",
+    "Time spent repairing the rooms of each deactivated user, when batch_deactivations"
+    " is enabled",
+)
+
+warmup_rooms = Gauge(
+    "manage_last_admin_warmup_rooms",
+    "Number of rooms the module's caches are warmed up for after startup, by state:"
+    " total, done or failed",
+    ["state"],
+)
+
+dry_run_power_levels_events = Counter(
+    "manage_last_admin_dry_run_power_levels_events",
+    "Number of power levels events that would have been sent outside of dry run mode,"
+    " by repair strategy",
+    ["strategy"],
+)
+
+power_levels_event_size_bytes = Histogram(
+    "manage_last_admin_power_levels_event_size_bytes",
+    "Size of the content of the power levels events sent, in bytes",
+    buckets=(256, 1024, 4096, 16384, 32768, 49152, 65536, float("inf")),
+)
+
+# The type of the module's caches in Synapse's cache metrics.
+CACHE_TYPE = "manage_last_admin"
+
+
+def register_module_cache(name: str, cache: Any) -> CacheMetric:
+    """Registers one of the module's caches with Synapse's cache metrics, which report
+    its size and hit rate as synapse_util_caches_cache_* metrics.
+
+    Args:
+        name: The name of the cache in the metrics.
+        cache: The cache, which must implement __len__, and may have a max_size
+            attribute.
+
+    Returns:
+        The metric to report the cache's hits, misses and evictions to.
+    """
+    return register_cache(CACHE_TYPE, name, cache, resizable=False)
+
+
+class _FunctoolsCache:
+    """Exposes a function wrapped with functools.lru_cache to Synapse's cache metrics."""
+
+    def __init__(self, func: Any):
+        self._func = func
+        self.max_size: Optional[int] = func.cache_parameters()["maxsize"]
+        self.metric: Optional[CacheMetric] = None
+
+    def __len__(self) -> int:
+        info = self._func.cache_info()
+        # Synapse asks for the size of the cache first when collecting its metrics, so
+        # this is where the hits and misses are brought up to date.
+        if self.metric is not None:
+            self.metric.hits = info.hits
+            self.metric.misses = info.misses
+        return int(info.currsize)
+
+
+def register_functools_cache(name: str, func: Callable[..., Any]) -> CacheMetric:
+    """Registers a function wrapped with functools.lru_cache with Synapse's cache
+    metrics. Its hits and misses are read from the function's cache info whenever the
+    metrics are collected.
+
+    Args:
+        name: The name of the cache in the metrics.
+        func: The cached function.
+
+    Returns:
+        The cache's metric.
+    """
+    cache = _FunctoolsCache(func)
+    cache.metric = register_cache(CACHE_TYPE, name, cache, resizable=False)
+    return cache.metric
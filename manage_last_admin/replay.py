@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Replays recorded room states and events through the module, without a homeserver.
+
+Each line of the input files is a JSON object with:
+
+* "event": the event to check, usually a leave, in the format of Synapse's event JSON.
+* "state": the list of the room's state events when the event was sent.
+* "room_version": optional, the version of the room, defaults to "10".
+
+Input files are read one line at a time, and the state events of a line are only turned
+into events when the module looks them up, so large exports can be replayed with little
+memory. The power levels events the module would have sent, or replaced the checked
+event with, are written to the output file, if any, and a summary of the throughput and
+latency of the module is printed.
+
+Usage:
+
+    python -m manage_last_admin.replay --config config.yaml --output sent.jsonl \\
+        dump.jsonl [dump2.jsonl ...]
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from typing import (
+    IO,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    TextIO,
+    Tuple,
+    TypeVar,
+    cast,
+)
+
+import attr
+import yaml
+from synapse.api.constants import EventTypes, Membership
+from synapse.api.room_versions import KNOWN_ROOM_VERSIONS, RoomVersion
+from synapse.events import EventBase, make_event_from_dict
+from synapse.module_api import ModuleApi
+from synapse.types import JsonDict, StateMap
+
+from manage_last_admin import ManageLastAdmin
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+DEFAULT_ROOM_VERSION = "10"
+
+# The latency percentiles to report.
+PERCENTILES = (50, 90, 99)
+
+
+class LazyStateMap(Mapping[Tuple[str, str], EventBase]):
+    """The state of a room, built from the JSON of its state events.
+
+    The JSON of an event is only turned into an event the first time it's looked up, as
+    the module usually only needs a handful of the room's state events.
+    """
+
+    def __init__(self, state: Iterable[JsonDict], room_version: RoomVersion):
+        self._room_version = room_version
+        self._raw: Dict[Tuple[str, str], JsonDict] = {
+            (event_dict["type"], event_dict["state_key"]): event_dict
+            for event_dict in state
+        }
+        self._events: Dict[Tuple[str, str], EventBase] = {}
+
+    @property
+    def events_built(self) -> int:
+        """How many events were built from their JSON so far."""
+        return len(self._events)
+
+    def __getitem__(self, key: Tuple[str, str]) -> EventBase:
+        event = self._events.get(key)
+        if event is None:
+            event = make_event_from_dict(self._raw[key], self._room_version)
+            self._events[key] = event
+        return event
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._raw
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        return iter(self._raw)
+
+    def __len__(self) -> int:
+        return len(self._raw)
+
+
+class RecordingModuleApi:
+    """Implements the parts of the ModuleApi the module uses when processing events,
+    against the state of the line being replayed. Events the module sends are recorded
+    instead.
+    """
+
+    def __init__(self, server_name: str):
+        self.server_name = server_name
+        # The state of the room of the event being replayed.
+        self.state: StateMap[EventBase] = {}
+        # The events sent while replaying the current line.
+        self.sent: List[JsonDict] = []
+
+    def register_third_party_rules_callbacks(self, **kwargs: Any) -> None:
+        pass
+
+    def is_mine(self, user_id: str) -> bool:
+        return user_id.split(":", 1)[1] == self.server_name
+
+    async def create_and_send_event_into_room(self, event_dict: JsonDict) -> None:
+        self.sent.append(event_dict)
+
+    async def defer_to_thread(
+        self, f: Callable[..., T], *args: Any, **kwargs: Any
+    ) -> T:
+        # Events are replayed one at a time, so there's nothing else to hold up.
+        return f(*args, **kwargs)
+
+    async def get_room_state(
+        self,
+        room_id: str,
+        event_filter: Optional[Iterable[Tuple[str, Optional[str]]]] = None,
+    ) -> StateMap[EventBase]:
+        if event_filter is None:
+            return self.state
+
+        state = {}
+        for event_type, state_key in event_filter:
+            if state_key is not None:
+                if (event_type, state_key) in self.state:
+                    state[(event_type, state_key)] = self.state[(event_type, state_key)]
+                continue
+
+            for key in self.state:
+                if key[0] == event_type:
+                    state[key] = self.state[key]
+        return state
+
+
+@attr.s(auto_attribs=True)
+class ReplayStats:
+    """What happened while replaying events."""
+
+    # How many events were checked, and how many of them were leaves.
+    events: int = 0
+    leaves: int = 0
+    # How many lines of the input couldn't be replayed.
+    skipped: int = 0
+    # How many power levels events the module would have sent.
+    sent: int = 0
+    # How many state events were built from their JSON, across all lines.
+    state_events_built: int = 0
+    # How long each call to check_event_allowed took, in seconds.
+    latencies: List[float] = attr.Factory(list)
+    # How long the whole replay took, including reading the input, in seconds.
+    elapsed: float = 0
+
+    def summary(self) -> str:
+        """Returns a human readable summary of the stats."""
+        lines = [
+            f"Events checked: {self.events} ({self.leaves} leaves,"
+            f" {self.skipped} lines skipped)",
+            f"Power levels events sent: {self.sent}",
+            f"State events built: {self.state_events_built}",
+        ]
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            total = sum(latencies)
+            lines.append(
+                f"Throughput: {len(latencies) / total:.1f} events per second in the"
+                f" module, {len(latencies) / self.elapsed:.1f} including reading the"
+                " input"
+            )
+            lines.append(
+                "Latency: "
+                + ", ".join(
+                    f"p{p} {percentile(latencies, p) * 1000:.3f} ms"
+                    for p in PERCENTILES
+                )
+                + f", max {latencies[-1] * 1000:.3f} ms"
+            )
+        return "\n".join(lines)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Returns the p-th percentile of the given sorted values, using the nearest rank
+    method.
+    """
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def replay(
+    module: ManageLastAdmin,
+    api: RecordingModuleApi,
+    lines: Iterable[str],
+    output: Optional[IO[str]] = None,
+) -> ReplayStats:
+    """Checks the event of each line with the module.
+
+    Args:
+        module: The module to replay the events through.
+        api: The ModuleApi the module was created with.
+        lines: The lines of the input, see the module's docstring for their format.
+        output: Where to write the power levels events the module would have sent, as
+            JSON lines, if anywhere.
+
+    Returns:
+        What happened while replaying the events.
+    """
+    stats = ReplayStats()
+    replay_start = time.perf_counter()
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+
+        try:
+            record = json.loads(line)
+            room_version = KNOWN_ROOM_VERSIONS[
+                record.get("room_version", DEFAULT_ROOM_VERSION)
+            ]
+            state = LazyStateMap(record["state"], room_version)
+            event = make_event_from_dict(record["event"], room_version)
+        except Exception as e:
+            logger.warning("Skipping line %d: %r", line_number, e)
+            stats.skipped += 1
+            continue
+
+        api.state = state
+        api.sent = []
+
+        start = time.perf_counter()
+        _, replacement = _run(module.check_event_allowed(event, state))
+        stats.latencies.append(time.perf_counter() - start)
+        if replacement is not None:
+            # A power levels event was replaced with one that repairs the room.
+            api.sent.append(replacement)
+
+        stats.events += 1
+        if event.type == EventTypes.Member and event.membership == Membership.LEAVE:
+            stats.leaves += 1
+        stats.sent += len(api.sent)
+        stats.state_events_built += state.events_built
+
+        if output is not None:
+            for event_dict in api.sent:
+                sent = {
+                    "line": line_number,
+                    "event_id": event.event_id,
+                    "sent": event_dict,
+                }
+                output.write(json.dumps(sent) + "\n")
+
+    stats.elapsed = time.perf_counter() - replay_start
+    return stats
+
+
+def _run(awaitable: Awaitable[T]) -> T:
+    """Runs a coroutine which never has to wait on anything, which is the case when
+    the module runs against a RecordingModuleApi, without an event loop.
+    """
+    coroutine = awaitable.__await__()
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return cast(T, e.value)
+    raise RuntimeError("The module had to wait while replaying an event")
+
+
+def _read_lines(paths: List[str]) -> Iterator[str]:
+    """Reads the lines of the given files one at a time, "-" meaning the standard
+    input.
+    """
+    for path in paths:
+        if path == "-":
+            yield from sys.stdin
+            continue
+
+        with open(path) as f:
+            yield from f
+
+
+def main(argv: Optional[List[str]] = None, stdout: TextIO = sys.stdout) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help='The JSON lines files to replay, or "-" for the standard input.',
+    )
+    parser.add_argument(
+        "--config",
+        help="A YAML file with the configuration of the module.",
+    )
+    parser.add_argument(
+        "--server-name",
+        default="example.com",
+        help="The name of the homeserver the module runs on.",
+    )
+    parser.add_argument(
+        "--output",
+        help="Where to write the power levels events the module would have sent.",
+    )
+    args = parser.parse_args(argv)
+
+    raw_config: Dict[str, Any] = {}
+    if args.config is not None:
+        with open(args.config) as f:
+            raw_config = yaml.safe_load(f) or {}
+    # Repairs are replayed inline, and there's no database to sweep, retry repairs from
+    # or warm caches up from, nor accounts to deactivate.
+    raw_config.update(
+        repair_in_background=False,
+        sweeper_enabled=False,
+        retry_failed_repairs=False,
+        warmup_enabled=False,
+        batch_deactivations=False,
+        slow_sampler_threshold_ms=None,
+    )
+
+    api = RecordingModuleApi(args.server_name)
+    module = ManageLastAdmin(
+        ManageLastAdmin.parse_config(raw_config), cast(ModuleApi, api)
+    )
+
+    output = open(args.output, "w") if args.output is not None else None
+    try:
+        stats = replay(module, api, _read_lines(args.inputs), output)
+    finally:
+        if output is not None:
+            output.close()
+
+    stdout.write(stats.summary() + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
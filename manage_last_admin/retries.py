@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import logging
+import random
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable, Final, List, Optional, Tuple, TypeVar, cast
+
+import attr
+from synapse.api.room_versions import KNOWN_ROOM_VERSIONS
+from synapse.events import EventBase, make_event_from_dict
+from synapse.module_api import ModuleApi
+from synapse.storage.database import LoggingTransaction
+from synapse.util.async_helpers import concurrently_execute
+
+from manage_last_admin import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# The table storing the repairs to retry.
+PENDING_REPAIRS_TABLE = "manage_last_admin_pending_repairs"
+
+
+class RetryResult:
+    """What came out of retrying a repair, when it didn't fail."""
+
+    # The new power levels event was sent.
+    REPAIRED: Final = "succeeded"
+    # The room has an admin again, without the module's help.
+    NOT_NEEDED: Final = "not_needed"
+    # The room still has no admin, but the module can't repair it, e.g. because the
+    # admin whose leave triggered the repair isn't in the room anymore.
+    UNREPAIRABLE: Final = "abandoned"
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class PendingRepair:
+    """A repair waiting to be retried."""
+
+    room_id: str
+    # The version of the room, and the JSON of the leave event that triggered the
+    # repair, so the event can be rebuilt.
+    room_version: str
+    event_json: str
+    # How many times the repair was retried so far.
+    attempts: int
+
+    def get_event(self) -> EventBase:
+        return make_event_from_dict(
+            json.loads(self.event_json), KNOWN_ROOM_VERSIONS[self.room_version]
+        )
+
+
+class RepairRetryQueue:
+    """Stores the repairs that failed, and retries them with exponential backoff.
+
+    Repairs are stored in a table of Synapse's database, or of a local SQLite database
+    if a path is given, so they survive restarts. Due repairs are retried in batches,
+    with a bounded number of them running at once, so a lot of repairs failing during an
+    outage don't all hit the homeserver at the same time once it's over.
+
+    There's at most one pending repair per room: a room only needs to be repaired once,
+    and each attempt works from the room's current state.
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        retry_repair: Callable[[EventBase], Awaitable[str]],
+        database_path: Optional[str],
+        base_delay_ms: int,
+        max_delay_ms: int,
+        max_attempts: int,
+        batch_size: int,
+        concurrency: int,
+    ):
+        """
+        Args:
+            api: The module API.
+            retry_repair: Retries the repair triggered by the given leave event. Returns
+                why there's nothing left to retry, see RetryResult, or raises if the
+                repair failed.
+            database_path: The path of the SQLite database to store repairs in, or None
+                to store them in Synapse's database.
+            base_delay_ms: How long to wait before the first retry.
+            max_delay_ms: The maximum time to wait between two retries.
+            max_attempts: After how many retries to give up.
+            batch_size: The maximum number of repairs retried per batch.
+            concurrency: The maximum number of repairs retried at once.
+        """
+        self._api = api
+        self._retry_repair = retry_repair
+        self._base_delay_ms = base_delay_ms
+        self._max_delay_ms = max_delay_ms
+        self._max_attempts = max_attempts
+        self._batch_size = batch_size
+        self._concurrency = concurrency
+
+        self._connection: Optional[sqlite3.Connection] = None
+        if database_path is not None:
+            self._connection = sqlite3.connect(database_path)
+
+        self._tables_created = False
+        self._processing = False
+
+    def start(self, interval_ms: int) -> None:
+        """Looks for due repairs every interval_ms milliseconds.
+
+        Args:
+            interval_ms: How long to wait between two batches of retries.
+        """
+        self._api.looping_background_call(
+            self.process,
+            interval_ms,
+            desc="manage_last_admin_retry_repairs",
+        )
+
+    async def schedule(self, event: EventBase, error: str) -> None:
+        """Stores a failed repair, to be retried after the initial delay.
+
+        Args:
+            event: The leave event that triggered the repair.
+            error: Why the repair failed.
+        """
+        await self._create_tables()
+        await self._run_interaction(
+            "manage_last_admin_schedule_repair",
+            _store_repair_txn,
+            PendingRepair(
+                room_id=event.room_id,
+                room_version=event.room_version.identifier,
+                event_json=json.dumps(event.get_dict()),
+                attempts=0,
+            ),
+            self._next_attempt_ts(0),
+            error,
+        )
+        logger.info("Repair of room %s failed, will retry: %s", event.room_id, error)
+
+    async def process(self) -> None:
+        """Retries one batch of due repairs."""
+        if self._processing:
+            # The previous batch is still running.
+            return
+
+        self._processing = True
+        try:
+            await self._create_tables()
+            repairs = await self._run_interaction(
+                "manage_last_admin_get_due_repairs",
+                _get_due_repairs_txn,
+                int(time.time() * 1000),
+                self._batch_size,
+            )
+            await concurrently_execute(self._retry, repairs, self._concurrency)
+        finally:
+            self._processing = False
+
+    async def _retry(self, repair: PendingRepair) -> None:
+        """Retries a repair, and stores when to try again if it fails.
+
+        Args:
+            repair: The repair to retry.
+        """
+        result: Optional[str] = None
+        try:
+            result = await self._retry_repair(repair.get_event())
+        except Exception as e:
+            logger.exception("Failed to retry repair of room %s", repair.room_id)
+            error = str(e)
+
+        attempts = repair.attempts + 1
+        if result is not None:
+            metrics.repair_retries.labels(result).inc()
+        elif attempts >= self._max_attempts:
+            metrics.repair_retries.labels("abandoned").inc()
+            logger.error(
+                "Giving up on repairing room %s after %d attempts: %s",
+                repair.room_id,
+                attempts,
+                error,
+            )
+        else:
+            metrics.repair_retries.labels("failed").inc()
+            await self._run_interaction(
+                "manage_last_admin_reschedule_repair",
+                _store_repair_txn,
+                attr.evolve(repair, attempts=attempts),
+                self._next_attempt_ts(attempts),
+                error,
+            )
+            return
+
+        await self._run_interaction(
+            "manage_last_admin_delete_repair",
+            _delete_repair_txn,
+            repair.room_id,
+        )
+
+    def _next_attempt_ts(self, attempts: int) -> int:
+        """Works out when to try a repair again, with exponential backoff and jitter.
+
+        Args:
+            attempts: How many times the repair was retried so far.
+
+        Returns:
+            The time of the next attempt, in milliseconds since the epoch.
+        """
+        delay = min(self._max_delay_ms, self._base_delay_ms * 2**attempts)
+        # Only wait for a random half of the delay, so repairs that failed together are
+        # spread out when they're retried.
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        return int(time.time() * 1000 + delay)
+
+    async def _run_interaction(
+        self, desc: str, func: Callable[..., T], *args: Any
+    ) -> T:
+        """Runs the given function in a transaction, with the transaction as its first
+        argument followed by args.
+        """
+        if self._connection is None:
+            return await self._api.run_db_interaction(desc, func, *args)
+
+        # The queries are small, and SQLite is local, so run them right away.
+        with self._connection:
+            cursor = self._connection.cursor()
+            # sqlite3's cursors implement what the transaction functions use of
+            # LoggingTransaction.
+            return func(cast(LoggingTransaction, cursor), *args)
+
+    async def _create_tables(self) -> None:
+        """Creates the table storing pending repairs, if it doesn't already exist."""
+        if self._tables_created:
+            return
+
+        await self._run_interaction(
+            "manage_last_admin_create_pending_repairs_table",
+            _create_tables_txn,
+        )
+        self._tables_created = True
+
+
+def _create_tables_txn(txn: LoggingTransaction) -> None:
+    txn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {PENDING_REPAIRS_TABLE} (
+            room_id TEXT PRIMARY KEY,
+            room_version TEXT NOT NULL,
+            event_json TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            next_attempt_ts BIGINT NOT NULL,
+            last_error TEXT NOT NULL
+        )
+        """
+    )
+
+
+def _store_repair_txn(
+    txn: LoggingTransaction, repair: PendingRepair, next_attempt_ts: int, error: str
+) -> None:
+    txn.execute(
+        f"DELETE FROM {PENDING_REPAIRS_TABLE} WHERE room_id = ?", (repair.room_id,)
+    )
+    txn.execute(
+        f"""
+        INSERT INTO {PENDING_REPAIRS_TABLE}
+            (room_id, room_version, event_json, attempts, next_attempt_ts, last_error)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (
+            repair.room_id,
+            repair.room_version,
+            repair.event_json,
+            repair.attempts,
+            next_attempt_ts,
+            error,
+        ),
+    )
+
+
+def _get_due_repairs_txn(
+    txn: LoggingTransaction, now_ms: int, limit: int
+) -> List[PendingRepair]:
+    txn.execute(
+        f"""
+        SELECT room_id, room_version, event_json, attempts FROM {PENDING_REPAIRS_TABLE}
+        WHERE next_attempt_ts <= ?
+        ORDER BY next_attempt_ts
+        LIMIT ?
+        """,
+        (now_ms, limit),
+    )
+    rows = cast(List[Tuple[str, str, str, int]], txn.fetchall())
+    return [
+        PendingRepair(
+            room_id=room_id,
+            room_version=room_version,
+            event_json=event_json,
+            attempts=attempts,
+        )
+        for room_id, room_version, event_json, attempts in rows
+    ]
+
+
+def _delete_repair_txn(txn: LoggingTransaction, room_id: str) -> None:
+    txn.execute(f"DELETE FROM {PENDING_REPAIRS_TABLE} WHERE room_id = ?", (room_id,))
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import json
+import logging
+import os
+import secrets
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import yaml
+from synapse.api.constants import EventTypes
+from synapse.api.room_versions import EventFormatVersions
+from synapse.events import EventBase
+from synapse.module_api import ModuleApi, run_as_background_process
+from synapse.types import JsonDict, StateMap
+
+from manage_last_admin import metrics
+
+logger = logging.getLogger(__name__)
+
+# The directory the module is imported from.
+_PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# How long to let the replay producing the profile of a sample run for, in seconds.
+PROFILE_TIMEOUT = 60
+
+# The state event types, other than memberships and power levels, the module looks at,
+# with the parts of their content it uses.
+_ROOM_TYPE_EVENTS = {
+    EventTypes.RoomEncryption: "algorithm",
+    "im.vector.room.access_rules": "rule",
+}
+
+
+class SlowInvocationSampler:
+    """Captures the calls to check_event_allowed that take longer than a threshold, for
+    offline analysis.
+
+    Nothing is recorded while a call runs, so calls under the threshold only cost a
+    comparison. Once a call goes over it, its inputs are scrubbed of personal data and
+    written in the format of the replay tool (see manage_last_admin.replay), along with
+    the module's configuration, and the replay tool is run on them under cProfile in a
+    separate process, all in Synapse's thread pool. The profile is of this replay, not
+    of the slow call itself: it covers the module's own work on these inputs with cold
+    caches, not the time spent waiting on the homeserver.
+
+    Only the most recent samples are kept in the directory, and samples are taken at
+    most once per min_interval_ms so a slow homeserver doesn't fill it with profiles.
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        get_room_type: Callable[[str, StateMap[EventBase]], str],
+        config: Dict[str, Any],
+        threshold_ms: int,
+        directory: str,
+        max_samples: int,
+        min_interval_ms: int,
+    ):
+        """
+        Args:
+            api: The module API.
+            get_room_type: Returns the type of the given room, see RoomType.
+            config: The configuration to replay samples with, as it would be written in
+                Synapse's configuration file.
+            threshold_ms: From how long a call to check_event_allowed is sampled.
+            directory: Where to write samples.
+            max_samples: How many samples to keep.
+            min_interval_ms: The minimum time between two samples.
+        """
+        self._api = api
+        self._get_room_type = get_room_type
+        self._config = config
+        self._threshold = threshold_ms / 1000
+        self._directory = directory
+        self._max_samples = max_samples
+        self._min_interval = min_interval_ms / 1000
+
+        self._last_sample = -float("inf")
+
+    def maybe_sample(
+        self,
+        event: EventBase,
+        state_events: StateMap[EventBase],
+        outcome: str,
+        elapsed: float,
+    ) -> None:
+        """Samples a call to check_event_allowed in the background if it took longer
+        than the threshold.
+
+        Args:
+            event: The event the call checked.
+            state_events: The state of the room the call was given.
+            outcome: The outcome of the call, see LeaveOutcome.
+            elapsed: How long the call took, in seconds.
+        """
+        if elapsed < self._threshold:
+            return
+
+        now = time.monotonic()
+        if now - self._last_sample < self._min_interval:
+            return
+        self._last_sample = now
+
+        run_as_background_process(
+            "manage_last_admin_sample_slow_invocation",
+            self.sample,
+            event,
+            state_events,
+            outcome,
+            elapsed,
+        )
+
+    async def sample(
+        self,
+        event: EventBase,
+        state_events: StateMap[EventBase],
+        outcome: str,
+        elapsed: float,
+    ) -> str:
+        """Writes a sample of a call to check_event_allowed, see maybe_sample.
+
+        Returns:
+            The path of the sample's capture, without its extension. The capture is
+            written to <path>.jsonl, the configuration to <path>.yaml and the profile
+            to <path>.prof.
+        """
+        from manage_last_admin import RoomType
+
+        room_type = self._get_room_type(event.room_id, state_events)
+        # Capturing the inputs looks at, and hashes, every member of some rooms, so it
+        # is done in the thread pool along with the profiling rather than on the
+        # reactor.
+        path = await self._api.defer_to_thread(
+            self._write_sample,
+            event,
+            state_events,
+            room_type,
+            # These rooms are repaired by promoting their members.
+            room_type in (RoomType.UNKNOWN, RoomType.EXTERNAL),
+            outcome,
+            elapsed,
+        )
+        metrics.slow_invocations_sampled.inc()
+        return path
+
+    def _write_sample(
+        self,
+        event: EventBase,
+        state_events: StateMap[EventBase],
+        room_type: str,
+        all_members: bool,
+        outcome: str,
+        elapsed: float,
+    ) -> str:
+        """Captures the inputs of a call to check_event_allowed, writes them along with
+        the configuration, then profiles their replay. Blocks, so is run in a thread.
+
+        Args:
+            event: The event the call checked.
+            state_events: The state of the room the call was given.
+            room_type: The type of the room, see RoomType.
+            all_members: Whether to capture the membership of every member of the room,
+                see capture_inputs.
+            outcome: The outcome of the call, see LeaveOutcome.
+            elapsed: How long the call took, in seconds.
+
+        Returns:
+            The path of the sample's capture, without its extension.
+        """
+        capture = capture_inputs(event, state_events, all_members=all_members)
+        capture.update(
+            room_type=room_type, outcome=outcome, elapsed_ms=round(elapsed * 1000, 3)
+        )
+
+        os.makedirs(self._directory, exist_ok=True)
+        path = os.path.join(
+            self._directory,
+            f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(4)}",
+        )
+        with open(path + ".jsonl", "w") as f:
+            f.write(json.dumps(capture) + "\n")
+        with open(path + ".yaml", "w") as f:
+            yaml.safe_dump(self._config, f)
+
+        logger.warning(
+            "Checking event %s in room %s took %.0fms, captured in %s.jsonl",
+            event.event_id,
+            event.room_id,
+            elapsed * 1000,
+            path,
+        )
+
+        self._profile(path)
+        self._rotate()
+        return path
+
+    def _profile(self, path: str) -> None:
+        """Replays a capture under cProfile, in a separate process so it doesn't share
+        the caches or the metrics of the running module.
+
+        Args:
+            path: The path of the capture, without its extension.
+        """
+        # Make sure the replay runs the same copy of the module as this one.
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [_PACKAGE_ROOT, env.get("PYTHONPATH")])
+        )
+        try:
+            result = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "cProfile",
+                    "-o",
+                    path + ".prof",
+                    "-m",
+                    "manage_last_admin.replay",
+                    "--config",
+                    path + ".yaml",
+                    "--server-name",
+                    self._api.server_name,
+                    path + ".jsonl",
+                ],
+                env=env,
+                capture_output=True,
+                text=True,
+                timeout=PROFILE_TIMEOUT,
+            )
+        except subprocess.TimeoutExpired:
+            logger.warning("Timed out profiling %s.jsonl", path)
+            return
+
+        if result.returncode != 0:
+            logger.warning("Failed to profile %s.jsonl: %s", path, result.stderr)
+
+    def _rotate(self) -> None:
+        """Deletes the oldest samples, so only max_samples of them are kept."""
+        names = sorted(
+            name[: -len(".jsonl")]
+            for name in os.listdir(self._directory)
+            if name.endswith(".jsonl")
+        )
+        for name in names[: max(0, len(names) - self._max_samples)]:
+            for extension in (".jsonl", ".yaml", ".prof"):
+                try:
+                    os.remove(os.path.join(self._directory, name + extension))
+                except FileNotFoundError:
+                    pass
+
+
+class _Scrubber:
+    """Replaces the localparts of the IDs in a capture with hashes.
+
+    Domains are kept, as the module's decisions depend on them. The hashes are salted
+    with a random salt for each capture, so IDs can't be matched across captures.
+    """
+
+    def __init__(self) -> None:
+        self._salt = secrets.token_bytes(16)
+
+    def id(self, sigil: str, matrix_id: str) -> str:
+        localpart, _, domain = matrix_id[1:].partition(":")
+        digest = hashlib.sha256(self._salt + localpart.encode()).hexdigest()[:16]
+        return f"{sigil}{digest}:{domain}" if domain else f"{sigil}{digest}"
+
+    def user_id(self, user_id: str) -> str:
+        return self.id("@", user_id)
+
+    def content(self, event: EventBase) -> JsonDict:
+        """Keeps only the parts of the event's content the module uses."""
+        content = event.content
+        if event.type == EventTypes.Member:
+            return {"membership": content.get("membership")}
+
+        if event.type == EventTypes.PowerLevels:
+            scrubbed = dict(content)
+            if isinstance(content.get("users"), dict):
+                scrubbed["users"] = {
+                    self.user_id(user_id): level
+                    for user_id, level in content["users"].items()
+                }
+            return scrubbed
+
+        key = _ROOM_TYPE_EVENTS.get(event.type)
+        return {key: content[key]} if key is not None and key in content else {}
+
+    def event(self, event: EventBase) -> JsonDict:
+        scrubbed = {
+            "room_id": self.id("!", event.room_id),
+            "sender": self.user_id(event.sender),
+            "type": event.type,
+            "content": self.content(event),
+        }
+        if event.is_state():
+            scrubbed["state_key"] = (
+                self.user_id(event.state_key)
+                if event.type == EventTypes.Member
+                else event.state_key
+            )
+        if event.room_version.event_format == EventFormatVersions.ROOM_V1_V2:
+            # The ID of the event isn't derived from its content in these versions.
+            scrubbed["event_id"] = self.id("$", event.event_id)
+        return scrubbed
+
+
+def capture_inputs(
+    event: EventBase,
+    state_events: StateMap[EventBase],
+    all_members: bool = False,
+) -> JsonDict:
+    """Captures what the module looks at when checking an event, in the format of the
+    replay tool, with the localparts of user and room IDs replaced with hashes.
+
+    Args:
+        event: The event being checked.
+        state_events: The state of the room the event was checked against.
+        all_members: Whether to capture the membership of every member of the room,
+            rather than only the ones of the users listed in the power levels and of
+            the users the event is about.
+
+    Returns:
+        The capture, as a line of the replay tool's input.
+    """
+    keys: List[Tuple[str, str]] = [(EventTypes.PowerLevels, "")]
+    keys.extend((event_type, "") for event_type in _ROOM_TYPE_EVENTS)
+
+    if all_members:
+        keys.extend(key for key in state_events if key[0] == EventTypes.Member)
+    else:
+        users: Set[str] = {event.sender}
+        if event.is_state() and event.type == EventTypes.Member:
+            users.add(event.state_key)
+        for pl_event in (state_events.get((EventTypes.PowerLevels, "")), event):
+            if pl_event is not None and pl_event.type == EventTypes.PowerLevels:
+                pl_users = pl_event.content.get("users")
+                if isinstance(pl_users, dict):
+                    users.update(pl_users)
+        keys.extend((EventTypes.Member, user_id) for user_id in sorted(users))
+
+    scrubber = _Scrubber()
+    state: List[JsonDict] = []
+    for key in keys:
+        state_event: Optional[EventBase] = state_events.get(key)
+        if state_event is not None:
+            state.append(scrubber.event(state_event))
+
+    return {
+        "room_version": event.room_version.identifier,
+        "event": scrubber.event(event),
+        "state": state,
+    }
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import time
+from typing import Any, Awaitable, Callable, List, TypeVar
+
+from synapse.module_api import ModuleApi
+from synapse.storage.database import LoggingTransaction
+from synapse.util.async_helpers import concurrently_execute
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# The table storing the ID of the last room the sweeper looked at.
+SWEEPER_POSITION_TABLE = "manage_last_admin_sweeper_position"
+# The table storing the rooms the sweeper found without an admin.
+ORPHANED_ROOMS_TABLE = "manage_last_admin_orphaned_rooms"
+
+
+class OrphanedRoomSweeper:
+    """Goes through every room with local members, looking for rooms that don't have
+    any admin left.
+
+    Rooms are visited in the order of their IDs, one page at a time, and the ID of the
+    last room of each page is stored in the database so a restart resumes the sweep
+    where it stopped. Once every room has been visited, the next sweep starts over.
+
+    Rooms found without an admin are logged and stored in the orphaned rooms table.
+    They can't be repaired automatically: changing a room's power levels requires a
+    joined member with a high enough power level, which is exactly what these rooms
+    lack.
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        is_room_orphaned: Callable[[str], Awaitable[bool]],
+        batch_size: int,
+        concurrency: int,
+        rooms_per_second: float,
+    ):
+        self._api = api
+        self._is_room_orphaned = is_room_orphaned
+        self._batch_size = batch_size
+        self._concurrency = concurrency
+        self._rooms_per_second = rooms_per_second
+
+        self._tables_created = False
+        self._sweeping = False
+
+        # How many rooms were checked, and how many of them turned out to be orphaned,
+        # since the module started.
+        self.rooms_checked = 0
+        self.orphaned_rooms = 0
+
+    def start(self, interval_ms: int) -> None:
+        """Schedules a sweep every interval_ms milliseconds.
+
+        Args:
+            interval_ms: How long to wait between two sweeps.
+        """
+        self._api.looping_background_call(
+            self.sweep,
+            interval_ms,
+            desc="manage_last_admin_sweep",
+        )
+
+    async def sweep(self) -> None:
+        """Checks every room after the stored position, one page at a time, until all
+        rooms have been checked.
+        """
+        if self._sweeping:
+            # The previous sweep is still running.
+            return
+
+        self._sweeping = True
+        try:
+            await self._create_tables()
+
+            while await self._sweep_page():
+                pass
+        finally:
+            self._sweeping = False
+
+    async def _sweep_page(self) -> bool:
+        """Checks the next page of rooms, and stores the new position.
+
+        Returns:
+            Whether there may be more rooms to check.
+        """
+        start = time.monotonic()
+
+        last_room_id = await self._run_db_interaction(
+            "manage_last_admin_get_sweeper_position",
+            _get_position_txn,
+        )
+        room_ids = await self._run_db_interaction(
+            "manage_last_admin_get_rooms_to_sweep",
+            _get_rooms_to_sweep_txn,
+            last_room_id,
+            self._batch_size,
+        )
+
+        await concurrently_execute(self._check_room, room_ids, self._concurrency)
+
+        # If this page is the last one, the next sweep starts over.
+        more_rooms = len(room_ids) == self._batch_size
+        await self._run_db_interaction(
+            "manage_last_admin_set_sweeper_position",
+            _set_position_txn,
+            room_ids[-1] if more_rooms else "",
+        )
+        if not more_rooms:
+            logger.info(
+                "Finished sweeping rooms, %d orphaned rooms found so far",
+                self.orphaned_rooms,
+            )
+            return False
+
+        # Don't check rooms faster than the configured rate.
+        remaining = len(room_ids) / self._rooms_per_second - (time.monotonic() - start)
+        if remaining > 0:
+            await self._api.sleep(remaining)
+
+        return True
+
+    async def _check_room(self, room_id: str) -> None:
+        """Checks whether the given room has an admin left, and records it if not.
+
+        Args:
+            room_id: The room to check.
+        """
+        try:
+            orphaned = await self._is_room_orphaned(room_id)
+        except Exception as e:
+            logger.exception("Failed to check room %s for admins: %s", room_id, e)
+            return
+
+        self.rooms_checked += 1
+        if not orphaned:
+            return
+
+        self.orphaned_rooms += 1
+        logger.warning("Room %s doesn't have any admin left", room_id)
+        await self._run_db_interaction(
+            "manage_last_admin_record_orphaned_room",
+            _record_orphaned_room_txn,
+            room_id,
+            int(time.time() * 1000),
+        )
+
+    def _run_db_interaction(
+        self, desc: str, func: Callable[..., T], *args: Any
+    ) -> Awaitable[T]:
+        """Runs the given function in a database transaction, with the transaction as
+        its first argument followed by args.
+        """
+        return self._api.run_db_interaction(desc, func, *args)
+
+    async def _create_tables(self) -> None:
+        """Creates the tables used by the sweeper, if they don't already exist."""
+        if self._tables_created:
+            return
+
+        await self._run_db_interaction(
+            "manage_last_admin_create_sweeper_tables",
+            _create_tables_txn,
+        )
+        self._tables_created = True
+
+
+def _create_tables_txn(txn: LoggingTransaction) -> None:
+    txn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {SWEEPER_POSITION_TABLE} (
+            id INTEGER PRIMARY KEY,
+            last_room_id TEXT NOT NULL
+        )
+        """
+    )
+    txn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {ORPHANED_ROOMS_TABLE} (
+            room_id TEXT PRIMARY KEY,
+            detected_ts BIGINT NOT NULL
+        )
+        """
+    )
+
+
+def _get_position_txn(txn: LoggingTransaction) -> str:
+    txn.execute(f"SELECT last_room_id FROM {SWEEPER_POSITION_TABLE} WHERE id = 0")
+    row = txn.fetchone()
+    return str(row[0]) if row is not None else ""
+
+
+def _set_position_txn(txn: LoggingTransaction, last_room_id: str) -> None:
+    txn.execute(
+        f"UPDATE {SWEEPER_POSITION_TABLE} SET last_room_id = ? WHERE id = 0",
+        (last_room_id,),
+    )
+    if txn.rowcount == 0:
+        txn.execute(
+            f"INSERT INTO {SWEEPER_POSITION_TABLE} (id, last_room_id) VALUES (0, ?)",
+            (last_room_id,),
+        )
+
+
+def _get_rooms_to_sweep_txn(
+    txn: LoggingTransaction, last_room_id: str, limit: int
+) -> List[str]:
+    txn.execute(
+        """
+        SELECT DISTINCT room_id FROM local_current_membership
+        WHERE membership = 'join' AND room_id > ?
+        ORDER BY room_id
+        LIMIT ?
+        """,
+        (last_room_id, limit),
+    )
+    return [row[0] for row in txn.fetchall()]
+
+
+def _record_orphaned_room_txn(
+    txn: LoggingTransaction, room_id: str, detected_ts: int
+) -> None:
+    txn.execute(f"DELETE FROM {ORPHANED_ROOMS_TABLE} WHERE room_id = ?", (room_id,))
+    txn.execute(
+        f"INSERT INTO {ORPHANED_ROOMS_TABLE} (room_id, detected_ts) VALUES (?, ?)",
+        (room_id, detected_ts),
+    )
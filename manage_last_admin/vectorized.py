@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Selection of the users to promote with NumPy, for rooms with a lot of members.
+
+NumPy is an optional dependency: if it isn't installed, AVAILABLE is False and the
+module only uses its pure-Python implementation.
+"""
+import sys
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, List, Mapping, Sequence, Tuple
+
+from synapse.api.constants import Membership
+
+try:
+    import numpy as np
+
+    AVAILABLE = True
+except ImportError:  # pragma: no cover
+    AVAILABLE = False
+
+if TYPE_CHECKING:
+    from manage_last_admin import DomainMatcher, PowerLevelsView
+
+# Below this many users, the users with a given level are looked at without NumPy,
+# whose fixed cost is higher than looking each of them up.
+SMALL_TIER_SIZE = 64
+
+_ACTIVE_MEMBERSHIPS = (Membership.JOIN, Membership.INVITE)
+
+
+class PowerLevelsArrays:
+    """The users listed in a power levels event, as arrays.
+
+    Users are sorted by power level, from highest to lowest, and keep the order of the
+    power levels event's content within each level, so selections follow the same order
+    as the pure-Python implementation.
+    """
+
+    __slots__ = ("user_ids", "users", "tiers", "allowed")
+
+    def __init__(
+        self, power_levels: "PowerLevelsView", forbidden_domains: "DomainMatcher"
+    ):
+        self.user_ids = [
+            sys.intern(user_id)
+            for _, user_ids in power_levels.levels
+            for user_id in user_ids
+        ]
+        self.users: Any = np.array(self.user_ids, dtype=object)
+        # Each user-specific level, from highest to lowest, with the slice of the arrays
+        # holding the users that have it. Levels are kept as Python integers, as they
+        # can be larger than what NumPy's integer types hold.
+        self.tiers: List[Tuple[int, slice]] = []
+        start = 0
+        for level, user_ids in power_levels.levels:
+            self.tiers.append((level, slice(start, start + len(user_ids))))
+            start += len(user_ids)
+        # Whether each user isn't from a forbidden domain.
+        self.allowed: Any = _allowed_mask(self.user_ids, forbidden_domains)
+
+
+class VectorizedEngine:
+    """Selects users to promote with masked reductions over arrays built once per power
+    levels event.
+    """
+
+    def __init__(self, cache_size: int, forbidden_domains: "DomainMatcher"):
+        self._cache_size = cache_size
+        self._forbidden_domains = forbidden_domains
+        self._arrays: "OrderedDict[str, PowerLevelsArrays]" = OrderedDict()
+
+    def get_arrays(self, power_levels: "PowerLevelsView") -> PowerLevelsArrays:
+        """Returns the arrays for the given power levels, building them if needed."""
+        arrays = self._arrays.get(power_levels.event_id)
+        if arrays is None:
+            arrays = PowerLevelsArrays(power_levels, self._forbidden_domains)
+            self._arrays[power_levels.event_id] = arrays
+            while len(self._arrays) > self._cache_size:
+                self._arrays.popitem(last=False)
+        else:
+            self._arrays.move_to_end(power_levels.event_id)
+        return arrays
+
+    def get_users_with_highest_nondefault_pl(
+        self,
+        power_levels: "PowerLevelsView",
+        memberships: Mapping[str, str],
+        ignore_user: str,
+    ) -> Tuple[List[str], List[str]]:
+        """Same as manage_last_admin._get_users_with_highest_nondefault_pl, followed by
+        manage_last_admin._filter_out_users_from_forbidden_domain with the engine's
+        forbidden domains.
+
+        Returns:
+            The users with the highest non-default power level, and the ones among them
+            which aren't from a forbidden domain.
+        """
+        return select_users_with_highest_nondefault_pl(
+            self.get_arrays(power_levels),
+            power_levels.users_default,
+            memberships,
+            ignore_user,
+        )
+
+
+def select_users_with_highest_nondefault_pl(
+    arrays: PowerLevelsArrays,
+    users_default: int,
+    memberships: Mapping[str, str],
+    ignore_user: str,
+) -> Tuple[List[str], List[str]]:
+    """See VectorizedEngine.get_users_with_highest_nondefault_pl.
+
+    Like the pure-Python implementation, levels are looked at from highest to lowest,
+    and the membership of the users with a level is only looked up if no user with a
+    higher level is in, or invited to, the room. This doesn't use the engine's cache,
+    so it can run in a thread.
+    """
+    for level, tier in arrays.tiers:
+        # Stop if we've reached the default power level (or lower).
+        if level <= users_default:
+            break
+
+        if tier.stop - tier.start < SMALL_TIER_SIZE:
+            positions = [
+                i
+                for i in range(tier.start, tier.stop)
+                if arrays.user_ids[i] != ignore_user
+                and memberships.get(arrays.user_ids[i]) in _ACTIVE_MEMBERSHIPS
+            ]
+            if not positions:
+                continue
+
+            return (
+                [arrays.user_ids[i] for i in positions],
+                [arrays.user_ids[i] for i in positions if arrays.allowed[i]],
+            )
+
+        users = arrays.users[tier]
+        mask = _active_mask(users, memberships)
+        mask &= users != ignore_user
+        if not mask.any():
+            continue
+
+        return list(users[mask]), list(users[mask & arrays.allowed[tier]])
+
+    return [], []
+
+
+def _active_mask(users: Any, memberships: Mapping[str, str]) -> Any:
+    """Returns a mask of the users which are in, or invited to, the room."""
+    # Look the memberships up without going through Python code for each user.
+    codes = np.fromiter(map(memberships.get, users), dtype=object, count=len(users))
+    return (codes == Membership.JOIN) | (codes == Membership.INVITE)
+
+
+def _allowed_mask(user_ids: Sequence[str], forbidden_domains: "DomainMatcher") -> Any:
+    """Returns a mask of the given users which aren't from a forbidden domain."""
+    if not forbidden_domains:
+        return np.ones(len(user_ids), dtype=bool)
+
+    # Match each distinct domain once.
+    domain_ids: Dict[str, int] = {}
+    ids = np.fromiter(
+        (
+            domain_ids.setdefault(user_id.partition(":")[2], len(domain_ids))
+            for user_id in user_ids
+        ),
+        dtype=np.intp,
+        count=len(user_ids),
+    )
+    allowed = np.array(
+        [not forbidden_domains.matches(domain) for domain in domain_ids], dtype=bool
+    )
+    return allowed[ids]
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional, cast
+
+from synapse.module_api import ModuleApi, run_as_background_process
+from synapse.storage.database import LoggingTransaction
+
+from manage_last_admin import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CacheWarmer:
+    """Fills the module's caches for the biggest rooms of the homeserver after it
+    starts, so the first leave in each of them doesn't pay the cost of building them.
+
+    The warm-up runs in the background, at a limited rate, and starts after a delay so
+    it doesn't compete with the homeserver's own startup.
+    """
+
+    def __init__(
+        self,
+        api: ModuleApi,
+        warm_room: Callable[[str], Awaitable[None]],
+        rooms_per_second: float,
+    ):
+        self._api = api
+        self._warm_room = warm_room
+        self._rooms_per_second = rooms_per_second
+
+    def start(
+        self, room_ids: Optional[List[str]], max_rooms: int, delay_ms: int
+    ) -> None:
+        """Starts warming caches up in the background.
+
+        Args:
+            room_ids: The rooms to warm caches up for, or None for the local rooms with
+                the most local members.
+            max_rooms: How many rooms to warm caches up for, if room_ids is None.
+            delay_ms: How long to wait before starting.
+        """
+        run_as_background_process(
+            "manage_last_admin_warm_up",
+            self.warm_up,
+            room_ids,
+            max_rooms,
+            delay_ms,
+        )
+
+    async def warm_up(
+        self, room_ids: Optional[List[str]], max_rooms: int, delay_ms: int = 0
+    ) -> None:
+        """Warms caches up for the given rooms, see start."""
+        if delay_ms:
+            await self._api.sleep(delay_ms / 1000)
+
+        if room_ids is None:
+            # The type of run_db_interaction doesn't account for the transaction the
+            # function is given before the arguments.
+            room_ids = await self._api.run_db_interaction(
+                "manage_last_admin_get_rooms_to_warm_up",
+                cast(Callable[..., List[str]], _get_largest_rooms_txn),
+                max_rooms,
+            )
+
+        metrics.warmup_rooms.labels("total").set(len(room_ids))
+        start = time.monotonic()
+        for warmed, room_id in enumerate(room_ids, start=1):
+            try:
+                await self._warm_room(room_id)
+            except Exception as e:
+                logger.warning("Failed to warm caches up for room %s: %s", room_id, e)
+                metrics.warmup_rooms.labels("failed").inc()
+            else:
+                metrics.warmup_rooms.labels("done").inc()
+
+            # Don't warm rooms up faster than the configured rate.
+            remaining = warmed / self._rooms_per_second - (time.monotonic() - start)
+            if remaining > 0:
+                await self._api.sleep(remaining)
+
+        logger.info("Warmed caches up for %d rooms", len(room_ids))
+
+
+def _get_largest_rooms_txn(txn: LoggingTransaction, limit: int) -> List[str]:
+    txn.execute(
+        """
+        SELECT room_id FROM local_current_membership
+        WHERE membership = 'join'
+        GROUP BY room_id
+        ORDER BY COUNT(*) DESC, room_id
+        LIMIT ?
+        """,
+        (limit,),
+    )
+    return [row[0] for row in txn.fetchall()]
@@ -13,16 +13,56 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Any, Dict, Optional
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple, TypeVar
 from unittest import mock
 
+from synapse.events import EventBase
 from synapse.module_api import ModuleApi, UserID
+from synapse.types import StateMap
 
 from manage_last_admin import ManageLastAdmin
 
+T = TypeVar("T")
+
+
+async def defer_to_thread(f: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Implements ModuleApi.defer_to_thread with the event loop's default executor."""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, lambda: f(*args, **kwargs)
+    )
+
+
+def make_get_room_state(
+    get_state: Callable[[], StateMap[EventBase]]
+) -> Callable[..., Awaitable[StateMap[EventBase]]]:
+    """Returns an implementation of ModuleApi.get_room_state which reads the room's
+    state from the given function, and applies the provided filter to it.
+    """
+
+    async def get_room_state(
+        room_id: str,
+        event_filter: Optional[Iterable[Tuple[str, Optional[str]]]] = None,
+    ) -> StateMap[EventBase]:
+        state = get_state()
+        if event_filter is None:
+            return dict(state)
+
+        event_filter = list(event_filter)
+        return {
+            (event_type, state_key): event
+            for (event_type, state_key), event in state.items()
+            if (event_type, state_key) in event_filter
+            or (event_type, None) in event_filter
+        }
+
+    return get_room_state
+
 
 def create_module(
-    config_override: Optional[Dict[str, Any]] = None, server_name: str = "example.com"
+    config_override: Optional[Dict[str, Any]] = None,
+    server_name: str = "example.com",
+    get_state: Optional[Callable[[], StateMap[EventBase]]] = None,
 ) -> ManageLastAdmin:
     if config_override is None:
         config_override = {}
@@ -35,7 +75,15 @@ def create_module(
     # etc.) are needed for running the tests.
     module_api = mock.Mock(spec=ModuleApi)
     module_api.create_and_send_event_into_room = mock.AsyncMock()
+    module_api.get_room_state = mock.AsyncMock()
+    if get_state is not None:
+        module_api.get_room_state.side_effect = make_get_room_state(get_state)
     module_api.get_qualified_user_id.side_effect = get_qualified_user_id
+    module_api.server_name = server_name
+    module_api.is_mine.side_effect = (
+        lambda user_id: UserID.from_string(user_id).domain == server_name
+    )
+    module_api.defer_to_thread = mock.AsyncMock(side_effect=defer_to_thread)
 
     config = ManageLastAdmin.parse_config(config_override)
 
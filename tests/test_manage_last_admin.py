@@ -16,18 +16,41 @@
 # From Python 3.8 onwards, aiounittest.AsyncTestCase can be replaced by
 # unittest.IsolatedAsyncioTestCase, so we'll be able to get rid of this dependency when
 # we stop supporting Python < 3.8 in Synapse.
+import io
+import json
+import os
+import pstats
+import sqlite3
+import tempfile
+import threading
+import unittest
 from abc import abstractmethod
-from typing import Any, Dict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from unittest import mock
 
 import aiounittest
+from canonicaljson import encode_canonical_json
+from prometheus_client import REGISTRY
 from synapse.api.constants import EventTypes, Membership
 from synapse.api.room_versions import RoomVersions
 from synapse.events import EventBase, make_event_from_dict
-from synapse.types import JsonDict, MutableStateMap
+from synapse.types import JsonDict, MutableStateMap, StateMap
 from synapse.util.stringutils import random_string
+from twisted.internet import defer
 
-from manage_last_admin import ACCESS_RULES_TYPE
-from tests import create_module
+from manage_last_admin import (
+    ACCESS_RULES_TYPE,
+    EVENT_SIZE_HEADROOM,
+    MAX_EVENT_SIZE,
+    ManageLastAdmin,
+    RoomSnapshot,
+    RoomType,
+    _classify_room,
+    replay,
+    sampler,
+    vectorized,
+)
+from tests import create_module, make_get_room_state
 
 
 CONFIG_DOMAINS_FORBIDDEN_WHEN_RESTRICTED=["externe.com"]
@@ -46,6 +69,14 @@ class ManageLastAdminTestCases:
             self.room_id = "!someroom:example.com"
             self.state = self.get_public_room()
 
+        def create_module(
+            self, config_override: Optional[Dict[str, Any]] = None
+        ) -> ManageLastAdmin:
+            """Creates the module, reading the current state of the room from
+            self.state.
+            """
+            return create_module(config_override, get_state=lambda: self.state)
+
         def get_basic_room_state(self) -> MutableStateMap[EventBase]:
             return {
                 (EventTypes.PowerLevels, ""): self.create_event(
@@ -219,7 +250,7 @@ class ManageLastAdminTestCases:
             )
             return state
         async def do_set_room_users_default_when_last_admin_leaves(self) -> None:
-            module = create_module()
+            module = self.create_module()
             leave_event = self.create_event(
                 {
                     "sender": self.user_id,
@@ -244,11 +275,14 @@ class ManageLastAdminTestCases:
             for user, pl in pl_event_dict["content"]["users"].items():
                 self.assertEqual(pl, 100, user)
 
-        async def do_promote_when_last_admin_leaves(self) -> None:
+        async def do_promote_when_last_admin_leaves(
+            self, extra_config: Optional[Dict[str, Any]] = None
+        ) -> ManageLastAdmin:
             # Set the config flag to allow promoting custom PLs before freezing the room.
-            module = create_module(config_override={
+            module = self.create_module(config_override={
                 "promote_moderators": True, 
-                "domains_forbidden_when_restricted":CONFIG_DOMAINS_FORBIDDEN_WHEN_RESTRICTED})
+                "domains_forbidden_when_restricted":CONFIG_DOMAINS_FORBIDDEN_WHEN_RESTRICTED,
+                **(extra_config or {})})
             # Make the last admin leave.
             leave_event = self.create_event(
                 {
@@ -282,6 +316,7 @@ class ManageLastAdminTestCases:
             self.assertEqual(
                 evt_dict["content"]["users"][self.mod_user_id], 100, evt_dict
             )
+            return module
 
         async def do_nothing_when_admin_leaves(self, module: Any) -> None:
             leave_event = self.create_event(
@@ -301,6 +336,55 @@ class ManageLastAdminTestCases:
             # Test that no event is generated
             self.assertFalse(module._api.create_and_send_event_into_room.called)
 
+        def add_admin(
+            self, state: MutableStateMap[EventBase], user_id: str, membership: str
+        ) -> None:
+            """Gives the user an admin power level, and sets their membership."""
+            pl_event = state[(EventTypes.PowerLevels, "")]
+            content = dict(pl_event.content)
+            content["users"] = {**content["users"], user_id: 100}
+            state[(EventTypes.PowerLevels, "")] = self.create_event(
+                {
+                    "sender": self.user_id,
+                    "type": EventTypes.PowerLevels,
+                    "state_key": "",
+                    "content": content,
+                    "room_id": self.room_id,
+                },
+            )
+            self.set_membership(state, user_id, membership)
+
+        def set_membership(
+            self, state: MutableStateMap[EventBase], user_id: str, membership: str
+        ) -> EventBase:
+            member_event = self.create_event(
+                {
+                    "sender": user_id,
+                    "type": EventTypes.Member,
+                    "state_key": user_id,
+                    "content": {"membership": membership},
+                    "room_id": self.room_id,
+                },
+            )
+            state[(EventTypes.Member, user_id)] = member_event
+            return member_event
+
+        async def leave(self, module: Any, user_id: str) -> None:
+            leave_event = self.create_event(
+                {
+                    "sender": user_id,
+                    "type": EventTypes.Member,
+                    "content": {"membership": Membership.LEAVE},
+                    "room_id": self.room_id,
+                    "state_key": user_id,
+                },
+            )
+            allowed, replacement = await module.check_event_allowed(
+                leave_event, self.state
+            )
+            self.assertTrue(allowed)
+            self.assertEqual(replacement, None)
+
         # TEST SCENARIOS #
 
         async def test_set_room_users_default_when_last_admin_leaves_on_public_room(
@@ -338,7 +422,7 @@ class ManageLastAdminTestCases:
 #        ) -> None:
 #            """Tests that the module do not send any event when last member leaves an unknown room."""
 #            self.state = self.get_other_room()
-#            module = create_module()
+#            module = self.create_module()
 #            await self.do_nothing_when_admin_leaves(module)
 
         async def test_promote_when_last_admin_leaves_on_other_room(self) -> None:
@@ -349,6 +433,972 @@ class ManageLastAdminTestCases:
             await self.do_promote_when_last_admin_leaves()
 
 
+        @unittest.skipUnless(vectorized.AVAILABLE, "NumPy isn't installed")
+        async def test_promote_vectorized(self) -> None:
+            """Tests that the module promotes the same users when candidates are selected
+            with NumPy, and that the arrays are built when the power levels event is sent.
+            """
+            module = await self.do_promote_when_last_admin_leaves(
+                {"vectorized_threshold": 1}
+            )
+            engine = module._vectorized
+            assert engine is not None
+            pl_event = self.state[(EventTypes.PowerLevels, "")]
+            self.assertIn(pl_event.event_id, engine._arrays)
+
+            engine._arrays.clear()
+            await module.on_new_event(pl_event, self.state)
+            self.assertIn(pl_event.event_id, engine._arrays)
+
+        async def test_room_snapshot(self) -> None:
+            """Tests that a room snapshot collects everything in a single pass over the
+            room's state.
+            """
+            snapshot = RoomSnapshot.from_state(self.state)
+            self.assertEqual(snapshot.entries_scanned, len(self.state))
+            self.assertEqual(snapshot.room_type, RoomType.PUBLIC)
+            self.assertFalse(snapshot.is_encrypted)
+            self.assertCountEqual(
+                snapshot.joined, [self.user_id, self.mod_user_id, self.regular_user_id]
+            )
+            self.assertEqual(
+                snapshot.get_membership(self.left_user_id), Membership.LEAVE
+            )
+            assert snapshot.power_levels is not None
+            self.assertEqual(snapshot.power_levels.admins, {self.user_id})
+
+            snapshot = RoomSnapshot.from_state(self.get_private_room())
+            self.assertTrue(snapshot.is_encrypted)
+            self.assertEqual(snapshot.room_type, RoomType.PRIVATE)
+
+            snapshot = RoomSnapshot.from_state(self.get_other_room())
+            self.assertEqual(snapshot.access_rule, "unrestricted")
+            self.assertEqual(snapshot.room_type, RoomType.EXTERNAL)
+
+        async def test_room_type_cache(self) -> None:
+            """Tests that the type of a room is cached until its encryption or access
+            rules event changes.
+            """
+            module = self.create_module()
+            self.assertEqual(
+                module.get_room_type(self.room_id, self.state), RoomType.PUBLIC
+            )
+
+            # The room type is only worked out again if one of these events changes.
+            with mock.patch(
+                "manage_last_admin._classify_room", wraps=_classify_room
+            ) as classify_room:
+                self.assertEqual(
+                    module.get_room_type(self.room_id, self.state), RoomType.PUBLIC
+                )
+                self.assertFalse(classify_room.called)
+
+                self.state = self.make_room_private(self.state)
+                self.assertEqual(
+                    module.get_room_type(self.room_id, self.state), RoomType.PRIVATE
+                )
+                self.assertEqual(classify_room.call_count, 1)
+
+                self.state[(ACCESS_RULES_TYPE, "")] = self.create_event(
+                    {
+                        "sender": self.user_id,
+                        "type": ACCESS_RULES_TYPE,
+                        "state_key": "",
+                        "content": {"rule": "unrestricted"},
+                        "room_id": self.room_id,
+                        # Make sure the new event gets a different ID.
+                        "origin_server_ts": 1,
+                    },
+                )
+                self.assertEqual(
+                    module.get_room_type(self.room_id, self.state), RoomType.EXTERNAL
+                )
+                self.assertEqual(classify_room.call_count, 2)
+
+        async def test_promote_too_many_users(self) -> None:
+            """Tests that the module only promotes as many users as it can fit in the new
+            power levels event when the last admin leaves a room with a lot of members.
+            """
+            self.state = self.get_other_room()
+            for i in range(2000):
+                self.set_membership(
+                    self.state,
+                    f"@user_with_a_fairly_long_name_{i}:example.com",
+                    Membership.JOIN,
+                )
+
+            module = self.create_module(config_override={"promote_moderators": False})
+            await self.leave(module, self.user_id)
+
+            args, _ = module._api.create_and_send_event_into_room.call_args  # type: ignore[attr-defined]
+            content = args[0]["content"]
+            self.assertEqual(content["users_default"], 0)
+            self.assertGreater(len(content["users"]), 1000)
+            self.assertLess(len(content["users"]), 2000)
+            self.assertLessEqual(
+                len(encode_canonical_json(content)),
+                MAX_EVENT_SIZE - EVENT_SIZE_HEADROOM,
+            )
+
+        async def test_targeted_state_lookups(self) -> None:
+            """Tests that detecting the last admin leaving only looks up the membership of
+            the users listed in the power levels, and that only member events are fetched
+            when the whole member list is needed.
+            """
+            for i in range(1000):
+                self.set_membership(
+                    self.state, f"@user{i}:example.com", Membership.JOIN
+                )
+
+            module = self.create_module()
+            with mock.patch.object(
+                module, "_report_state_entries_touched"
+            ) as report_state_entries_touched:
+                await self.leave(module, self.user_id)
+
+            # The power levels event, and the members listed in it.
+            _, entries = report_state_entries_touched.call_args[0]
+            self.assertEqual(entries, 5)
+            # Public rooms don't need the member list.
+            self.assertFalse(module._api.get_room_state.called)  # type: ignore[attr-defined]
+
+            self.state = self.make_room_unknown(self.state)
+            self.set_membership(self.state, self.user_id, Membership.JOIN)
+            module = self.create_module()
+            await self.leave(module, self.user_id)
+            module._api.get_room_state.assert_called_once_with(  # type: ignore[attr-defined]
+                self.room_id, [(EventTypes.Member, None)]
+            )
+            args, _ = module._api.create_and_send_event_into_room.call_args  # type: ignore[attr-defined]
+            self.assertIn("@user999:example.com", args[0]["content"]["users"])
+
+        async def test_repair_in_background(self) -> None:
+            """Tests that the leaves of admins are processed in the background when
+            configured to, that the leave of the last admin is only allowed once the
+            room is repaired, and that leaves beyond the concurrency limit are processed
+            inline.
+            """
+            module = self.create_module(
+                config_override={
+                    "repair_in_background": True,
+                    "repair_concurrency": 1,
+                    "repair_coalescing_window_ms": 0,
+                }
+            )
+            # The leaves that were allowed, and so persisted by Synapse, when each power
+            # levels event was sent.
+            persisted: List[str] = []
+            sent_after: List[List[str]] = []
+            send_deferred: "defer.Deferred[None]" = defer.Deferred()
+
+            def send(event_dict: JsonDict) -> "defer.Deferred[None]":
+                sent_after.append(list(persisted))
+                return send_deferred
+
+            module._api.create_and_send_event_into_room = mock.Mock(  # type: ignore[method-assign]
+                side_effect=send
+            )
+
+            # A non-admin leaving doesn't start anything.
+            await self.leave(module, self.regular_user_id)
+            self.assertEqual(len(module._background_repairs), 0)
+
+            # The repair of the first room runs in the background, and its last admin's
+            # leave waits for it.
+            first_leave = defer.ensureDeferred(self.leave(module, self.user_id))
+            first_leave.addCallback(lambda _: persisted.append("!first"))
+            self.assertFalse(first_leave.called)
+            self.assertEqual(len(module._background_repairs), 1)
+            self.assertEqual(
+                REGISTRY.get_sample_value("manage_last_admin_background_repairs"), 1
+            )
+
+            def inline_repairs() -> float:
+                return (
+                    REGISTRY.get_sample_value("manage_last_admin_inline_repairs_total")
+                    or 0
+                )
+
+            # The last admin of another room leaving is processed inline, since the
+            # only worker is busy.
+            before = inline_repairs()
+            self.room_id = "!otherroom:example.com"
+            second_leave = defer.ensureDeferred(self.leave(module, self.user_id))
+            second_leave.addCallback(lambda _: persisted.append("!other"))
+            self.assertFalse(second_leave.called)
+            self.assertEqual(inline_repairs(), before + 1)
+
+            # Both power levels events were sent before any of the leaves went through.
+            send_deferred.callback(None)
+            self.assertEqual(sent_after, [[], []])
+            self.assertCountEqual(persisted, ["!first", "!other"])
+            self.assertEqual(len(module._background_repairs), 0)
+            self.assertEqual(
+                REGISTRY.get_sample_value("manage_last_admin_background_repairs"), 0
+            )
+
+        async def test_repair_in_background_failed(self) -> None:
+            """Tests that the leave of the last admin is rejected when the repair run in
+            the background fails and failed repairs are retried.
+            """
+            with tempfile.TemporaryDirectory() as directory:
+                module = self.create_module(
+                    {
+                        "promote_moderators": True,
+                        "repair_in_background": True,
+                        "retry_failed_repairs": True,
+                        "retry_database_path": os.path.join(directory, "retries.db"),
+                    }
+                )
+                send = module._api.create_and_send_event_into_room
+                send.side_effect = Exception("database is down")  # type: ignore[attr-defined]
+                with self.assertRaisesRegex(Exception, "database is down"):
+                    await self.leave(module, self.user_id)
+                self.assertEqual(len(module._background_repairs), 0)
+
+        async def test_coalesce_repairs(self) -> None:
+            """Tests that a leave processed right after a repair of the same room is
+            checked against the latest state of the room, and doesn't cause another
+            repair if the room already has an admin.
+            """
+            module = self.create_module(config_override={"promote_moderators": True})
+            await self.leave(module, self.user_id)
+            self.assertEqual(module._api.create_and_send_event_into_room.call_count, 1)  # type: ignore[attr-defined]
+
+            # The latest state includes the power levels event the repair sent.
+            args, _ = module._api.create_and_send_event_into_room.call_args  # type: ignore[attr-defined]
+            latest_state = dict(self.state)
+            latest_state[(EventTypes.PowerLevels, "")] = self.create_event(args[0])
+            module._api.get_room_state.side_effect = make_get_room_state(  # type: ignore[attr-defined]
+                lambda: latest_state
+            )
+
+            # The same leave goes through again, with the state from before the repair.
+            await self.leave(module, self.user_id)
+            self.assertEqual(module._api.create_and_send_event_into_room.call_count, 1)  # type: ignore[attr-defined]
+            self.assertEqual(module.coalesced_repairs, 1)
+
+        async def test_room_admin_index_updated_from_new_events(self) -> None:
+            """Tests that the admin index of a room follows the membership events it's
+            notified of.
+            """
+            module = self.create_module()
+            # A non-admin leaving builds the room's index.
+            await self.leave(module, self.regular_user_id)
+            index = module._room_admin_indexes.get(self.room_id)
+            assert index is not None
+            self.assertEqual(index.active_admins, {self.user_id})
+
+            admin2_id = "@admin2:example.com"
+            self.add_admin(self.state, admin2_id, Membership.INVITE)
+            await module.on_new_event(
+                self.state[(EventTypes.Member, admin2_id)], self.state
+            )
+            await module.on_new_event(
+                self.state[(EventTypes.PowerLevels, "")], self.state
+            )
+            self.assertEqual(index.active_admins, {self.user_id, admin2_id})
+
+            leave_event = self.set_membership(self.state, admin2_id, Membership.LEAVE)
+            await module.on_new_event(leave_event, self.state)
+            self.assertEqual(index.active_admins, {self.user_id})
+
+        async def test_room_admin_index_missed_admin_leaving(self) -> None:
+            """Tests that the module still repairs the room if its index missed another
+            admin leaving the room.
+            """
+            admin2_id = "@admin2:example.com"
+            self.add_admin(self.state, admin2_id, Membership.JOIN)
+            module = self.create_module()
+            await self.leave(module, self.regular_user_id)
+
+            # The other admin leaves without the module being notified.
+            self.set_membership(self.state, admin2_id, Membership.LEAVE)
+            await self.leave(module, self.user_id)
+            self.assertTrue(module._api.create_and_send_event_into_room.called)  # type: ignore[attr-defined]
+
+        async def test_room_admin_index_missed_admin_joining(self) -> None:
+            """Tests that the module doesn't repair the room if its index missed another
+            admin joining the room.
+            """
+            admin2_id = "@admin2:example.com"
+            self.add_admin(self.state, admin2_id, Membership.LEAVE)
+            module = self.create_module()
+            await self.leave(module, self.regular_user_id)
+
+            # The other admin joins without the module being notified.
+            self.set_membership(self.state, admin2_id, Membership.JOIN)
+            await self.leave(module, self.user_id)
+            self.assertFalse(module._api.create_and_send_event_into_room.called)  # type: ignore[attr-defined]
+
+        async def test_sweep_orphaned_rooms(self) -> None:
+            """Tests that the sweeper finds rooms without an admin, and resumes from where
+            it stopped.
+            """
+            module = self.create_module({"sweeper_batch_size": 2})
+
+            db = sqlite3.connect(":memory:")
+            db.execute(
+                "CREATE TABLE local_current_membership"
+                " (room_id TEXT, user_id TEXT, membership TEXT)"
+            )
+            orphaned_room_ids = {"!b:example.com", "!d:example.com"}
+            for room_id in ["!a:example.com", "!b:example.com", "!c:example.com"]:
+                db.execute(
+                    "INSERT INTO local_current_membership VALUES (?, ?, 'join')",
+                    (room_id, self.regular_user_id),
+                )
+
+            def run_db_interaction(
+                desc: str, func: Callable[..., Any], *args: Any
+            ) -> "defer.Deferred[Any]":
+                return defer.succeed(func(db.cursor(), *args))
+
+            orphaned_state = dict(self.state)
+            self.set_membership(orphaned_state, self.user_id, Membership.LEAVE)
+
+            async def get_room_state(
+                room_id: str, event_filter: List[Tuple[str, str]]
+            ) -> StateMap[EventBase]:
+                # The sweeper only asks for the state it needs.
+                self.assertIsNotNone(event_filter)
+                state = orphaned_state if room_id in orphaned_room_ids else self.state
+                return {key: state[key] for key in event_filter if key in state}
+
+            module._api.run_db_interaction.side_effect = run_db_interaction  # type: ignore[attr-defined]
+            module._api.get_room_state.side_effect = get_room_state  # type: ignore[attr-defined]
+            module._api.sleep = mock.AsyncMock()  # type: ignore[method-assign]
+
+            await module.sweeper.sweep()
+            self.assertEqual(module.sweeper.rooms_checked, 3)
+            self.assertEqual(module.sweeper.orphaned_rooms, 1)
+
+            # A new room appears, the next sweep starts over.
+            db.execute(
+                "INSERT INTO local_current_membership VALUES (?, ?, 'join')",
+                ("!d:example.com", self.regular_user_id),
+            )
+            await module.sweeper.sweep()
+            self.assertEqual(module.sweeper.rooms_checked, 7)
+
+            rows = db.execute(
+                "SELECT room_id FROM manage_last_admin_orphaned_rooms ORDER BY room_id"
+            ).fetchall()
+            self.assertEqual([row[0] for row in rows], sorted(orphaned_room_ids))
+
+            # A sweep interrupted after the first page resumes after it.
+            db.execute(
+                "UPDATE manage_last_admin_sweeper_position SET last_room_id = ?",
+                ("!b:example.com",),
+            )
+            await module.sweeper.sweep()
+            self.assertEqual(module.sweeper.rooms_checked, 9)
+
+            # Orphaned rooms are only reported, the sweeper has no one to repair them as.
+            self.assertFalse(module._api.create_and_send_event_into_room.called)  # type: ignore[attr-defined]
+
+        async def test_metrics(self) -> None:
+            """Tests that processing leaves is reported to the module's metrics."""
+
+            def sample(name: str, labels: Optional[Dict[str, str]] = None) -> float:
+                return REGISTRY.get_sample_value(name, labels) or 0
+
+            def outcomes() -> Dict[str, float]:
+                return {
+                    outcome: sample(
+                        "manage_last_admin_check_event_allowed_seconds_count",
+                        {"outcome": outcome},
+                    )
+                    for outcome in ("not_last_admin", "promoted")
+                }
+
+            before = outcomes()
+            promoted_before = sample("manage_last_admin_promoted_users_total")
+            sent_before = sample(
+                "manage_last_admin_power_levels_events_sent_total",
+                {"strategy": "promote"},
+            )
+
+            module = self.create_module({"promote_moderators": True})
+            await self.leave(module, self.regular_user_id)
+            await self.leave(module, self.user_id)
+
+            after = outcomes()
+            self.assertEqual(after["not_last_admin"], before["not_last_admin"] + 1)
+            self.assertEqual(after["promoted"], before["promoted"] + 1)
+            self.assertEqual(
+                sample("manage_last_admin_promoted_users_total"), promoted_before + 1
+            )
+            self.assertEqual(
+                sample(
+                    "manage_last_admin_power_levels_events_sent_total",
+                    {"strategy": "promote"},
+                ),
+                sent_before + 1,
+            )
+
+        async def test_dry_run(self) -> None:
+            """Tests that in dry run mode, the module goes through the whole repair but
+            doesn't send the new power levels event.
+            """
+
+            def sample(name: str, labels: Dict[str, str]) -> float:
+                return REGISTRY.get_sample_value(name, labels) or 0
+
+            dry_run_before = sample(
+                "manage_last_admin_dry_run_power_levels_events_total",
+                {"strategy": "promote"},
+            )
+            sent_before = sample(
+                "manage_last_admin_power_levels_events_sent_total",
+                {"strategy": "promote"},
+            )
+            stages_before = sample(
+                "manage_last_admin_stage_seconds_count", {"stage": "select_candidates"}
+            )
+
+            module = self.create_module({"promote_moderators": True, "dry_run": True})
+            with self.assertLogs("manage_last_admin", level="INFO") as logs:
+                await self.leave(module, self.user_id)
+
+            self.assertFalse(module._api.create_and_send_event_into_room.called)  # type: ignore[attr-defined]
+            self.assertTrue(
+                any(
+                    self.mod_user_id in line and "Dry run" in line
+                    for line in logs.output
+                ),
+                logs.output,
+            )
+            self.assertEqual(
+                sample(
+                    "manage_last_admin_dry_run_power_levels_events_total",
+                    {"strategy": "promote"},
+                ),
+                dry_run_before + 1,
+            )
+            self.assertEqual(
+                sample(
+                    "manage_last_admin_power_levels_events_sent_total",
+                    {"strategy": "promote"},
+                ),
+                sent_before,
+            )
+            self.assertEqual(
+                sample(
+                    "manage_last_admin_stage_seconds_count",
+                    {"stage": "select_candidates"},
+                ),
+                stages_before + 1,
+            )
+
+        async def test_offload(self) -> None:
+            """Tests that the computations of a leave are run in a thread when the room
+            is big enough.
+            """
+            # Every member of the room is listed in its power levels, so there are no
+            # candidates to filter.
+            stages = ["build_room_snapshot", "select_candidates", "build_power_levels"]
+
+            def offloaded() -> List[float]:
+                return [
+                    REGISTRY.get_sample_value(
+                        "manage_last_admin_offloaded_seconds_count", {"stage": stage}
+                    )
+                    or 0
+                    for stage in stages
+                ]
+
+            self.state = self.get_other_room()
+            before = offloaded()
+
+            module = self.create_module({"offload_threshold": 1})
+            await self.leave(module, self.user_id)
+
+            self.assertEqual(offloaded(), [count + 1 for count in before])
+            self.assertEqual(module._api.defer_to_thread.call_count, 3)  # type: ignore[attr-defined]
+            self.assertTrue(module._api.create_and_send_event_into_room.called)  # type: ignore[attr-defined]
+
+            # Small rooms are processed on the reactor.
+            module = self.create_module()
+            await self.leave(module, self.user_id)
+            self.assertFalse(module._api.defer_to_thread.called)  # type: ignore[attr-defined]
+            self.assertEqual(offloaded(), [count + 1 for count in before])
+
+        async def test_retry_failed_repairs(self) -> None:
+            """Tests that failed repairs are stored and retried from the room's current
+            state until they succeed.
+            """
+            # Without retries, the leave goes through even if the repair fails.
+            module = self.create_module({"promote_moderators": True})
+            send = module._api.create_and_send_event_into_room
+            send.side_effect = Exception("database is down")  # type: ignore[attr-defined]
+            await self.leave(module, self.user_id)
+            self.assertTrue(send.called)  # type: ignore[attr-defined]
+
+            with tempfile.TemporaryDirectory() as directory:
+                database_path = os.path.join(directory, "retries.db")
+                module = self.create_module(
+                    {
+                        "promote_moderators": True,
+                        "retry_failed_repairs": True,
+                        "retry_database_path": database_path,
+                        "retry_base_delay_ms": 0,
+                    }
+                )
+                assert module.retry_queue is not None
+                send = module._api.create_and_send_event_into_room
+                send.side_effect = [Exception("database is down"), Exception("still down"), None]  # type: ignore[attr-defined]
+
+                # The leave is rejected, so the admin is still in the room when the
+                # repair is retried.
+                with self.assertRaisesRegex(Exception, "database is down"):
+                    await self.leave(module, self.user_id)
+
+                def pending() -> List[Tuple[str, int, str]]:
+                    connection = sqlite3.connect(database_path)
+                    return connection.execute(
+                        "SELECT room_id, attempts, last_error"
+                        " FROM manage_last_admin_pending_repairs"
+                    ).fetchall()
+
+                self.assertEqual(pending(), [(self.room_id, 0, "database is down")])
+
+                def retries(result: str) -> float:
+                    return (
+                        REGISTRY.get_sample_value(
+                            "manage_last_admin_repair_retries_total", {"result": result}
+                        )
+                        or 0
+                    )
+
+                before = {
+                    result: retries(result)
+                    for result in ("succeeded", "not_needed", "failed", "abandoned")
+                }
+                await module.retry_queue.process()
+                self.assertEqual(pending(), [(self.room_id, 1, "still down")])
+                self.assertEqual(retries("failed"), before["failed"] + 1)
+
+                # The repair is sent on behalf of the admin.
+                await module.retry_queue.process()
+                self.assertEqual(pending(), [])
+                self.assertEqual(retries("succeeded"), before["succeeded"] + 1)
+                self.assertEqual(send.call_count, 3)  # type: ignore[attr-defined]
+                args, _ = send.call_args  # type: ignore[attr-defined]
+                self.assertEqual(args[0]["content"]["users"][self.mod_user_id], 100)
+
+                # If the admin has left, the repair is dropped since it can't be sent.
+                send.side_effect = Exception("database is down")  # type: ignore[attr-defined]
+                with self.assertRaisesRegex(Exception, "database is down"):
+                    await self.leave(module, self.user_id)
+                self.assertEqual(len(pending()), 1)
+                self.set_membership(self.state, self.user_id, Membership.LEAVE)
+                await module.retry_queue.process()
+                self.assertEqual(pending(), [])
+                self.assertEqual(send.call_count, 4)  # type: ignore[attr-defined]
+                self.assertEqual(retries("abandoned"), before["abandoned"] + 1)
+                self.assertEqual(retries("succeeded"), before["succeeded"] + 1)
+
+        async def test_failed_repair_rejects_leave(self) -> None:
+            """Tests that the leave of the last admin is rejected when failed repairs are
+            retried and the power levels event can't be sent, even for a transient
+            error, and that the admin can leave once it can be sent again.
+            """
+            with tempfile.TemporaryDirectory() as directory:
+                module = self.create_module(
+                    {
+                        "promote_moderators": True,
+                        "retry_failed_repairs": True,
+                        "retry_database_path": os.path.join(directory, "retries.db"),
+                    }
+                )
+                send = module._api.create_and_send_event_into_room
+                send.side_effect = Exception("database hiccup")  # type: ignore[attr-defined]
+
+                leave_event = self.create_event(
+                    {
+                        "sender": self.user_id,
+                        "type": EventTypes.Member,
+                        "content": {"membership": Membership.LEAVE},
+                        "room_id": self.room_id,
+                        "state_key": self.user_id,
+                    },
+                )
+                with self.assertRaisesRegex(Exception, "database hiccup"):
+                    await module.check_event_allowed(leave_event, self.state)
+
+                send.side_effect = None  # type: ignore[attr-defined]
+                await self.leave(module, self.user_id)
+                self.assertEqual(send.call_count, 2)  # type: ignore[attr-defined]
+
+        def change_power_levels(self, users: Dict[str, int]) -> EventBase:
+            """Builds a power levels event sent by the room's admin, updating the levels
+            of the given users."""
+            pl_event = self.state[(EventTypes.PowerLevels, "")]
+            content = dict(pl_event.content)
+            content["users"] = {**pl_event.content["users"], **users}
+            return self.create_event(
+                {
+                    "sender": self.user_id,
+                    "type": EventTypes.PowerLevels,
+                    "state_key": "",
+                    "content": content,
+                    "room_id": self.room_id,
+                }
+            )
+
+        async def test_kick_by_last_admin(self) -> None:
+            """Tests that the last admin kicking or banning someone from the room doesn't
+            repair it."""
+            module = self.create_module({"promote_moderators": True})
+
+            for membership in (Membership.LEAVE, Membership.BAN):
+                kick = self.create_event(
+                    {
+                        "sender": self.user_id,
+                        "type": EventTypes.Member,
+                        "content": {"membership": membership},
+                        "room_id": self.room_id,
+                        "state_key": self.regular_user_id,
+                    },
+                )
+                allowed, replacement = await module.check_event_allowed(
+                    kick, self.state
+                )
+                self.assertTrue(allowed)
+                self.assertIsNone(replacement)
+
+            module._api.create_and_send_event_into_room.assert_not_called()  # type: ignore[attr-defined]
+
+        async def test_last_admin_demotes_themselves(self) -> None:
+            """Tests that the last admin giving up their admin level has their power
+            levels event replaced with one that also repairs the room."""
+            def sample(name: str) -> float:
+                return REGISTRY.get_sample_value(name, {"strategy": "promote"}) or 0
+
+            sent_before = sample("manage_last_admin_power_levels_events_sent_total")
+            replaced_before = sample(
+                "manage_last_admin_power_levels_events_replaced_total"
+            )
+
+            module = self.create_module({"promote_moderators": True})
+            demotion = self.change_power_levels({self.user_id: 50})
+
+            allowed, replacement = await module.check_event_allowed(
+                demotion, self.state
+            )
+
+            self.assertTrue(allowed)
+            assert replacement is not None
+            self.assertEqual(replacement["type"], EventTypes.PowerLevels)
+            self.assertEqual(replacement["sender"], self.user_id)
+            self.assertEqual(replacement["content"]["users"][self.user_id], 50)
+            self.assertEqual(replacement["content"]["users"][self.mod_user_id], 100)
+            module._api.create_and_send_event_into_room.assert_not_called()  # type: ignore[attr-defined]
+
+            # Synapse may still reject the replacement, so it isn't counted as sent.
+            self.assertEqual(
+                sample("manage_last_admin_power_levels_events_sent_total"), sent_before
+            )
+            self.assertEqual(
+                sample("manage_last_admin_power_levels_events_replaced_total"),
+                replaced_before + 1,
+            )
+
+            # In dry run mode, the event is left alone.
+            module = self.create_module({"promote_moderators": True, "dry_run": True})
+            _, replacement = await module.check_event_allowed(demotion, self.state)
+            self.assertIsNone(replacement)
+
+        async def test_power_levels_change_keeps_admin(self) -> None:
+            """Tests that power levels changes that leave an admin in the room are let
+            through, ordinary ones without looking up the membership of any user."""
+            module = self.create_module({"promote_moderators": True})
+            get_membership = mock.Mock(wraps=self.state.get)
+            state = mock.Mock(wraps=self.state)
+            state.get = get_membership
+
+            # An ordinary change, which doesn't touch the admins.
+            _, replacement = await module.check_event_allowed(
+                self.change_power_levels({self.regular_user_id: 10}), state
+            )
+            self.assertIsNone(replacement)
+            get_membership.assert_called_once_with((EventTypes.PowerLevels, ""))
+
+            # The admin demotes themselves, but promotes the moderator at the same time.
+            _, replacement = await module.check_event_allowed(
+                self.change_power_levels({self.user_id: 50, self.mod_user_id: 100}),
+                self.state,
+            )
+            self.assertIsNone(replacement)
+            module._api.create_and_send_event_into_room.assert_not_called()  # type: ignore[attr-defined]
+
+        async def test_admin_default_level_lowered(self) -> None:
+            """Tests that, in a room where admin is the default level (e.g. one repaired
+            by making it so), any member lowering it is treated as the last admin giving
+            up their level, including with power levels that don't list any user."""
+            module = self.create_module({"promote_moderators": True})
+
+            def set_power_levels(sender: str, content: Dict[str, Any]) -> EventBase:
+                return self.create_event(
+                    {
+                        "sender": sender,
+                        "type": EventTypes.PowerLevels,
+                        "state_key": "",
+                        "content": content,
+                        "room_id": self.room_id,
+                    }
+                )
+
+            self.state[(EventTypes.PowerLevels, "")] = set_power_levels(
+                self.user_id, {"users": {self.mod_user_id: 50}, "users_default": 100}
+            )
+            _, replacement = await module.check_event_allowed(
+                set_power_levels(
+                    self.regular_user_id,
+                    {"users": {self.mod_user_id: 50}, "users_default": 0},
+                ),
+                self.state,
+            )
+            assert replacement is not None
+            self.assertEqual(replacement["sender"], self.regular_user_id)
+            self.assertEqual(
+                replacement["content"],
+                {"users": {self.mod_user_id: 100}, "users_default": 0},
+            )
+
+            # Power levels without a "users" key don't list any admin either.
+            self.state[(EventTypes.PowerLevels, "")] = set_power_levels(
+                self.user_id, {"users_default": 100}
+            )
+            _, replacement = await module.check_event_allowed(
+                set_power_levels(self.regular_user_id, {"users_default": 0}),
+                self.state,
+            )
+            assert replacement is not None
+            self.assertEqual(
+                replacement["content"], {"users": {}, "users_default": 100}
+            )
+
+            # Lowering the default level is fine if an admin is still in the room.
+            _, replacement = await module.check_event_allowed(
+                set_power_levels(
+                    self.regular_user_id,
+                    {"users": {self.user_id: 100}, "users_default": 0},
+                ),
+                self.state,
+            )
+            self.assertIsNone(replacement)
+            module._api.create_and_send_event_into_room.assert_not_called()  # type: ignore[attr-defined]
+
+        async def test_responsible_server(self) -> None:
+            """Tests that, with the module running on every server of the room, only the
+            server of the leaving admin repairs it, and the others skip the leave.
+            """
+            modules = {
+                server_name: create_module(
+                    {"promote_moderators": True},
+                    server_name=server_name,
+                    get_state=lambda: self.state,
+                )
+                for server_name in ("example.com", "other.example.com", "example.org")
+            }
+
+            for module in modules.values():
+                await self.leave(module, self.user_id)
+
+            for server_name, module in modules.items():
+                send = module._api.create_and_send_event_into_room
+                if server_name == "example.com":
+                    send.assert_called_once()  # type: ignore[attr-defined]
+                    args, _ = send.call_args  # type: ignore[attr-defined]
+                    self.assertEqual(args[0]["sender"], self.user_id)
+                else:
+                    send.assert_not_called()  # type: ignore[attr-defined]
+                    self.assertIsNone(module._room_admin_indexes.get(self.room_id))
+
+        async def test_batch_deactivations(self) -> None:
+            """Tests that the rooms of a deactivated user are repaired in one batch,
+            while they're still in them.
+            """
+            connection = sqlite3.connect(":memory:")
+            connection.execute(
+                "CREATE TABLE local_current_membership"
+                " (room_id TEXT, user_id TEXT, membership TEXT)"
+            )
+            connection.execute("CREATE TABLE rooms (room_id TEXT, room_version TEXT)")
+            other_room_id = "!other:example.com"
+            left_room_id = "!left:example.com"
+            room_version = self.state[
+                (EventTypes.PowerLevels, "")
+            ].room_version.identifier
+            for room_id, membership in [
+                (self.room_id, Membership.JOIN),
+                (other_room_id, Membership.JOIN),
+                (left_room_id, Membership.LEAVE),
+            ]:
+                connection.execute(
+                    "INSERT INTO local_current_membership VALUES (?, ?, ?)",
+                    (room_id, self.user_id, membership),
+                )
+                connection.execute(
+                    "INSERT INTO rooms VALUES (?, ?)", (room_id, room_version)
+                )
+
+            async def run_db_interaction(
+                desc: str, func: Callable[..., Any], *args: Any
+            ) -> Any:
+                return func(connection.cursor(), *args)
+
+            module = self.create_module(
+                {"promote_moderators": True, "batch_deactivations": True}
+            )
+            module._api.run_db_interaction.side_effect = run_db_interaction  # type: ignore[attr-defined]
+            _, kwargs = module._api.register_third_party_rules_callbacks.call_args  # type: ignore[attr-defined]
+            self.assertIsNotNone(kwargs["on_user_deactivation_status_changed"])
+
+            outcomes = await module.deactivation_batcher.process(self.user_id)
+
+            self.assertEqual(outcomes, {"promoted": 2})
+            send = module._api.create_and_send_event_into_room
+            self.assertEqual(
+                sorted(args[0]["room_id"] for args, _ in send.call_args_list),  # type: ignore[attr-defined]
+                sorted([self.room_id, other_room_id]),
+            )
+            for args, _ in send.call_args_list:  # type: ignore[attr-defined]
+                self.assertEqual(args[0]["sender"], self.user_id)
+                self.assertEqual(args[0]["content"]["users"][self.mod_user_id], 100)
+
+            # Once the user has left, there's nothing to repair anymore.
+            self.set_membership(self.state, self.user_id, Membership.LEAVE)
+            outcomes = await module.deactivation_batcher.process(self.user_id)
+            self.assertEqual(outcomes, {"not_last_admin": 2})
+            self.assertEqual(send.call_count, 2)  # type: ignore[attr-defined]
+
+        async def test_slow_sampler(self) -> None:
+            """Tests that slow calls to check_event_allowed are captured with a profile,
+            that the captures are scrubbed and can be replayed, and that only the most
+            recent ones are kept."""
+            with tempfile.TemporaryDirectory() as directory:
+                module = self.create_module(
+                    {
+                        "promote_moderators": True,
+                        "slow_sampler_threshold_ms": 1000,
+                        "slow_sampler_directory": directory,
+                        "slow_sampler_max_samples": 1,
+                    }
+                )
+                assert module.slow_sampler is not None
+                self.set_membership(
+                    self.state, "@stranger:example.com", Membership.JOIN
+                )
+                leave_event = self.create_event(
+                    {
+                        "sender": self.user_id,
+                        "type": EventTypes.Member,
+                        "content": {"membership": Membership.LEAVE},
+                        "room_id": self.room_id,
+                        "state_key": self.user_id,
+                    },
+                )
+
+                await module.slow_sampler.sample(leave_event, self.state, "promoted", 2)
+
+                # The inputs are captured in the thread pool, not on the reactor.
+                capture_threads: List[threading.Thread] = []
+                original_capture_inputs = sampler.capture_inputs
+
+                def capture_inputs(*args: Any, **kwargs: Any) -> JsonDict:
+                    capture_threads.append(threading.current_thread())
+                    return original_capture_inputs(*args, **kwargs)
+
+                with mock.patch.object(sampler, "capture_inputs", capture_inputs):
+                    path = await module.slow_sampler.sample(
+                        leave_event, self.state, "promoted", 2
+                    )
+                self.assertEqual(len(capture_threads), 1)
+                self.assertIsNot(capture_threads[0], threading.current_thread())
+
+                self.assertEqual(
+                    sorted(os.listdir(directory)),
+                    sorted(
+                        os.path.basename(path) + extension
+                        for extension in (".jsonl", ".prof", ".yaml")
+                    ),
+                )
+                with open(path + ".jsonl") as f:
+                    line = f.read()
+                # The profile of the capture's replay can be loaded.
+                self.assertTrue(pstats.Stats(path + ".prof").stats)  # type: ignore[attr-defined]
+
+            capture = json.loads(line)
+            self.assertEqual(capture["elapsed_ms"], 2000)
+            self.assertEqual(capture["room_type"], RoomType.PUBLIC)
+            for user_id in (self.user_id, self.mod_user_id, self.room_id):
+                self.assertNotIn(user_id.split(":")[0][1:], line)
+            # The join rules, and the members who aren't listed in the power levels, are
+            # left out.
+            self.assertEqual(len(capture["state"]), len(self.state) - 2)
+
+            api = replay.RecordingModuleApi("example.com")
+            replay_module = ManageLastAdmin(
+                ManageLastAdmin.parse_config({"promote_moderators": True}),
+                api,  # type: ignore[arg-type]
+            )
+            output = io.StringIO()
+            stats = replay.replay(replay_module, api, [line], output)
+            self.assertEqual(stats.sent, 1)
+            sent = json.loads(output.getvalue())["sent"]
+            # The scrubbed moderator was promoted.
+            self.assertEqual(
+                sorted(sent["content"]["users"].values()), [0, 75, 100, 100]
+            )
+
+        async def test_warm_up(self) -> None:
+            """Tests that warming caches up builds the admin index of the rooms with the
+            most local members, and reports its progress.
+            """
+
+            def sample(state: str) -> float:
+                return (
+                    REGISTRY.get_sample_value(
+                        "manage_last_admin_warmup_rooms", {"state": state}
+                    )
+                    or 0
+                )
+
+            connection = sqlite3.connect(":memory:")
+            connection.execute(
+                "CREATE TABLE local_current_membership"
+                " (room_id TEXT, user_id TEXT, membership TEXT)"
+            )
+            connection.executemany(
+                "INSERT INTO local_current_membership VALUES (?, ?, ?)",
+                [
+                    (self.room_id, self.user_id, Membership.JOIN),
+                    (self.room_id, self.mod_user_id, Membership.JOIN),
+                    ("!small:example.com", self.user_id, Membership.JOIN),
+                    ("!left:example.com", self.user_id, Membership.LEAVE),
+                    ("!left:example.com", self.mod_user_id, Membership.LEAVE),
+                ],
+            )
+
+            async def run_db_interaction(
+                desc: str, func: Callable[..., Any], *args: Any
+            ) -> Any:
+                return func(connection.cursor(), *args)
+
+            module = self.create_module({"promote_moderators": True})
+            module._api.run_db_interaction.side_effect = run_db_interaction  # type: ignore[attr-defined]
+            done_before = sample("done")
+
+            await module.cache_warmer.warm_up(None, max_rooms=1)
+
+            self.assertIsNotNone(module._room_admin_indexes.get(self.room_id))
+            self.assertEqual(sample("total"), 1)
+            self.assertEqual(sample("done"), done_before + 1)
+
+
 class ManageLastAdminTestRoomV9(ManageLastAdminTestCases.BaseManageLastAdminTest):
     def create_event(self, content: JsonDict) -> EventBase:
         return make_event_from_dict(content, RoomVersions.V9)
@@ -16,10 +16,34 @@
 # From Python 3.8 onwards, aiounittest.AsyncTestCase can be replaced by
 # unittest.IsolatedAsyncioTestCase, so we'll be able to get rid of this dependency when
 # we stop supporting Python < 3.8 in Synapse.
-from typing import List
+import random
+import unittest
+from typing import Dict, List, Optional
+from unittest import mock
 
 import aiounittest
-from manage_last_admin import _filter_out_users_from_forbidden_domain
+import attr
+from canonicaljson import encode_canonical_json
+from synapse.api.constants import EventTypes, Membership
+from synapse.api.room_versions import RoomVersions
+from synapse.events import EventBase, make_event_from_dict
+from synapse.module_api.errors import ConfigError
+from synapse.types import JsonDict
+
+from manage_last_admin import (
+    DomainMatcher,
+    ManageLastAdmin,
+    ManageLastAdminConfig,
+    RoomSnapshot,
+    _filter_out_users_from_forbidden_domain,
+    _get_power_levels_view_for_event,
+    _get_users_with_highest_nondefault_pl,
+    _plan_promotion,
+    _power_levels_view_cache,
+    _PowerLevelsContentBuilder,
+    _PowerLevelsContentSizeEstimator,
+    vectorized,
+)
 
 
 
@@ -43,4 +67,372 @@ class TestFilterOutUsersFromForbiddenDomain(aiounittest.AsyncTestCase):
         user_ids = ["@user1:domain1.com"]
         forbidden_domains:List[str] = []
         result = _filter_out_users_from_forbidden_domain(user_ids, forbidden_domains)
-        self.assertEqual(result, ["@user1:domain1.com"])
\ No newline at end of file
+        self.assertEqual(result, ["@user1:domain1.com"])
+
+    def test_wildcard_domains(self) -> None:
+        """Test filtering with wildcard domains."""
+        user_ids = [
+            "@user1:externe.com",
+            "@user2:agent.externe.com",
+            "@user3:a.b.externe.com",
+            "@user4:notexterne.com",
+            "@user5:example.com",
+        ]
+        forbidden_domains = DomainMatcher(["*.externe.com", "example.com"])
+        result = _filter_out_users_from_forbidden_domain(user_ids, forbidden_domains)
+        self.assertEqual(result, ["@user1:externe.com", "@user4:notexterne.com"])
+
+
+class TestParseConfig(aiounittest.AsyncTestCase):
+    def test_defaults(self) -> None:
+        """Test that options which aren't set get the defaults of the config class."""
+        self.assertEqual(
+            attr.asdict(ManageLastAdmin.parse_config({}), recurse=False),
+            {
+                **attr.asdict(ManageLastAdminConfig(), recurse=False),
+                "forbidden_domains": mock.ANY,
+            },
+        )
+
+        config = ManageLastAdmin.parse_config(
+            {"domains_forbidden_when_restricted": ["*.externe.com"]}
+        )
+        self.assertTrue(config.forbidden_domains.matches("sub.externe.com"))
+
+    def test_invalid_rates(self) -> None:
+        """Test that rates and concurrencies which can't be used are rejected."""
+        for name, value in (
+            ("sweeper_rooms_per_second", 0),
+            ("warmup_rooms_per_second", -1),
+            ("retry_concurrency", "5"),
+        ):
+            with self.assertRaises(ConfigError):
+                ManageLastAdmin.parse_config({name: value})
+
+        config = ManageLastAdmin.parse_config({"warmup_rooms_per_second": 0.5})
+        self.assertEqual(config.warmup_rooms_per_second, 0.5)
+
+
+class TestPowerLevelsView(aiounittest.AsyncTestCase):
+    def create_power_levels_event(self, content: JsonDict) -> EventBase:
+        return make_event_from_dict(
+            {
+                "sender": "@admin:example.com",
+                "type": EventTypes.PowerLevels,
+                "state_key": "",
+                "content": content,
+                "room_id": "!someroom:example.com",
+            },
+            RoomVersions.V9,
+        )
+
+    def test_view(self) -> None:
+        """Test that the view is derived correctly from the event's content."""
+        event = self.create_power_levels_event(
+            {
+                "users": {
+                    "@admin:example.com": 100,
+                    "@admin2:example.com": 150,
+                    "@mod:example.com": 50,
+                    "@mod2:example.com": 50,
+                    "@bot:example.com": "60",
+                },
+                "users_default": 10,
+            }
+        )
+        view = _get_power_levels_view_for_event(event)
+        assert view is not None
+        self.assertEqual(view.event_id, event.event_id)
+        self.assertEqual(view.admins, {"@admin:example.com", "@admin2:example.com"})
+        self.assertEqual(len(view.users), 5)
+        self.assertEqual(
+            view.levels,
+            (
+                (150, ("@admin2:example.com",)),
+                (100, ("@admin:example.com",)),
+                (50, ("@mod:example.com", "@mod2:example.com")),
+            ),
+        )
+        self.assertEqual(view.users_default, 10)
+
+    def test_invalid_content(self) -> None:
+        """Test that no view is returned if the content has no usable users dict."""
+        event = self.create_power_levels_event({"users_default": 10})
+        self.assertIsNone(_get_power_levels_view_for_event(event))
+
+    def test_cached(self) -> None:
+        """Test that the view is only computed once per event."""
+        event = self.create_power_levels_event({"users": {"@admin:example.com": 100}})
+        misses = _power_levels_view_cache.misses
+        hits = _power_levels_view_cache.hits
+
+        view = _get_power_levels_view_for_event(event)
+        self.assertIs(_get_power_levels_view_for_event(event), view)
+        self.assertEqual(_power_levels_view_cache.misses, misses + 1)
+        self.assertEqual(_power_levels_view_cache.hits, hits + 1)
+
+
+class TestGetUsersWithHighestNondefaultPl(aiounittest.AsyncTestCase):
+    def create_snapshot(
+        self, users: Dict[str, int], memberships: Dict[str, str], users_default: int = 0
+    ) -> RoomSnapshot:
+        event = make_event_from_dict(
+            {
+                "sender": "@admin:example.com",
+                "type": EventTypes.PowerLevels,
+                "state_key": "",
+                "content": {"users": users, "users_default": users_default},
+                "room_id": "!someroom:example.com",
+            },
+            RoomVersions.V9,
+        )
+        snapshot = RoomSnapshot()
+        snapshot.power_levels = _get_power_levels_view_for_event(event)
+        snapshot.memberships = memberships
+        return snapshot
+
+    def test_highest_tier_with_members(self) -> None:
+        """Test that tiers without anyone in the room are skipped, and that the leaving
+        user is ignored."""
+        snapshot = self.create_snapshot(
+            {
+                "@admin:example.com": 100,
+                "@bot60:example.com": 60,
+                "@bot51:example.com": 51,
+                "@invited51:example.com": 51,
+                "@mod:example.com": 50,
+            },
+            {
+                "@admin:example.com": Membership.JOIN,
+                "@bot60:example.com": Membership.LEAVE,
+                "@invited51:example.com": Membership.INVITE,
+                "@mod:example.com": Membership.JOIN,
+            },
+        )
+        result = _get_users_with_highest_nondefault_pl(snapshot, "@admin:example.com")
+        self.assertEqual(result, ["@invited51:example.com"])
+
+    def test_nothing_above_default(self) -> None:
+        """Test that users at or below the default level are never returned."""
+        snapshot = self.create_snapshot(
+            {"@admin:example.com": 100, "@user:example.com": 10},
+            {
+                "@admin:example.com": Membership.JOIN,
+                "@user:example.com": Membership.JOIN,
+            },
+            users_default=10,
+        )
+        result = _get_users_with_highest_nondefault_pl(snapshot, "@admin:example.com")
+        self.assertEqual(result, [])
+
+
+class TestPowerLevelsContentBuilder(aiounittest.AsyncTestCase):
+    def test_copy_on_write(self) -> None:
+        """Test that the builder leaves the current content untouched, and only copies
+        what it changes."""
+        pl_content: JsonDict = {
+            "events": {"m.room.power_levels": 100},
+            "users": {"@admin:example.com": 100, "@mod:example.com": 50},
+            "users_default": 0,
+        }
+        builder = _PowerLevelsContentBuilder(pl_content)
+        builder.set_user_level("@mod:example.com", 100)
+        builder.set("users_default", 10)
+        new_content = builder.build()
+
+        self.assertEqual(
+            new_content,
+            {
+                "events": {"m.room.power_levels": 100},
+                "users": {"@admin:example.com": 100, "@mod:example.com": 100},
+                "users_default": 10,
+            },
+        )
+        self.assertEqual(pl_content["users"]["@mod:example.com"], 50)
+        self.assertEqual(pl_content["users_default"], 0)
+        self.assertIs(new_content["events"], pl_content["events"])
+
+
+class TestPlanPromotion(aiounittest.AsyncTestCase):
+    def setUp(self) -> None:
+        self.pl_content: JsonDict = {
+            "ban": 50,
+            "events": {"m.room.power_levels": 100},
+            "users": {"@admin:example.com": 100, "@mod:example.com": 50},
+            "users_default": 0,
+        }
+
+    def test_estimator(self) -> None:
+        """Test that the estimated size matches the size of the encoded content."""
+        for users in ({}, self.pl_content["users"]):
+            content = {**self.pl_content, "users": dict(users)}
+            estimator = _PowerLevelsContentSizeEstimator(content)
+            for user_id in ("@mod:example.com", "@user:example.com", "@ü:example.com"):
+                estimator.add(user_id, 100)
+                content["users"][user_id] = 100
+            self.assertEqual(estimator.size, len(encode_canonical_json(content)))
+
+    def test_everyone_fits(self) -> None:
+        """Test that everyone is promoted if the content stays small enough."""
+        users = ["@mod:example.com", "@user:example.com"]
+        self.assertEqual(_plan_promotion(self.pl_content, users, 100, 65536), users)
+
+    def test_partial(self) -> None:
+        """Test that as many users as possible are promoted if not everyone fits."""
+        size = len(encode_canonical_json(self.pl_content))
+        users = [
+            "@a_very_long_user_name:example.com",
+            "@user1:example.com",
+            "@mod:example.com",
+            "@user2:example.com",
+        ]
+        # Enough room for the mod's level change and the two short user IDs.
+        max_size = size + 1 + 2 * len(',"@user1:example.com":100')
+        self.assertEqual(
+            _plan_promotion(self.pl_content, users, 100, max_size),
+            ["@user1:example.com", "@mod:example.com", "@user2:example.com"],
+        )
+
+    def test_nobody_fits(self) -> None:
+        """Test that None is returned if nobody can be promoted."""
+        size = len(encode_canonical_json(self.pl_content))
+        self.assertIsNone(
+            _plan_promotion(self.pl_content, ["@user:example.com"], 100, size)
+        )
+
+
+@unittest.skipUnless(vectorized.AVAILABLE, "NumPy isn't installed")
+class TestVectorizedEngine(aiounittest.AsyncTestCase):
+    def create_random_snapshot(self, rng: random.Random, users: int) -> RoomSnapshot:
+        """Builds a snapshot of a room with random power levels and memberships."""
+        domains = ["example.com", "externe.com", "sub.externe.com", "other.org"]
+        levels: Dict[str, int] = {}
+        memberships: Dict[str, str] = {}
+        for i in range(users):
+            user_id = f"@user{i}:{rng.choice(domains)}"
+            levels[user_id] = rng.choice([0, 10, 50, 50, 75, 100])
+            membership = rng.choice(
+                [Membership.JOIN, Membership.INVITE, Membership.LEAVE, None]
+            )
+            if membership is not None:
+                memberships[user_id] = membership
+
+        event = make_event_from_dict(
+            {
+                "sender": "@user0:example.com",
+                "type": EventTypes.PowerLevels,
+                "state_key": "",
+                "content": {"users": levels, "users_default": 10},
+                "room_id": "!someroom:example.com",
+            },
+            RoomVersions.V9,
+        )
+        snapshot = RoomSnapshot()
+        snapshot.power_levels = _get_power_levels_view_for_event(event)
+        snapshot.memberships = memberships
+        return snapshot
+
+    def create_snapshot(self, levels: Dict[str, int]) -> RoomSnapshot:
+        """Builds a snapshot of a room with the given power levels, in which every user
+        is joined."""
+        event = make_event_from_dict(
+            {
+                "sender": "@admin:example.com",
+                "type": EventTypes.PowerLevels,
+                "state_key": "",
+                "content": {"users": levels, "users_default": 0},
+                "room_id": "!someroom:example.com",
+            },
+            RoomVersions.V9,
+        )
+        snapshot = RoomSnapshot()
+        snapshot.power_levels = _get_power_levels_view_for_event(event)
+        snapshot.memberships = {user_id: Membership.JOIN for user_id in levels}
+        return snapshot
+
+    def test_same_results_as_python(self) -> None:
+        """Test that the engine selects the same users, in the same order, as the
+        pure-Python implementation."""
+        rng = random.Random(0)
+        forbidden_domains = DomainMatcher(["*.externe.com", "other.org"])
+        engine = vectorized.VectorizedEngine(10, forbidden_domains)
+        for users in (1, 2, 10, 100, 1000):
+            for _ in range(5):
+                snapshot = self.create_random_snapshot(rng, users)
+                assert snapshot.power_levels is not None
+                ignore_user = rng.choice(list(snapshot.power_levels.users))
+
+                expected = _get_users_with_highest_nondefault_pl(snapshot, ignore_user)
+                result = engine.get_users_with_highest_nondefault_pl(
+                    snapshot.power_levels, snapshot.memberships, ignore_user
+                )
+                self.assertEqual(
+                    result,
+                    (
+                        expected,
+                        _filter_out_users_from_forbidden_domain(
+                            expected, forbidden_domains
+                        ),
+                    ),
+                )
+
+    def test_arrays_cached(self) -> None:
+        """Test that the arrays are built once per power levels event, and that the
+        least recently used ones are evicted."""
+        rng = random.Random(1)
+        engine = vectorized.VectorizedEngine(1, DomainMatcher([]))
+        first = self.create_random_snapshot(rng, 10).power_levels
+        second = self.create_random_snapshot(rng, 10).power_levels
+        assert first is not None and second is not None
+
+        arrays = engine.get_arrays(first)
+        self.assertIs(engine.get_arrays(first), arrays)
+        engine.get_arrays(second)
+        self.assertIsNot(engine.get_arrays(first), arrays)
+
+    def test_large_levels(self) -> None:
+        """Test that levels which don't fit in 32 or 64 bits integers are handled."""
+        snapshot = self.create_snapshot(
+            {
+                "@admin:example.com": 2**64,
+                "@mod1:example.com": 2**40,
+                "@mod2:example.com": 2**53 - 1,
+                "@mod3:example.com": 2**40,
+                "@user:example.com": 50,
+            }
+        )
+        assert snapshot.power_levels is not None
+
+        engine = vectorized.VectorizedEngine(1, DomainMatcher([]))
+        self.assertEqual(
+            engine.get_users_with_highest_nondefault_pl(
+                snapshot.power_levels, snapshot.memberships, "@admin:example.com"
+            ),
+            (["@mod2:example.com"], ["@mod2:example.com"]),
+        )
+
+    def test_stops_at_highest_level_in_room(self) -> None:
+        """Test that the membership of the users with a level lower than the highest
+        level with users in the room isn't looked up."""
+        levels = {"@admin:example.com": 100, "@mod:example.com": 50}
+        levels.update({f"@bot{i}:example.com": 10 for i in range(100)})
+        snapshot = self.create_snapshot(levels)
+        assert snapshot.power_levels is not None
+
+        looked_up: List[str] = []
+
+        class Memberships(Dict[str, str]):
+            def get(self, user_id: str, default: Optional[str] = None) -> Optional[str]:  # type: ignore[override]
+                looked_up.append(user_id)
+                return super().get(user_id, default)
+
+        engine = vectorized.VectorizedEngine(1, DomainMatcher(["externe.com"]))
+        self.assertEqual(
+            engine.get_users_with_highest_nondefault_pl(
+                snapshot.power_levels,
+                Memberships(snapshot.memberships),
+                "@admin:example.com",
+            ),
+            (["@mod:example.com"], ["@mod:example.com"]),
+        )
+        self.assertEqual(looked_up, ["@mod:example.com"])
@@ -26,7 +26,7 @@ from synapse.events import EventBase, make_event_from_dict
 from synapse.types import JsonDict, MutableStateMap
 from synapse.util.stringutils import random_string
 
-from manage_last_admin import ACCESS_RULES_TYPE, _is_last_admin_leaving, _get_power_levels_content_from_state
+from manage_last_admin import ACCESS_RULES_TYPE, RoomSnapshot, _is_last_admin_leaving
 from tests import create_module
 
 
@@ -182,7 +182,8 @@ class ManageLastAdminTestScenarii:
         async def admin_leaves(self) -> Any:
             module = create_module(config_override={
                 "promote_moderators": True, 
-                "domains_forbidden_when_restricted":CONFIG_DOMAINS_FORBIDDEN_WHEN_RESTRICTED}
+                "domains_forbidden_when_restricted":CONFIG_DOMAINS_FORBIDDEN_WHEN_RESTRICTED},
+                get_state=lambda: self.state,
                 )
             leave_event = self.create_event(
                 {
@@ -396,10 +397,10 @@ class ManageLastAdminTestScenarii:
                     "state_key": self.admin_id,
                 },
             )
-            pl_content = _get_power_levels_content_from_state(self.state)
+            snapshot = RoomSnapshot.from_state(self.state)
             
             #method to test
-            last_admin_leaving = _is_last_admin_leaving(leave_event, pl_content, self.state) # type: ignore[arg-type]
+            last_admin_leaving = _is_last_admin_leaving(leave_event, snapshot)
             self.assertFalse(last_admin_leaving)
 
 class ManageLastAdminTestRoomV9(ManageLastAdminTestScenarii.BaseManageLastAdminTest):
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import json
+import os
+import tempfile
+from typing import Any, Dict, List
+
+import aiounittest
+from synapse.api.constants import EventTypes, Membership
+from synapse.types import JsonDict
+
+from manage_last_admin import ManageLastAdmin, replay
+
+ROOM_ID = "!room:example.com"
+ADMIN = "@admin:example.com"
+MOD = "@mod:example.com"
+
+
+def member_event(user_id: str, membership: str) -> JsonDict:
+    return {
+        "room_id": ROOM_ID,
+        "sender": user_id,
+        "type": EventTypes.Member,
+        "state_key": user_id,
+        "content": {"membership": membership},
+    }
+
+
+def make_line(members: int, **extra: Any) -> str:
+    """Builds a line of a dump in which ADMIN, the last admin of a room, leaves it."""
+    state: List[Dict[str, Any]] = [
+        {
+            "room_id": ROOM_ID,
+            "sender": ADMIN,
+            "type": EventTypes.PowerLevels,
+            "state_key": "",
+            "content": {"users": {ADMIN: 100, MOD: 50}, "users_default": 0},
+        },
+        member_event(ADMIN, Membership.JOIN),
+        member_event(MOD, Membership.JOIN),
+    ]
+    state.extend(
+        member_event(f"@user{i}:example.com", Membership.JOIN) for i in range(members)
+    )
+    return json.dumps(
+        {"state": state, "event": member_event(ADMIN, Membership.LEAVE), **extra}
+    )
+
+
+class ReplayTestCase(aiounittest.AsyncTestCase):
+    def test_replay(self) -> None:
+        """Tests that leaves are replayed through the module, that the events it sends
+        are recorded, and that only the state events it needs are built."""
+        api = replay.RecordingModuleApi("example.com")
+        module = ManageLastAdmin(
+            ManageLastAdmin.parse_config({"promote_moderators": True}),
+            api,  # type: ignore[arg-type]
+        )
+        output = io.StringIO()
+
+        with self.assertLogs("manage_last_admin.replay", level="WARNING"):
+            stats = replay.replay(
+                module,
+                api,
+                [make_line(100), "", "not json", make_line(10, room_version="9")],
+                output,
+            )
+
+        self.assertEqual(stats.events, 2)
+        self.assertEqual(stats.leaves, 2)
+        self.assertEqual(stats.skipped, 1)
+        self.assertEqual(stats.sent, 2)
+        self.assertEqual(len(stats.latencies), 2)
+        # The power levels and the memberships of the users they list, for each line.
+        self.assertEqual(stats.state_events_built, 6)
+
+        sent = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([record["line"] for record in sent], [1, 4])
+        for record in sent:
+            self.assertEqual(record["sent"]["type"], EventTypes.PowerLevels)
+            self.assertEqual(record["sent"]["content"]["users"][MOD], 100)
+
+    def test_main(self) -> None:
+        """Tests that the command line reads the dumps and the configuration, and prints
+        a summary."""
+        with tempfile.TemporaryDirectory() as directory:
+            dump_path = os.path.join(directory, "dump.jsonl")
+            with open(dump_path, "w") as f:
+                f.write(make_line(10) + "\n")
+            config_path = os.path.join(directory, "config.yaml")
+            with open(config_path, "w") as f:
+                f.write("promote_moderators: false\n")
+            output_path = os.path.join(directory, "sent.jsonl")
+
+            stdout = io.StringIO()
+            replay.main(
+                ["--config", config_path, "--output", output_path, dump_path], stdout
+            )
+
+            with open(output_path) as f:
+                sent = [json.loads(line) for line in f]
+
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0]["sent"]["content"]["users_default"], 100)
+        self.assertIn(
+            "Events checked: 1 (1 leaves, 0 lines skipped)", stdout.getvalue()
+        )
+        self.assertIn("Latency: p50", stdout.getvalue())